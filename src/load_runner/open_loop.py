@@ -0,0 +1,265 @@
+"""
+Open-loop load runner - sends search requests at a fixed arrival rate regardless of the responses,
+replayed from a recorded request log or generated from a configurable distribution (see workload.py).
+
+Unlike the closed-loop locust user (main.py), a slow response does not delay the following requests,
+and latency is measured from the time the request was scheduled to be sent, so queueing in the server
+(or in the runner, if all connections are busy) is included rather than omitted (coordinated omission).
+
+    python open_loop.py --host http://localhost:8100 --rate 200 --duration 60
+    python open_loop.py --movies ../movie_indexer_job/data/seed_data.json --cache-hit-ratio 0.8 --deep-page-ratio 0.1
+    python open_loop.py --replay access.log --rate 500
+"""
+import argparse
+import http.client
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import urlsplit
+
+from workload import Vocabulary, WorkloadConfig, WorkloadGenerator, read_request_log, replay, shape_of
+
+# histogram buckets are log-scaled: 4 buckets per doubling (~19% wide) from 10us to ~20 minutes
+MIN_LATENCY = 1e-5
+BUCKETS_PER_OCTAVE = 4
+BUCKET_COUNT = BUCKETS_PER_OCTAVE * 27
+
+DEFAULT_HOST = os.environ.get("MOVIE_SERVER_URL", "http://localhost:8100")
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket log-scaled histogram of durations in seconds,
+    quantiles are reported as the upper bound of the bucket (capped by the max)
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.max = 0.
+
+    @staticmethod
+    def upper_bound(bucket: int) -> float:
+        return MIN_LATENCY * 2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE)
+
+    def add(self, elapsed: float):
+        bucket = int(math.log2(elapsed / MIN_LATENCY) * BUCKETS_PER_OCTAVE) if elapsed > MIN_LATENCY else 0
+        self.counts[min(bucket, BUCKET_COUNT - 1)] += 1
+        self.count += 1
+        self.max = max(self.max, elapsed)
+
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        total = 0
+        for bucket, count in enumerate(self.counts):
+            total += count
+            if total >= rank and count:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def buckets(self) -> Dict[str, int]:
+        """
+        Non-empty buckets keyed by the upper bound in milliseconds
+        """
+        return {f"{self.upper_bound(bucket) * 1000:.4g}": count for bucket, count in enumerate(self.counts) if count}
+
+
+class ShapeStats:
+    """
+    Latencies of one query shape:
+    - corrected: from the scheduled send time to the response, what a user arriving at that time experiences
+    - service: from the actual send time to the response, as a closed-loop client would report it
+    """
+
+    def __init__(self):
+        self.corrected = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.errors = 0
+
+
+@dataclass
+class ShapeSummary:
+    """
+    Latency percentiles in milliseconds
+    """
+    shape: str
+    requests: int
+    errors: int
+    p50: float
+    p90: float
+    p99: float
+    p999: float
+    max: float
+    service_p50: float
+    service_p99: float
+
+
+class OpenLoopRunner:
+    """
+    Sends requests on schedule from one thread, responses are awaited by a pool of threads,
+    each keeping its own persistent connection
+    """
+
+    def __init__(self, host: str, rate: float, duration: float, connections: int, poisson: bool = False,
+                 timeout: float = 10, seed: Optional[int] = None):
+        url = urlsplit(host if "//" in host else f"http://{host}")
+        self.connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.rate = rate
+        self.duration = duration
+        self.connections = connections
+        self.poisson = poisson
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.stats: Dict[str, ShapeStats] = {}
+        self.sent = 0
+        self.elapsed = 0.
+
+    def connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = self.local.connection = self.connection_class(self.netloc, timeout=self.timeout)
+        return connection
+
+    def send(self, path: str, scheduled: float):
+        start_time = time.perf_counter()
+        try:
+            connection = self.connection()
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            failed = response.status >= 400
+        except (OSError, http.client.HTTPException):
+            self.local.connection.close()
+            self.local.connection = None
+            failed = True
+        end_time = time.perf_counter()
+
+        shape = shape_of(path)
+        with self.lock:
+            stats = self.stats.get(shape)
+            if stats is None:
+                stats = self.stats[shape] = ShapeStats()
+            stats.corrected.add(end_time - scheduled)
+            stats.service.add(end_time - start_time)
+            stats.errors += failed
+
+    def run(self, paths: Iterator[str]):
+        start_time = time.perf_counter()
+        scheduled = start_time
+        with ThreadPoolExecutor(max_workers=self.connections) as executor:
+            for path in paths:
+                if scheduled - start_time >= self.duration:
+                    break
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(self.send, path, scheduled)
+                self.sent += 1
+                scheduled += self.rng.expovariate(self.rate) if self.poisson else 1 / self.rate
+        self.elapsed = time.perf_counter() - start_time
+
+    def summary(self) -> List[ShapeSummary]:
+        """
+        Per shape summaries, the most frequent shape first, followed by the total
+        """
+        shapes = sorted(self.stats.items(), key=lambda _: -_[1].corrected.count)
+        total = ShapeStats()
+        for _, stats in shapes:
+            for histogram, total_histogram in ((stats.corrected, total.corrected), (stats.service, total.service)):
+                total_histogram.counts = [a + b for a, b in zip(total_histogram.counts, histogram.counts)]
+                total_histogram.count += histogram.count
+                total_histogram.max = max(total_histogram.max, histogram.max)
+            total.errors += stats.errors
+
+        return [
+            ShapeSummary(
+                shape=shape,
+                requests=stats.corrected.count,
+                errors=stats.errors,
+                p50=stats.corrected.quantile(0.5) * 1000,
+                p90=stats.corrected.quantile(0.9) * 1000,
+                p99=stats.corrected.quantile(0.99) * 1000,
+                p999=stats.corrected.quantile(0.999) * 1000,
+                max=stats.corrected.max * 1000,
+                service_p50=stats.service.quantile(0.5) * 1000,
+                service_p99=stats.service.quantile(0.99) * 1000,
+            )
+            for shape, stats in shapes + [("total", total)]
+        ]
+
+
+def print_summary(runner: OpenLoopRunner, summaries: List[ShapeSummary]):
+    print(f"Sent {runner.sent} requests in {runner.elapsed:.1f}s ({runner.sent / runner.elapsed:.1f}/s, target {runner.rate:.1f}/s)")
+    print("Corrected latency (from the scheduled send time) in ms, service latency (from the actual send time) for comparison")
+    print(f"{'shape':<36} {'requests':>9} {'errors':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'p99.9':>9} {'max':>9} "
+          f"{'svc p50':>9} {'svc p99':>9}")
+    for _ in summaries:
+        print(f"{_.shape:<36} {_.requests:>9} {_.errors:>7} {_.p50:>9.2f} {_.p90:>9.2f} {_.p99:>9.2f} {_.p999:>9.2f} "
+              f"{_.max:>9.2f} {_.service_p50:>9.2f} {_.service_p99:>9.2f}")
+
+
+def parse_shape_weights(value: str) -> Dict[str, float]:
+    weights = {}
+    for item in value.split(","):
+        shape, _, weight = item.partition("=")
+        weights[shape.strip()] = float(weight or 1)
+    return weights
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Open-loop load runner for the movie search API")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="server url, MOVIE_SERVER_URL by default")
+    parser.add_argument("--rate", type=float, default=100, help="requests per second")
+    parser.add_argument("--duration", type=float, default=60, help="seconds")
+    parser.add_argument("--connections", type=int, default=64, help="maximum concurrent requests")
+    parser.add_argument("--poisson", action="store_true", help="exponentially distributed gaps instead of a constant one")
+    parser.add_argument("--timeout", type=float, default=10)
+    parser.add_argument("--replay", help="recorded access log or file of request paths to replay instead of generated queries")
+    parser.add_argument("--movies", help="json db (e.g. the seed data) to draw queried words, cast, genres and years from")
+    parser.add_argument("--shape-weights", type=parse_shape_weights, help="e.g. all=1,year=1,year_genre=1,cast_genre=1,title=2,complex=1")
+    parser.add_argument("--zipf", type=float, default=WorkloadConfig.zipf_exponent, help="popularity skew of queried values")
+    parser.add_argument("--deep-page-ratio", type=float, default=WorkloadConfig.deep_page_ratio)
+    parser.add_argument("--cache-hit-ratio", type=float, default=WorkloadConfig.cache_hit_ratio)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", help="also write summaries and corrected histograms as json to this file")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        paths = replay(read_request_log(args.replay))
+    else:
+        config = WorkloadConfig(zipf_exponent=args.zipf, deep_page_ratio=args.deep_page_ratio,
+                                cache_hit_ratio=args.cache_hit_ratio, seed=args.seed)
+        if args.shape_weights:
+            config.shape_weights = args.shape_weights
+        vocabulary = Vocabulary.from_movies(args.movies) if args.movies else Vocabulary()
+        paths = iter(WorkloadGenerator(config, vocabulary))
+
+    runner = OpenLoopRunner(args.host, args.rate, args.duration, args.connections, args.poisson, args.timeout, args.seed)
+    runner.run(paths)
+    summaries = runner.summary()
+    print_summary(runner, summaries)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "rate": args.rate,
+                "sent": runner.sent,
+                "elapsed": runner.elapsed,
+                "summaries": [asdict(_) for _ in summaries],
+                "corrected_histograms_ms": {shape: stats.corrected.buckets() for shape, stats in runner.stats.items()},
+            }, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
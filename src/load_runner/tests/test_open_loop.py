@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+
+import open_loop
+from open_loop import LatencyHistogram, OpenLoopRunner
+
+
+class FakeClock:
+    """
+    Stand-in of the time module, sleeping advances the clock
+    """
+
+    def __init__(self):
+        self.now = 0.
+
+    def perf_counter(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class FakeResponse:
+
+    def __init__(self, status: int):
+        self.status = status
+
+    def read(self) -> bytes:
+        return b"{}"
+
+
+class FakeConnection:
+    """
+    Responds after the service time has passed on the clock
+    """
+
+    def __init__(self, clock: FakeClock, service_time: float, status: int = 200):
+        self.clock = clock
+        self.service_time = service_time
+        self.status = status
+        self.paths = []
+
+    def request(self, method: str, path: str):
+        self.paths.append(path)
+
+    def getresponse(self) -> FakeResponse:
+        self.clock.now += self.service_time
+        return FakeResponse(self.status)
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(open_loop, "time", clock)
+    return clock
+
+
+def test_latency_is_measured_from_the_scheduled_send_time(clock):
+    runner = OpenLoopRunner("localhost:8100", rate=10, duration=1, connections=1)
+    runner.local.connection = FakeConnection(clock, service_time=0.1)
+
+    # the request was scheduled at 0, but sent at 0.5 as all connections were busy
+    clock.now = 0.5
+    runner.send("/?year=2000", scheduled=0.)
+    runner.send("/?year=2001", scheduled=0.6)
+
+    stats = runner.stats["year"]
+    assert stats.corrected.count == stats.service.count == 2
+    assert stats.corrected.max == pytest.approx(0.6)
+    assert stats.service.max == pytest.approx(0.1)
+    summary = {_.shape: _ for _ in runner.summary()}
+    assert summary["year"].max == summary["total"].max == pytest.approx(600)
+    assert summary["year"].service_p99 == pytest.approx(100, rel=0.2)
+    assert summary["year"].errors == 0
+
+    runner.local.connection = FakeConnection(clock, service_time=0.1, status=500)
+    runner.send("/", scheduled=clock.now)
+    assert runner.stats["all"].errors == 1
+
+
+def test_requests_are_sent_on_schedule_regardless_of_delays(clock):
+    # a gap of 1/8s adds up without rounding
+    runner = OpenLoopRunner("localhost:8100", rate=8, duration=1, connections=4)
+    sent = []
+    lock = threading.Lock()
+
+    def send(path: str, scheduled: float):
+        with lock:
+            sent.append((path, scheduled))
+
+    runner.send = send
+
+    def slow_paths():
+        # producing each request takes longer than the gap between requests, the runner falls behind the schedule
+        for number in range(100):
+            clock.now += 0.25
+            yield f"/?page={number}"
+
+    runner.run(slow_paths())
+
+    assert runner.sent == 8
+    assert sorted(scheduled for _, scheduled in sent) == [number / 8 for number in range(8)]
+    # the schedule is not shifted by the delays, so the latency of late requests includes the lag
+    assert clock.now > 2
+
+
+def test_histogram_quantiles_are_bucket_upper_bounds():
+    histogram = LatencyHistogram()
+    for number in range(1, 101):
+        histogram.add(number / 1000)
+
+    assert histogram.count == 100
+    assert histogram.max == pytest.approx(0.1)
+    # buckets are ~19% wide
+    assert 0.050 <= histogram.quantile(0.5) < 0.050 * 1.19
+    assert 0.099 <= histogram.quantile(0.99) <= 0.1
+    assert histogram.quantile(1) == pytest.approx(0.1)
+    assert sum(histogram.buckets().values()) == 100
@@ -0,0 +1,59 @@
+import itertools
+import random
+from collections import Counter
+
+import pytest
+
+from workload import DEEP_PAGE, Vocabulary, WorkloadConfig, WorkloadGenerator, ZipfSampler, read_request_log, replay, shape_of
+
+
+def generate(config: WorkloadConfig, count: int = 1000):
+    return list(itertools.islice(WorkloadGenerator(config, Vocabulary()), count))
+
+
+def test_workload_is_deterministic_for_a_seed():
+    assert generate(WorkloadConfig(seed=7), 5) == ["/?year=1990", "/?page=2", "/?year=1990", "/?year=1990", "/?page=2"]
+    assert generate(WorkloadConfig(seed=7)) == generate(WorkloadConfig(seed=7))
+    assert generate(WorkloadConfig(seed=7)) != generate(WorkloadConfig(seed=8))
+
+
+def test_workload_follows_the_configuration():
+    paths = generate(WorkloadConfig(shape_weights={"year_genre": 1}, deep_page_ratio=0, cache_hit_ratio=0, seed=1))
+    assert {shape_of(_) for _ in paths} == {"year+genre"}
+
+    paths = generate(WorkloadConfig(shape_weights={"cast_genre": 1}, deep_page_ratio=1, cache_hit_ratio=0, seed=1))
+    assert {shape_of(_) for _ in paths} == {"cast+genre:deep"}
+
+    # repeated requests come from the recently generated ones
+    paths = generate(WorkloadConfig(cache_hit_ratio=0.9, repeat_pool=10, seed=1))
+    repeated = sum(path in paths[:number] for number, path in enumerate(paths))
+    assert 850 < repeated < 950
+
+    with pytest.raises(ValueError):
+        WorkloadGenerator(WorkloadConfig(shape_weights={"unknown": 1}), Vocabulary())
+
+
+def test_zipf_sampler_ranks_values_by_popularity():
+    sampler = ZipfSampler(["a", "b", "c"], 1.0)
+    rng = random.Random(1)
+    counts = Counter(sampler.sample(rng) for _ in range(11000))
+    # weights 1 : 1/2 : 1/3
+    assert counts["a"] > counts["b"] > counts["c"]
+    assert abs(counts["a"] / counts["c"] - 3) < 0.3
+
+
+def test_shape_of_request_paths():
+    assert shape_of("/") == "all"
+    assert shape_of("/?year=0&genre=Drama") == "genre"
+    assert shape_of(f"/?title_contains=day&page={DEEP_PAGE}") == "title_contains:deep"
+    assert shape_of("/?cast=X&cursor=abc") == "cast:deep"
+
+
+def test_can_replay_request_log(tmp_path):
+    log = tmp_path / "access.log"
+    log.write_text('127.0.0.1 - "GET /?year=2000 HTTP/1.1" 200\n/?genre=Drama\nnot a request\n')
+    paths = read_request_log(str(log))
+    assert paths == ["/?year=2000", "/?genre=Drama"]
+    assert list(itertools.islice(replay(paths), 3)) == ["/?year=2000", "/?genre=Drama", "/?year=2000"]
+    with pytest.raises(ValueError):
+        replay([])
@@ -0,0 +1,194 @@
+"""
+Search requests for the open-loop load runner - replayed from recorded request logs or generated
+from a configurable distribution of query shapes, values, pages and repeated (cached) queries
+"""
+import bisect
+import itertools
+import json
+import random
+import re
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+# the values queried by the locust user (main.py), used when no movie data is given
+FREQUENT_WORDS = ["book", "dawn", "day", "fate", "word"]
+FAMOUS_CAST = ["Sean Connery", "Gillian Anderson", "Cate Blanchett", "Billy Bob Thornton"]
+GENRES = ["Drama", "Comedy"]
+YEARS = list(range(1990, 2010))
+
+# pages from DEEP_PAGE on are reported as a separate shape
+DEEP_PAGE = 10
+MAX_DEEP_PAGE = 100
+FILTERS = ("title_contains", "year", "cast", "genre")
+
+# request line of an access log (uvicorn, nginx, ingress), e.g. "GET /?year=2000&page=1 HTTP/1.1"
+REQUEST_LINE = re.compile(r'"GET (\S+) HTTP/[\d.]+"')
+
+
+def shape_of(path: str) -> str:
+    """
+    Query shape of a search request path - the filters present, e.g. "cast+genre" or "all" without filters,
+    with a ":deep" suffix for pages from DEEP_PAGE on or cursor pagination
+    """
+    params = dict(parse_qsl(urlsplit(path).query))
+    shape = "+".join(_ for _ in FILTERS if params.get(_) not in (None, "", "0")) or "all"
+    try:
+        deep = "cursor" in params or int(params.get("page", 0)) >= DEEP_PAGE
+    except ValueError:
+        deep = False
+    return f"{shape}:deep" if deep else shape
+
+
+def read_request_log(path: str) -> List[str]:
+    """
+    Search request paths of a recorded log - access log lines with a GET request line, or one path per line
+    """
+    paths = []
+    with open(path) as f:
+        for line in f:
+            match = REQUEST_LINE.search(line)
+            if match is not None:
+                paths.append(match.group(1))
+            elif line.startswith("/"):
+                paths.append(line.strip())
+    return paths
+
+
+def replay(paths: List[str]) -> Iterator[str]:
+    """
+    Recorded requests in order, repeated from the start until the run ends
+    """
+    if not paths:
+        raise ValueError("No requests to replay")
+    return itertools.cycle(paths)
+
+
+class ZipfSampler:
+    """
+    Draws values ranked by popularity, the probability of the k-th value is proportional to k ** -exponent
+    """
+
+    def __init__(self, values: List, exponent: float):
+        self.values = values
+        self.cum_weights = list(itertools.accumulate(rank ** -exponent for rank in range(1, len(values) + 1)))
+
+    def sample(self, rng: random.Random):
+        return self.values[bisect.bisect(self.cum_weights, rng.random() * self.cum_weights[-1])]
+
+
+@dataclass
+class Vocabulary:
+    """
+    Query values ranked by popularity
+    """
+    words: List[str] = field(default_factory=lambda: list(FREQUENT_WORDS))
+    cast: List[str] = field(default_factory=lambda: list(FAMOUS_CAST))
+    genres: List[str] = field(default_factory=lambda: list(GENRES))
+    years: List[int] = field(default_factory=lambda: list(YEARS))
+
+    @staticmethod
+    def from_movies(path: str, top: int = 10000, min_word_length: int = 3) -> "Vocabulary":
+        """
+        Rank title words, cast members, genres and years of a json db (e.g. the seed data) by the number of movies
+        """
+        with open(path) as f:
+            movies = json.load(f)
+        words, cast, genres, years = Counter(), Counter(), Counter(), Counter()
+        for movie in movies:
+            words.update({_ for _ in re.findall(r"\w+", movie["title"].lower()) if len(_) >= min_word_length})
+            cast.update(set(movie["cast"]))
+            genres.update(set(movie["genres"]))
+            years[movie["year"]] += 1
+        return Vocabulary(
+            words=[_ for _, count in words.most_common(top)],
+            cast=[_ for _, count in cast.most_common(top)],
+            genres=[_ for _, count in genres.most_common()],
+            years=[_ for _, count in years.most_common()],
+        )
+
+
+@dataclass
+class WorkloadConfig:
+    """
+    - shape_weights: relative frequency of query shapes, equal as the locust tasks by default
+    - zipf_exponent: skew of title word, cast, genre and year popularity
+    - deep_page_ratio: fraction of paginated queries asking a page from DEEP_PAGE to MAX_DEEP_PAGE, others ask pages 0-2
+    - cache_hit_ratio: fraction of requests repeating one of the last repeat_pool generated requests,
+      i.e. served from the result cache once it is warm
+    """
+    shape_weights: Dict[str, float] = field(default_factory=lambda: {
+        "all": 1, "year": 1, "year_genre": 1, "cast_genre": 1, "title": 1, "complex": 1,
+    })
+    zipf_exponent: float = 1.0
+    deep_page_ratio: float = 0.05
+    cache_hit_ratio: float = 0.5
+    repeat_pool: int = 1000
+    seed: Optional[int] = None
+
+
+class WorkloadGenerator:
+    """
+    Generates search request paths of the configured distribution
+    """
+
+    SHAPES = ("all", "year", "year_genre", "cast_genre", "title", "complex")
+
+    def __init__(self, config: WorkloadConfig, vocabulary: Vocabulary):
+        unknown = set(config.shape_weights) - set(self.SHAPES)
+        if unknown:
+            raise ValueError(f"Unknown query shapes {', '.join(sorted(unknown))}")
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.words = ZipfSampler(vocabulary.words, config.zipf_exponent)
+        self.cast = ZipfSampler(vocabulary.cast, config.zipf_exponent)
+        self.genres = ZipfSampler(vocabulary.genres, config.zipf_exponent)
+        self.years = ZipfSampler(vocabulary.years, config.zipf_exponent)
+        self.shapes = list(config.shape_weights)
+        self.shape_weights = list(config.shape_weights.values())
+        self.recent: deque = deque(maxlen=config.repeat_pool)
+
+    def page(self) -> int:
+        if self.rng.random() < self.config.deep_page_ratio:
+            return self.rng.randrange(DEEP_PAGE, MAX_DEEP_PAGE)
+        return self.rng.randrange(3)
+
+    def filters(self, shape: str) -> Tuple[Dict, bool]:
+        """
+        Filters of a new query of the shape and whether it is paginated
+        """
+        if shape == "all":
+            return {}, True
+        if shape == "year":
+            return {"year": self.years.sample(self.rng)}, True
+        if shape == "year_genre":
+            return {"year": self.years.sample(self.rng), "genre": self.genres.sample(self.rng)}, True
+        if shape == "cast_genre":
+            return {"cast": self.cast.sample(self.rng), "genre": self.genres.sample(self.rng)}, True
+        if shape == "title":
+            return {"title_contains": self.words.sample(self.rng)}, False
+        return {
+            "title_contains": self.words.sample(self.rng),
+            "year": self.years.sample(self.rng),
+            "cast": self.cast.sample(self.rng),
+            "genre": self.genres.sample(self.rng),
+        }, False
+
+    def next_path(self) -> str:
+        if self.recent and self.rng.random() < self.config.cache_hit_ratio:
+            return self.rng.choice(self.recent)
+
+        shape = self.rng.choices(self.shapes, self.shape_weights)[0]
+        params, paginated = self.filters(shape)
+        if paginated:
+            page = self.page()
+            if page:
+                params["page"] = page
+        path = f"/?{urlencode(params)}" if params else "/"
+        self.recent.append(path)
+        return path
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            yield self.next_path()
@@ -0,0 +1,89 @@
+"""
+Compression of published objects as streams - gzip, or zstd if the zstandard package is installed.
+The API server has a copy of the decompression part (movies/compression.py), keep them in sync.
+"""
+import hashlib
+import zlib
+from typing import BinaryIO, Iterable, Iterator, Tuple
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+CHUNK_SIZE = 1024 * 1024
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+
+def new_compressor(encoding: str):
+    if encoding == "gzip":
+        # the gzip header has no timestamp, equal contents are compressed to equal objects
+        return zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    raise ValueError(f"Unsupported compression {encoding}")
+
+
+def new_decompressor(encoding: str):
+    if encoding == "gzip":
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported compression {encoding}")
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    compressor = new_compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_file(src: BinaryIO, dst: BinaryIO, encoding: str) -> Tuple[int, str]:
+    """
+    Compress the file chunk by chunk, returns the size and the sha256 checksum of the compressed contents
+    """
+    compressor = new_compressor(encoding)
+    checksum = hashlib.sha256()
+    size = 0
+
+    def write(data: bytes):
+        nonlocal size
+        dst.write(data)
+        checksum.update(data)
+        size += len(data)
+
+    for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+        write(compressor.compress(chunk))
+    write(compressor.flush())
+    return size, checksum.hexdigest()
+
+
+def iter_decompressed(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """
+    Decompress a stream of chunks
+
+    :raises ValueError: if the stream is not valid or truncated
+    """
+    decompressor = new_decompressor(encoding)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    # older zstandard versions don't report the end of the frame, the checksum of the object covers truncation then
+    if not getattr(decompressor, "eof", True):
+        raise ValueError("Compressed stream is truncated")
+
+
+def iter_verified(chunks: Iterable[bytes], size: int, checksum: str) -> Iterator[bytes]:
+    """
+    Pass the chunks through, checking their total size and sha256 checksum once the stream ends
+
+    :raises ValueError: if the contents do not match
+    """
+    digest = hashlib.sha256()
+    received = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        received += len(chunk)
+        yield chunk
+    if received != size or digest.hexdigest() != checksum:
+        raise ValueError(f"Object of {received} bytes does not match the expected {size} bytes and checksum {checksum}")
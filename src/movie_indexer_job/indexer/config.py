@@ -1,3 +1,4 @@
+import os
 from os import environ
 
 # use localstack if available
@@ -8,3 +9,39 @@ AWS_REGION = environ.get("AWS_DEFAULT_REGION")
 AWS_INBOX_BUCKET_NAME = environ.get("AWS_INBOX_BUCKET_NAME")
 AWS_STORAGE_BUCKET_NAME = environ.get("AWS_STORAGE_BUCKET_NAME")
 AWS_ARCHIVE_BUCKET_NAME = environ.get("AWS_ARCHIVE_BUCKET_NAME")
+# the json db is published as content-addressed compressed objects (main.db/<sha256>.json.gz) followed by the pointer
+# naming the current one (version, key, size, checksum), readers fetch the pointer and then exactly that object
+MAIN_DB_POINTER_KEY = environ.get("MAIN_DB_POINTER_KEY", "main.pointer")
+MAIN_DB_PREFIX = environ.get("MAIN_DB_PREFIX", "main.db/")
+# compression of the json db and of the snapshot shards - "gzip", or "zstd" if the zstandard package is installed
+SNAPSHOT_COMPRESSION = environ.get("SNAPSHOT_COMPRESSION", "gzip")
+# binary snapshot of the main db for fast API server startup
+BINARY_SNAPSHOT_KEY = environ.get("BINARY_SNAPSHOT_KEY", "main.snapshot")
+# binary snapshot split into shards for concurrent loading, published with a manifest listing the shards
+SNAPSHOT_MANIFEST_KEY = environ.get("SNAPSHOT_MANIFEST_KEY", "main.manifest")
+SNAPSHOT_SHARD_PREFIX = environ.get("SNAPSHOT_SHARD_PREFIX", "main.shards/")
+SNAPSHOT_SHARD_SIZE = int(environ.get("SNAPSHOT_SHARD_SIZE", "50000"))
+# movies of each run are written as a delta segment listed in the manifest after the shards,
+# segments are compacted into a new base once there are COMPACTION_MAX_SEGMENTS of them
+# or they hold more movies than COMPACTION_MAX_SEGMENT_RATIO of the base
+SNAPSHOT_SEGMENT_PREFIX = environ.get("SNAPSHOT_SEGMENT_PREFIX", "main.segments/")
+COMPACTION_MAX_SEGMENTS = int(environ.get("COMPACTION_MAX_SEGMENTS", "16"))
+COMPACTION_MAX_SEGMENT_RATIO = float(environ.get("COMPACTION_MAX_SEGMENT_RATIO", "0.1"))
+# inbox objects fetched concurrently (and pooled S3 connections)
+INBOX_FETCH_WORKERS = int(environ.get("INBOX_FETCH_WORKERS", "16"))
+# inbox files of at least this size are decoded in a pool of processes, 0 processes decode every file in the fetching threads
+INBOX_PROCESS_DECODE_MIN_BYTES = int(environ.get("INBOX_PROCESS_DECODE_MIN_BYTES", str(4 * 1024 * 1024)))
+INBOX_DECODE_PROCESSES = int(environ.get("INBOX_DECODE_PROCESSES", str(os.cpu_count() or 1)))
+# processed inbox objects are copied to the archive bucket by ARCHIVE_WORKERS threads and deleted in batches,
+# S3 calls and failed deletes of single keys are attempted up to ARCHIVE_MAX_ATTEMPTS times
+ARCHIVE_WORKERS = int(environ.get("ARCHIVE_WORKERS", "16"))
+ARCHIVE_DELETE_BATCH_SIZE = int(environ.get("ARCHIVE_DELETE_BATCH_SIZE", "1000"))
+ARCHIVE_MAX_ATTEMPTS = int(environ.get("ARCHIVE_MAX_ATTEMPTS", "5"))
+# "streaming" ingests with memory bounded by INGEST_MEMORY_BUDGET_BYTES (see indexer/streaming.py) instead of the whole db in memory
+INGEST_MODE = environ.get("INGEST_MODE", "memory")
+INGEST_MEMORY_BUDGET_BYTES = int(environ.get("INGEST_MEMORY_BUDGET_BYTES", str(256 * 1024 * 1024)))
+# movies changed by each run are published as the next version of the change log (main.changes/<version>.json),
+# runs changing more than CHANGELOG_MAX_UPSERTS movies are published as reload entries, the last CHANGELOG_RETENTION versions are kept
+CHANGELOG_PREFIX = environ.get("CHANGELOG_PREFIX", "main.changes/")
+CHANGELOG_MAX_UPSERTS = int(environ.get("CHANGELOG_MAX_UPSERTS", "10000"))
+CHANGELOG_RETENTION = int(environ.get("CHANGELOG_RETENTION", "1000"))
@@ -0,0 +1,77 @@
+"""
+Incremental parsing of a top level json array, e.g. the json db streamed from S3
+(same as movies/json_stream.py of the API server, keep them in sync)
+"""
+import codecs
+import json
+import re
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+NON_WHITESPACE = re.compile(r"\S")
+
+
+def iter_json_array(chunks: Iterable[bytes], object_pairs_hook: Optional[Callable] = None) -> Iterator[Any]:
+    """
+    Yield items of a json array from chunks of utf-8 encoded bytes,
+    only the current chunk and an incomplete item are kept in memory.
+
+    :raises json.JSONDecodeError: if the data is not a json array
+    """
+    decoder = json.JSONDecoder(object_pairs_hook=object_pairs_hook)
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    exhausted = False
+
+    def read_more() -> bool:
+        nonlocal buffer, position, exhausted
+        if exhausted:
+            return False
+        chunk = next(chunks, None)
+        exhausted = chunk is None
+        buffer = buffer[position:] + text_decoder.decode(chunk or b"", final=exhausted)
+        position = 0
+        return True
+
+    def next_char() -> str:
+        # next non-whitespace character, empty at the end of the data
+        nonlocal position
+        while True:
+            match = NON_WHITESPACE.search(buffer, position)
+            if match is not None:
+                position = match.start()
+                return buffer[position]
+            position = len(buffer)
+            if not read_more():
+                return ""
+
+    if next_char() != "[":
+        raise json.JSONDecodeError("Expecting '['", buffer, position)
+    position += 1
+
+    if next_char() == "]":
+        return
+    while True:
+        next_char()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the item may be incomplete, retry with the next chunk
+                if read_more():
+                    continue
+                raise
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(buffer) and read_more():
+                continue
+            break
+        position = end
+        yield item
+
+        char = next_char()
+        if char == "]":
+            return
+        if char != ",":
+            raise json.JSONDecodeError("Expecting ',' or ']'", buffer, position)
+        position += 1
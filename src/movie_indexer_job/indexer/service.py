@@ -1,41 +1,106 @@
+import contextlib
 import datetime
+import hashlib
+import io
+import itertools
 import json
 import logging
-from typing import List, Dict, Tuple
+import multiprocessing
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, BinaryIO, Iterable, Iterator, List, Dict, Optional, Tuple
 
 import boto3
+from botocore.config import Config
 
-from indexer.config import AWS_ENDPOINT_URL, AWS_INBOX_BUCKET_NAME, AWS_STORAGE_BUCKET_NAME, AWS_ARCHIVE_BUCKET_NAME
+from indexer.config import AWS_ENDPOINT_URL, AWS_INBOX_BUCKET_NAME, AWS_STORAGE_BUCKET_NAME, AWS_ARCHIVE_BUCKET_NAME, BINARY_SNAPSHOT_KEY, \
+    SNAPSHOT_MANIFEST_KEY, SNAPSHOT_SHARD_PREFIX, SNAPSHOT_SHARD_SIZE, INBOX_FETCH_WORKERS, INBOX_PROCESS_DECODE_MIN_BYTES, INBOX_DECODE_PROCESSES, \
+    SNAPSHOT_SEGMENT_PREFIX, COMPACTION_MAX_SEGMENTS, COMPACTION_MAX_SEGMENT_RATIO, ARCHIVE_WORKERS, ARCHIVE_DELETE_BATCH_SIZE, ARCHIVE_MAX_ATTEMPTS, \
+    CHANGELOG_PREFIX, CHANGELOG_MAX_UPSERTS, CHANGELOG_RETENTION, MAIN_DB_POINTER_KEY, MAIN_DB_PREFIX, SNAPSHOT_COMPRESSION
+from indexer.compression import CHUNK_SIZE, EXTENSIONS, compress, compress_file, iter_decompressed, iter_verified
+from indexer.json_stream import iter_json_array
+from indexer.snapshot import encode_snapshot
+
+# years the snapshot column (uint16) can hold
+YEAR_RANGE = range(0, 2**16)
+
+
+def intern_strings(items: List[Tuple[str, Any]]) -> Dict:
+    """
+    json object hook sharing repeated keys and short strings (cast, genres) between movies
+    """
+    dct = {}
+    for k, v in items:
+        if isinstance(v, list):
+            v = [sys.intern(_) if isinstance(_, str) else _ for _ in v]
+        elif isinstance(v, str) and len(v) < 80:
+            v = sys.intern(v)
+        dct[sys.intern(k)] = v
+    return dct
+
+
+def decode_inbox_entry(contents: bytes) -> Any:
+    return json.loads(contents.decode("utf-8"), object_pairs_hook=intern_strings)
+
+
+def list_inbox_objects(s3) -> List[Dict]:
+    """
+    All inbox objects in the order they are applied - by LastModified (in seconds), then by key,
+    the listing is followed over continuation tokens (1000 keys per page)
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    s3objects = [obj for page in paginator.paginate(Bucket=AWS_INBOX_BUCKET_NAME) for obj in page.get('Contents', [])]
+    return sorted(s3objects, key=lambda obj: int(obj['LastModified'].timestamp()))
 
 
 def read_inbox_entries(s3=None) -> List[Tuple[str, Dict]]:
     """
     Read inbox entries
-    Returns list of tuples (filename, data)
+    Returns list of tuples (filename, data) in the order of file timestamps
+
+    Objects are fetched by INBOX_FETCH_WORKERS threads sharing a pool of connections, at most twice as many
+    fetched files wait to be collected in order. Files from INBOX_PROCESS_DECODE_MIN_BYTES on are decoded
+    in a pool of processes, smaller ones in the fetching threads. Files which are not valid json are skipped.
     """
     if s3 is None:
-        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL, config=Config(max_pool_connections=INBOX_FETCH_WORKERS))
 
-    resp = s3.list_objects_v2(Bucket=AWS_INBOX_BUCKET_NAME)
+    start_time = time.perf_counter()
+    s3objects = list_inbox_objects(s3)
+    use_processes = INBOX_DECODE_PROCESSES > 0 and any(obj['Size'] >= INBOX_PROCESS_DECODE_MIN_BYTES for obj in s3objects)
 
-    # check if empty
-    if 'Contents' not in resp:
-        return []
+    res: List[Tuple[str, Dict]] = []
+    with ThreadPoolExecutor(max_workers=INBOX_FETCH_WORKERS) as fetcher, \
+            (ProcessPoolExecutor(max_workers=INBOX_DECODE_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+             if use_processes else contextlib.nullcontext()) as decoder:
+        # processes are spawned rather than forked, as they are started from the fetching threads
 
-    s3objects = resp['Contents']
-    keys = [obj['Key'] for obj in sorted(s3objects, key=lambda obj: int(obj['LastModified'].timestamp()))]
+        def load(key: str) -> Any:
+            contents = s3.get_object(Bucket=AWS_INBOX_BUCKET_NAME, Key=key)['Body'].read()
+            if decoder is not None and len(contents) >= INBOX_PROCESS_DECODE_MIN_BYTES:
+                return decoder.submit(decode_inbox_entry, contents).result()
+            return decode_inbox_entry(contents)
 
-    res: List[Tuple[str, Dict]] = []
-    for k in keys:
-        data = s3.get_object(Bucket=AWS_INBOX_BUCKET_NAME, Key=k)
-        contents = data['Body'].read()
-        try:
-            json_str = contents.decode("utf-8")
-            json_data = json.loads(json_str)
-            res.append((k, json_data))
-        except Exception as e:
-            logging.error("Can't load item with key %s: %s", k, repr(e))
+        keys = (obj['Key'] for obj in s3objects)
+        pending = deque((key, fetcher.submit(load, key)) for key in itertools.islice(keys, 2 * INBOX_FETCH_WORKERS))
+        while pending:
+            k, future = pending.popleft()
+            for key in itertools.islice(keys, 1):
+                pending.append((key, fetcher.submit(load, key)))
+            try:
+                res.append((k, future.result()))
+            except ValueError as e:
+                # not utf-8 or not json
+                logging.error("Can't load item with key %s: %s", k, repr(e))
 
+    elapsed = time.perf_counter() - start_time
+    total_bytes = sum(obj['Size'] for obj in s3objects)
+    movies = sum(len(items) for _, items in res if isinstance(items, list))
+    logging.info("Read %s inbox files (%.1fMb, %s movies) in %.2fs: %.1f files/s, %.1fMb/s, %.0f movies/s",
+                 len(res), total_bytes / 2**20, movies, elapsed, len(res) / elapsed, total_bytes / 2**20 / elapsed, movies / elapsed)
     return res
 
 
@@ -46,54 +111,379 @@ def read_main_db(s3=None) -> List[Dict]:
     if s3 is None:
         s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
 
+    return list(iter_main_db(s3))
+
+
+def iter_main_db(s3) -> Iterator[Dict]:
+    """
+    Movies of the json db, parsed while it is downloaded (see iter_main_db_chunks)
+    """
+    chunks = iter_main_db_chunks(s3)
+    yield from iter_json_array(chunks, intern_strings)
+    # parsing stops at the end of the array, the rest of the stream is read so that it is verified
+    for _ in chunks:
+        pass
+
+
+def iter_main_db_chunks(s3) -> Iterator[bytes]:
+    """
+    The json db as a stream of chunks - the object named by the pointer, decompressed and verified against
+    the size and checksum of the pointer (the error is raised once the object has been read).
+    Buckets written before the pointer was introduced are read from the legacy json db (see legacy_main_db_key),
+    an empty array if there is none
+    """
+    pointer = read_main_db_pointer(s3)
+    if pointer is not None:
+        data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=pointer["key"])
+        yield from iter_decompressed(iter_verified(data['Body'].iter_chunks(CHUNK_SIZE), pointer["size"], pointer["checksum"]), pointer["encoding"])
+        return
+
+    key = legacy_main_db_key(s3)
+    if key is None:
+        yield b"[]"
+        return
+    data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=key)
+    yield from data['Body'].iter_chunks(CHUNK_SIZE)
+
+
+def read_main_db_pointer(s3) -> Optional[Dict]:
+    try:
+        data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=MAIN_DB_POINTER_KEY)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(data['Body'].read())
+
+
+def legacy_main_db_key(s3) -> Optional[str]:
+    """
+    Key of the json db written before the pointer - the first listed object of the storage bucket
+    which is not a snapshot, shard, segment, change log entry, manifest or pointer
+    """
     s3objects = s3.list_objects(Bucket=AWS_STORAGE_BUCKET_NAME)
 
-    for item in s3objects.get('Contents'):
-        data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=item.get('Key'))
-        contents = data['Body'].read()
-        json_str = contents.decode("utf-8")
-        json_data = json.loads(json_str)
-        return json_data
+    for item in s3objects.get('Contents', []):
+        key = item.get('Key')
+        if key in (BINARY_SNAPSHOT_KEY, SNAPSHOT_MANIFEST_KEY, MAIN_DB_POINTER_KEY) \
+                or key.startswith((SNAPSHOT_SHARD_PREFIX, SNAPSHOT_SEGMENT_PREFIX, CHANGELOG_PREFIX, MAIN_DB_PREFIX)):
+            continue
+        return key
 
-    return []
+    return None
 
 
-def update_main_db(db: List[Dict], entries: List[Tuple[str, Dict]]):
+def update_main_db(db: List[Dict], entries: List[Tuple[str, Dict]]) -> List[Dict]:
     """
     Update main db with inbox entries
+    Returns the movies which were created or changed (in their final state), in the order of their first change
     """
 
-    # index for most basic entity matching
-    movies_by_title_year = {_["title"] + str(_["year"]): _ for _ in db}
+    # index for most basic entity matching, of movies with the same title and year the last one is updated
+    movies_by_title_year: Dict[Tuple[str, int], Dict] = {movie_key(movie): movie for movie in db}
+    changed: Dict[Tuple[str, int], Dict] = {}
 
     for entry in entries:
         file_key, items = entry
-        for item in items:
-            movie_key = item["title"] + str(item["year"])
-            if movie_key in movies_by_title_year:
-                movies_by_title_year[movie_key].clear()
-                movies_by_title_year[movie_key].update(item)
-            else:
-                movies_by_title_year[movie_key] = item
+        for item in valid_movies(items, file_key):
+            key = movie_key(item)
+            movie = movies_by_title_year.get(key)
+            if movie is None:
+                movies_by_title_year[key] = changed[key] = item
                 db.append(item)
+            elif movie != item:
+                movie.clear()
+                movie.update(item)
+                changed[key] = movie
+
+    return list(changed.values())
+
+
+def movie_key(movie: Dict) -> Tuple[str, int]:
+    """
+    Identity of a movie - title and year, as a tuple they can't collide the way concatenated strings do ("A1" + "999" vs "A" + "1999")
+    """
+    return movie["title"], movie["year"]
+
+
+def is_valid_movie(movie: Any) -> bool:
+    """
+    Whether an inbox item can be stored: the binary snapshot has a uint16 year column and string tables of titles, cast and genres
+    """
+    return isinstance(movie, dict) and isinstance(movie.get("title"), str) \
+        and isinstance(movie.get("year"), int) and not isinstance(movie["year"], bool) and movie["year"] in YEAR_RANGE \
+        and all(isinstance(names, list) and all(isinstance(name, str) for name in names)
+                for names in (movie.get("cast"), movie.get("genres")))
+
+
+def valid_movies(items: Iterable[Any], file_key: str) -> Iterator[Dict]:
+    """
+    The valid movies of an inbox entry, invalid ones are logged and skipped so they can't fail the snapshots of every later run
+    """
+    for item in items:
+        if is_valid_movie(item):
+            yield item
+        else:
+            logging.warning("Skipping invalid movie in inbox entry %s: %r", file_key, item)
 
 
 def write_main_db(db: List[Dict], s3=None):
     """
-    Write main db back to S3
+    Write main db back to S3 (see publish_main_db), followed by the binary snapshot and the sharded binary snapshot
+    which is preferred by the API server. The single binary snapshot is kept for API servers which do not read sharded snapshots yet.
     """
     if s3 is None:
         s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
-    s3.put_object(Body=json.dumps(db).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key="main")
+    publish_main_db(io.BytesIO(json.dumps(db).encode()), s3)
+    s3.put_object(Body=encode_snapshot(db), Bucket=AWS_STORAGE_BUCKET_NAME, Key=BINARY_SNAPSHOT_KEY)
+    write_sharded_snapshot(db, s3)
 
 
-def archive_inbox_entries(entries: List[Tuple[str, Dict]], s3=None):
+def publish_main_db(f: BinaryIO, s3) -> Dict:
     """
-    Archive inbox entries to archive bucket
+    Publish the json db read from the file: it is compressed with SNAPSHOT_COMPRESSION (through a temporary file)
+    into an object named by its checksum, then the pointer to it is replaced with a single PUT, so readers
+    get either the previous or the new db and never list the bucket. Db objects other than the new one
+    and the one of the replaced pointer (which may still be loading) are deleted.
+    Returns the published pointer
     """
+    previous_pointer = read_main_db_pointer(s3)
+    with tempfile.TemporaryFile() as compressed:
+        size, checksum = compress_file(f, compressed, SNAPSHOT_COMPRESSION)
+        key = f"{MAIN_DB_PREFIX}{checksum}.json{EXTENSIONS[SNAPSHOT_COMPRESSION]}"
+        compressed.seek(0)
+        s3.upload_fileobj(compressed, AWS_STORAGE_BUCKET_NAME, key)
+
+    version = previous_pointer["version"] + 1 if previous_pointer is not None else 1
+    pointer = {"version": version, "key": key, "size": size, "checksum": checksum, "encoding": SNAPSHOT_COMPRESSION}
+    s3.put_object(Body=json.dumps(pointer).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=MAIN_DB_POINTER_KEY)
+
+    keep = {key}
+    if previous_pointer is not None:
+        keep.add(previous_pointer["key"])
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=MAIN_DB_PREFIX):
+        for item in page.get('Contents', []):
+            if item['Key'] not in keep:
+                s3.delete_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=item['Key'])
+    return pointer
+
+
+def read_snapshot_manifest(s3=None) -> Optional[Dict]:
     if s3 is None:
         s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
-    for entry in entries:
-        file_key, items = entry
-        s3.put_object(Body=json.dumps(items).encode(), Bucket=AWS_ARCHIVE_BUCKET_NAME, Key=str(int(datetime.datetime.now().timestamp() * 1000000)) + file_key)
-        s3.delete_object(Bucket=AWS_INBOX_BUCKET_NAME, Key=file_key)
+    try:
+        data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+    except s3.exceptions.NoSuchKey:
+        return None
+    return json.loads(data['Body'].read())
+
+
+def shard_set_of(key: str) -> str:
+    """
+    Shard set (publish) the shard key belongs to
+    """
+    return key[len(SNAPSHOT_SHARD_PREFIX):].split("/", 1)[0]
+
+
+def write_sharded_snapshot(db: List[Dict], s3):
+    """
+    Write the binary snapshot split into shards of SNAPSHOT_SHARD_SIZE movies, followed by the manifest listing them.
+    Every publish writes shards under a new shard set, so replacing the manifest switches readers to a complete set at once.
+    Shard sets other than the new one and the one of the replaced manifest (which may still be loading) are deleted,
+    as are the delta segments not listed in the replaced manifest.
+    """
+    previous_manifest = read_snapshot_manifest(s3)
+    shard_set = new_object_id()
+    shards = write_shards(db, shard_set, s3)
+    publish_base_manifest(len(db), shards, shard_set, previous_manifest, s3)
+
+
+def write_shards(items: Iterable[Dict], shard_set: str, s3) -> List[Dict]:
+    """
+    Write movies as binary shards of SNAPSHOT_SHARD_SIZE movies under the shard set, compressed with SNAPSHOT_COMPRESSION,
+    one shard is encoded at a time. Returns the manifest entries of the shards, with the size and the sha256 checksum
+    readers verify the shards against
+    """
+    items = iter(items)
+    shards = []
+    for number in itertools.count():
+        shard_items = list(itertools.islice(items, SNAPSHOT_SHARD_SIZE))
+        if not shard_items:
+            break
+        key = f"{SNAPSHOT_SHARD_PREFIX}{shard_set}/{number:05d}.snapshot{EXTENSIONS[SNAPSHOT_COMPRESSION]}"
+        body = compress(encode_snapshot(shard_items), SNAPSHOT_COMPRESSION)
+        s3.put_object(Body=body, Bucket=AWS_STORAGE_BUCKET_NAME, Key=key)
+        shards.append({"key": key, "format": "binary", "encoding": SNAPSHOT_COMPRESSION, "size": len(body),
+                       "checksum": hashlib.sha256(body).hexdigest(), "movies": len(shard_items)})
+    return shards
+
+
+def publish_base_manifest(movies: int, shards: List[Dict], shard_set: str, previous_manifest: Optional[Dict], s3):
+    """
+    Publish the manifest of a new base (without segments) and delete the shard sets and segments no manifest refers to
+    """
+    # the base changes only when a new shard set is published, API servers reload then (segments arrive through the change log)
+    manifest = {"base": shard_set, "movies": movies, "shards": shards}
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+
+    keep = {shard_set}
+    keep_segments = set()
+    if previous_manifest is not None:
+        keep.update(shard_set_of(shard["key"]) for shard in previous_manifest["shards"])
+        keep_segments.update(segment["key"] for segment in previous_manifest.get("segments", []))
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=SNAPSHOT_SHARD_PREFIX):
+        for item in page.get('Contents', []):
+            if shard_set_of(item['Key']) not in keep:
+                s3.delete_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=item['Key'])
+    # the new manifest lists no segments, the merged ones are kept while the previous manifest may be loading
+    for page in paginator.paginate(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=SNAPSHOT_SEGMENT_PREFIX):
+        for item in page.get('Contents', []):
+            if item['Key'] not in keep_segments:
+                s3.delete_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=item['Key'])
+
+
+def new_object_id() -> str:
+    """
+    Unique, increasing id of objects written by a run (shard sets, segments)
+    """
+    return str(int(datetime.datetime.now().timestamp() * 1000000))
+
+
+def merge_entries(entries: List[Tuple[str, Dict]]) -> List[Dict]:
+    """
+    Movies of the inbox entries merged as by update_main_db, one per title and year
+    """
+    delta: List[Dict] = []
+    update_main_db(delta, entries)
+    return delta
+
+
+def write_delta_segment(delta: List[Dict], manifest: Dict, s3=None) -> Dict:
+    """
+    Write the merged movies of inbox entries (see merge_entries) as an immutable delta segment,
+    then publish the manifest listing it after the existing segments.
+    Readers apply the segments in order over the shards, the last writer of a title/year wins.
+    Only the entries are read and written, the cost does not depend on the size of the db.
+    Returns the published manifest (the given one if there are no movies to write)
+    """
+    if s3 is None:
+        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+
+    if not delta:
+        return manifest
+
+    key = f"{SNAPSHOT_SEGMENT_PREFIX}{new_object_id()}.json"
+    s3.put_object(Body=json.dumps(delta).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=key)
+    return append_segments(manifest, [{"key": key, "format": "json", "movies": len(delta)}], s3)
+
+
+def append_segments(manifest: Dict, segments: List[Dict], s3) -> Dict:
+    """
+    Publish the manifest with the written segments listed after the existing ones, returns the published manifest
+    """
+    manifest = {**manifest, "segments": manifest.get("segments", []) + segments}
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+    return manifest
+
+
+def needs_compaction(manifest: Dict) -> bool:
+    segments = manifest.get("segments", [])
+    return len(segments) >= COMPACTION_MAX_SEGMENTS or sum(_["movies"] for _ in segments) > COMPACTION_MAX_SEGMENT_RATIO * manifest["movies"]
+
+
+def compact_segments(manifest: Dict, s3=None):
+    """
+    Merge the delta segments of the manifest into the main db and write it as the new base (see write_main_db),
+    the published manifest lists no segments
+    """
+    if s3 is None:
+        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+
+    db = read_main_db(s3)
+    for segment in manifest.get("segments", []):
+        items = json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=segment["key"])['Body'].read())
+        update_main_db(db, [(segment["key"], items)])
+    write_main_db(db, s3)
+
+
+def changelog_key(version: int) -> str:
+    # zero padded, so keys are listed in the version order
+    return f"{CHANGELOG_PREFIX}{version:012d}.json"
+
+
+def read_changelog_versions(s3) -> List[int]:
+    paginator = s3.get_paginator("list_objects_v2")
+    return [int(item['Key'][len(CHANGELOG_PREFIX):].split(".", 1)[0])
+            for page in paginator.paginate(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=CHANGELOG_PREFIX) for item in page.get('Contents', [])]
+
+
+def write_changelog_entry(upserts: Optional[List[Dict]], s3=None, segment: Optional[str] = None) -> int:
+    """
+    Publish the movies changed by a run as the next version of the change log, after the changed data has been written.
+    API servers poll the log and apply the upserts in place instead of reloading the snapshot.
+    The key of the delta segment holding the upserts (if the run wrote one) is published with them,
+    API servers applying them do not reload the manifest listing it.
+    Runs changing more than CHANGELOG_MAX_UPSERTS movies (or None, if the changes are not known) are published
+    as a reload entry without upserts. Only the last CHANGELOG_RETENTION versions are kept.
+    Returns the published version
+    """
+    if s3 is None:
+        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+
+    versions = read_changelog_versions(s3)
+    version = max(versions, default=0) + 1
+    if upserts is None or len(upserts) > CHANGELOG_MAX_UPSERTS:
+        entry = {"version": version, "reload": True}
+    else:
+        entry = {"version": version, "upserts": upserts}
+        if segment is not None:
+            entry["segment"] = segment
+    s3.put_object(Body=json.dumps(entry).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=changelog_key(version))
+
+    for old_version in versions:
+        if old_version <= version - CHANGELOG_RETENTION:
+            s3.delete_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=changelog_key(old_version))
+    return version
+
+
+def archive_inbox_entries(keys: List[str], s3=None):
+    """
+    Archive inbox entries to archive bucket - each object is copied server-side under the run id prefix,
+    then the keys are deleted from the inbox in batches of ARCHIVE_DELETE_BATCH_SIZE once all their copies succeeded.
+    Copies and deletes of different batches run concurrently. Both are idempotent, so failed calls are retried by the client
+    and keys reported as failed by a batch delete are retried with a backoff.
+
+    :raises Exception: if an object could not be archived or deleted, keys of the batch are kept in the inbox then
+    """
+    if s3 is None:
+        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL,
+                          config=Config(max_pool_connections=ARCHIVE_WORKERS, retries={"max_attempts": ARCHIVE_MAX_ATTEMPTS, "mode": "standard"}))
+
+    start_time = time.perf_counter()
+    run_id = new_object_id()
+
+    def copy(key: str):
+        s3.copy_object(CopySource={"Bucket": AWS_INBOX_BUCKET_NAME, "Key": key}, Bucket=AWS_ARCHIVE_BUCKET_NAME, Key=run_id + key)
+
+    def delete(batch: List[str]):
+        for attempt in range(ARCHIVE_MAX_ATTEMPTS):
+            resp = s3.delete_objects(Bucket=AWS_INBOX_BUCKET_NAME, Delete={"Objects": [{"Key": _} for _ in batch], "Quiet": True})
+            errors = resp.get('Errors', [])
+            if not errors:
+                return
+            batch = [_['Key'] for _ in errors]
+            time.sleep(0.1 * 2 ** attempt)
+        raise Exception(f"Can't delete {len(batch)} inbox entries, e.g. {batch[0]}: {errors[0].get('Message')}")
+
+    batches = [keys[start:start + ARCHIVE_DELETE_BATCH_SIZE] for start in range(0, len(keys), ARCHIVE_DELETE_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) as executor:
+        copies = [[executor.submit(copy, key) for key in batch] for batch in batches]
+        deletes = []
+        for batch, batch_copies in zip(batches, copies):
+            for future in batch_copies:
+                future.result()
+            deletes.append(executor.submit(delete, batch))
+        for future in deletes:
+            future.result()
+
+    logging.info("Archived %s inbox entries in %.2fs", len(keys), time.perf_counter() - start_time)
@@ -0,0 +1,93 @@
+"""
+Binary movie snapshot for fast API server startup.
+Keep the layout in sync with py_movie_db movies/snapshot.py.
+
+All numbers are little-endian.
+Header (32 bytes):
+- magic b"MOVIEDB\\0"
+- format version (uint32)
+- number of movies (uint32)
+- payload length (uint64)
+- CRC32 of the payload (uint32), reserved (uint32)
+Payload is a sequence of sections, each prefixed with its length (uint64) and padded to 8 bytes:
+- titles: string table
+- years: uint16 array (movies with other years are rejected when the inbox is parsed, see indexer.service.is_valid_movie)
+- cast names: string table
+- cast offsets: uint32 array (number of movies + 1), cast ids: uint32 array
+- genre names: string table
+- genre offsets: uint32 array (number of movies + 1), genre ids: uint32 array
+String table is the number of strings n (uint32), offsets of the strings in code points (uint32 array of n + 1)
+and the utf-8 encoded strings concatenated, so strings may contain any character (format version 1 joined them with NUL).
+Cast and genre ids of the movie i are ids[offsets[i]:offsets[i+1]].
+"""
+import itertools
+import struct
+import sys
+import zlib
+from array import array
+from typing import Dict, List
+
+MAGIC = b"MOVIEDB\0"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<8sIIQII")
+SECTION_LENGTH = struct.Struct("<Q")
+STRING_COUNT = struct.Struct("<I")
+
+
+def _to_little_endian(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _encode_strings(strings: List[str]) -> bytes:
+    offsets = array('I', [0])
+    offsets.extend(itertools.accumulate(map(len, strings)))
+    return STRING_COUNT.pack(len(strings)) + _to_little_endian(offsets) + "".join(strings).encode("utf-8")
+
+
+class _DictionaryColumn:
+    """
+    Encodes lists of strings (cast, genres) as ids into a shared dictionary in CSR layout
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.offsets = array('I', [0])
+        self.flat = array('I')
+
+    def append(self, values: List[str]):
+        # duplicates within a movie are dropped, the same way as the API server does
+        for value in dict.fromkeys(values):
+            value_id = self.ids.setdefault(value, len(self.ids))
+            self.flat.append(value_id)
+        self.offsets.append(len(self.flat))
+
+    def sections(self) -> List[bytes]:
+        return [_encode_strings(list(self.ids)), _to_little_endian(self.offsets), _to_little_endian(self.flat)]
+
+
+def encode_snapshot(db: List[Dict]) -> bytes:
+    """
+    Encode main db as a binary snapshot
+    """
+    titles = []
+    years = array('H')
+    cast = _DictionaryColumn()
+    genres = _DictionaryColumn()
+    for item in db:
+        titles.append(item["title"])
+        years.append(item["year"])
+        cast.append(item["cast"])
+        genres.append(item["genres"])
+
+    sections = [_encode_strings(titles), _to_little_endian(years), *cast.sections(), *genres.sections()]
+
+    payload = bytearray()
+    for section in sections:
+        payload += SECTION_LENGTH.pack(len(section))
+        payload += section
+        payload += b"\0" * (-len(section) % 8)
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, len(db), len(payload), zlib.crc32(payload), 0) + payload
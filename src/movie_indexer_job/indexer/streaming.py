@@ -0,0 +1,256 @@
+"""
+Streaming ingestion with memory bounded by INGEST_MEMORY_BUDGET_BYTES - inbox files and the json db are parsed item by item
+and merged through a title/year index of at most the budget, the merged movies are written as streams
+(to S3 through temporary files, which are on disk rather than in memory)
+"""
+import json
+import logging
+import resource
+import tempfile
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import boto3
+
+from indexer.config import AWS_ENDPOINT_URL, AWS_INBOX_BUCKET_NAME, AWS_STORAGE_BUCKET_NAME, BINARY_SNAPSHOT_KEY, SNAPSHOT_SEGMENT_PREFIX, \
+    INGEST_MEMORY_BUDGET_BYTES
+from indexer.json_stream import iter_json_array
+from indexer.service import intern_strings, iter_main_db_chunks, list_inbox_objects, movie_key, new_object_id, publish_main_db, read_snapshot_manifest, \
+    valid_movies, write_shards, publish_base_manifest, append_segments, needs_compaction
+
+CHUNK_SIZE = 1024 * 1024
+# estimated memory of an index entry besides the encoded movie and the title: key tuple, year, dict slot
+INDEX_ENTRY_OVERHEAD = 150
+
+
+class MovieIndex:
+    """
+    Movies by title and year, stored json encoded - a fraction of the memory of the parsed dicts.
+    Putting a movie with a known title and year replaces it, keeping its position.
+    """
+
+    def __init__(self):
+        self.movies: Dict[Tuple[str, int], bytes] = {}
+        self.size = 0
+
+    def put(self, movie: Dict):
+        key = movie_key(movie)
+        encoded = json.dumps(movie).encode()
+        previous = self.movies.get(key)
+        self.size += len(encoded) - (len(previous) if previous is not None else -len(key[0]) - INDEX_ENTRY_OVERHEAD)
+        self.movies[key] = encoded
+
+    def pop(self, movie: Dict) -> Optional[bytes]:
+        return self.movies.pop(movie_key(movie), None)
+
+    def __contains__(self, key: Tuple[str, int]) -> bool:
+        return key in self.movies
+
+    def values(self) -> Iterable[bytes]:
+        return self.movies.values()
+
+    def __len__(self):
+        return len(self.movies)
+
+
+def iter_indexes(movies: Iterable[Dict], budget: int) -> Iterator[MovieIndex]:
+    """
+    Put the movies into indexes in order, an index is yielded (and should be released) once its estimated size reaches the budget
+    """
+    index = MovieIndex()
+    for movie in movies:
+        index.put(movie)
+        if index.size >= budget:
+            logging.info("Index of %s movies reached the memory budget (%.0fMB)", len(index), index.size / 2**20)
+            yield index
+            index = MovieIndex()
+    if index:
+        yield index
+
+
+def iter_chunks(f: BinaryIO) -> Iterator[bytes]:
+    return iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+def iter_file_movies(f: BinaryIO) -> Iterator[Dict]:
+    """
+    Movies of a json array file, read from the start
+
+    :raises json.JSONDecodeError: if the file is not a json array
+    """
+    f.seek(0)
+    return iter_json_array(iter_chunks(f), intern_strings)
+
+
+def iter_object_movies(key: str, s3, bucket: str = AWS_STORAGE_BUCKET_NAME) -> Iterator[Dict]:
+    """
+    Movies of a json array object, parsed while it is downloaded
+
+    :raises json.JSONDecodeError: if the object is not a json array
+    """
+    data = s3.get_object(Bucket=bucket, Key=key)
+    return iter_json_array(data['Body'].iter_chunks(CHUNK_SIZE), intern_strings)
+
+
+def write_json_array(f: BinaryIO, encoded_movies: Iterable[bytes]) -> int:
+    """
+    Write json encoded movies as a json array, returns the number of movies
+    """
+    count = 0
+    f.write(b"[")
+    for encoded in encoded_movies:
+        if count:
+            f.write(b", ")
+        f.write(encoded)
+        count += 1
+    f.write(b"]")
+    return count
+
+
+def upload_json_array(key: str, encoded_movies: Iterable[bytes], s3) -> int:
+    """
+    Write json encoded movies as a json array object (through a temporary file), returns the number of movies
+    """
+    with tempfile.TemporaryFile() as f:
+        count = write_json_array(f, encoded_movies)
+        f.seek(0)
+        s3.upload_fileobj(f, AWS_STORAGE_BUCKET_NAME, key)
+    return count
+
+
+def stream_inbox_to_segments(s3, budget: int = INGEST_MEMORY_BUDGET_BYTES) -> Tuple[List[Dict], List[str]]:
+    """
+    Parse inbox files item by item in the order of file timestamps and write the movies as delta segments,
+    a segment is written whenever the index of movies reaches the budget.
+    Each file is downloaded to a temporary file and parsed to the end before any of its movies are applied:
+    files which are not valid json arrays are logged and left in the inbox without adding anything, as in memory mode.
+    Returns the manifest entries of the segments and the keys of the ingested inbox files
+    """
+    ingested: List[str] = []
+
+    def inbox_movies() -> Iterator[Dict]:
+        for obj in list_inbox_objects(s3):
+            with tempfile.TemporaryFile() as f:
+                for chunk in s3.get_object(Bucket=AWS_INBOX_BUCKET_NAME, Key=obj['Key'])['Body'].iter_chunks(CHUNK_SIZE):
+                    f.write(chunk)
+                try:
+                    for _ in iter_file_movies(f):
+                        pass
+                except ValueError as e:
+                    logging.error("Skipping inbox entry %s which is not valid json: %s", obj['Key'], e)
+                    continue
+                yield from valid_movies(iter_file_movies(f), obj['Key'])
+            ingested.append(obj['Key'])
+
+    segments = []
+    for index in iter_indexes(inbox_movies(), budget):
+        key = f"{SNAPSHOT_SEGMENT_PREFIX}{new_object_id()}.json"
+        segments.append({"key": key, "format": "json", "movies": upload_json_array(key, index.values(), s3)})
+    return segments, ingested
+
+
+def merge_pass(base: BinaryIO, index: MovieIndex, f: BinaryIO) -> int:
+    """
+    Write the base movies (a json array file) with the indexed movies applied as by update_main_db to a json array file:
+    the last movie of a title and year is replaced, indexed movies which are not in the base are appended.
+    The base is read twice, the first read counts the movies of the indexed titles and years, so the last one is known.
+    Returns the number of movies
+    """
+    remaining: Dict[Tuple[str, int], int] = {}
+    for movie in iter_file_movies(base):
+        key = movie_key(movie)
+        if key in index:
+            remaining[key] = remaining.get(key, 0) + 1
+
+    def merged() -> Iterator[bytes]:
+        for movie in iter_file_movies(base):
+            key = movie_key(movie)
+            if key in remaining:
+                remaining[key] -= 1
+                if not remaining[key]:
+                    del remaining[key]
+                    yield index.pop(movie)
+                    continue
+            yield json.dumps(movie).encode()
+        yield from index.values()
+
+    return write_json_array(f, merged())
+
+
+def compact_streaming(manifest: Dict, s3=None, budget: int = INGEST_MEMORY_BUDGET_BYTES):
+    """
+    Merge the delta segments of the manifest into the json db and write it as the new base, as compact_segments does
+    with memory bounded by the budget: segments are read into indexes of at most the budget, each index is applied
+    in a pass over a local copy of the json db (the first pass) or the output of the previous pass.
+    The single binary snapshot can't be written without the whole db in memory, a stale one is deleted
+    (API servers read the sharded snapshot).
+    """
+    if s3 is None:
+        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+
+    def segment_movies() -> Iterator[Dict]:
+        for segment in manifest.get("segments", []):
+            yield from iter_object_movies(segment["key"], s3)
+
+    merged: Optional[BinaryIO] = None
+    passes = 0
+    for index in iter_indexes(segment_movies(), budget):
+        if merged is None:
+            # every pass reads its base twice, the json db is downloaded to a temporary file once
+            merged = tempfile.TemporaryFile()
+            for chunk in iter_main_db_chunks(s3):
+                merged.write(chunk)
+        output = tempfile.TemporaryFile()
+        merge_pass(merged, index, output)
+        del index
+        merged.close()
+        merged = output
+        passes += 1
+
+    if merged is None:
+        return
+    logging.info("Segments merged in %s passes", passes)
+
+    with merged:
+        merged.seek(0)
+        movies = 0
+
+        def counted(items: Iterable[Dict]) -> Iterator[Dict]:
+            nonlocal movies
+            for item in items:
+                movies += 1
+                yield item
+
+        shard_set = new_object_id()
+        shards = write_shards(counted(iter_file_movies(merged)), shard_set, s3)
+        merged.seek(0)
+        publish_main_db(merged, s3)
+    s3.delete_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=BINARY_SNAPSHOT_KEY)
+    publish_base_manifest(movies, shards, shard_set, read_snapshot_manifest(s3), s3)
+
+
+def stream_ingest_inbox(s3=None, budget: int = INGEST_MEMORY_BUDGET_BYTES) -> List[str]:
+    """
+    Ingest the inbox as delta segments with memory bounded by the budget, then compact them if needed
+    (always if no snapshot has been published yet). Returns the keys of the ingested inbox files
+    """
+    if s3 is None:
+        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+
+    segments, ingested = stream_inbox_to_segments(s3, budget)
+    logging.info("%s inbox entries written as %s segments", len(ingested), len(segments))
+    manifest = read_snapshot_manifest(s3)
+    if manifest is None:
+        compact_streaming({"movies": 0, "shards": [], "segments": segments}, s3, budget)
+    elif segments:
+        manifest = append_segments(manifest, segments, s3)
+        if needs_compaction(manifest):
+            logging.info("Compacting %s segments...", len(manifest["segments"]))
+            compact_streaming(manifest, s3, budget)
+    return ingested
+
+
+def peak_memory_bytes() -> int:
+    """
+    Peak resident memory of the process (Linux reports kilobytes)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -1,7 +1,10 @@
 import logging
+import sys
 
 from indexer.lock import IngestionLock
+from indexer.config import INGEST_MODE
 import indexer.service as svc
+import indexer.streaming as streaming
 
 
 def ingest_inbox():
@@ -9,7 +12,10 @@ def ingest_inbox():
     Ingest new movies from inbox:
     - Place lock
     - Read inbox S3 in the order of file timestamps
-    - Create/update movies in main movie json data file based on movie title/year
+    - Write the new/updated movies as a delta segment of the published snapshot, based on movie title/year
+      (or create/update movies in main movie json data file if no snapshot has been published yet)
+    - Publish the changed movies as the next version of the change log
+    - Compact segments into a new main db once there are too many of them
     - Release lock
     """
 
@@ -20,24 +26,80 @@ def ingest_inbox():
         entries = svc.read_inbox_entries()
         logging.info("%s entries found", len(entries))
 
-        # read main movie db
-        logging.info("Loading main db...")
-        db = svc.read_main_db()
+        manifest = svc.read_snapshot_manifest()
+        if manifest is None:
+            # read main movie db
+            logging.info("Loading main db...")
+            db = svc.read_main_db()
 
-        # read each file and create/update movie in the main db
-        logging.info("Updating main db...")
-        svc.update_main_db(db, entries)
+            # read each file and create/update movie in the main db
+            logging.info("Updating main db...")
+            upserts = svc.update_main_db(db, entries)
 
-        # write main movie db
-        logging.info("Saving main db...")
-        svc.write_main_db(db)
+            # write main movie db
+            logging.info("Saving main db...")
+            svc.write_main_db(db)
+        else:
+            logging.info("Writing delta segment...")
+            upserts = svc.merge_entries(entries)
+            manifest = svc.write_delta_segment(upserts, manifest)
 
-        # archive inbox entries
-        svc.archive_inbox_entries(entries)
+        if upserts:
+            segment = manifest["segments"][-1]["key"] if manifest is not None else None
+            logging.info("Publishing %s changed movies as change log version %s", len(upserts), svc.write_changelog_entry(upserts, segment=segment))
+        if manifest is not None and svc.needs_compaction(manifest):
+            compact(manifest)
+
+        # archive inbox entries, the parsed movies are not needed anymore
+        keys = [key for key, _ in entries]
+        del entries
+        svc.archive_inbox_entries(keys)
+
+
+def ingest_inbox_streaming():
+    """
+    Ingest new movies from inbox with memory bounded by INGEST_MEMORY_BUDGET_BYTES:
+    - Place lock
+    - Parse inbox files item by item in the order of file timestamps, writing the movies as delta segments
+    - Compact segments into a new main db once there are too many of them (or if no snapshot has been published yet)
+    - Publish a reload entry of the change log
+    - Archive the ingested inbox files
+    - Release lock
+    """
+    with IngestionLock():
+        logging.info("Streaming inbox entries...")
+        keys = streaming.stream_ingest_inbox()
+        if keys:
+            # changed movies are not known without the db, API servers reload the snapshot
+            svc.write_changelog_entry(None)
+        svc.archive_inbox_entries(keys)
+
+
+def compact(manifest=None):
+    """
+    Merge delta segments into a new main db
+    """
+    if manifest is None:
+        manifest = svc.read_snapshot_manifest()
+    if manifest is None or not manifest.get("segments"):
+        logging.info("No segments to compact")
+        return
+    logging.info("Compacting %s segments...", len(manifest["segments"]))
+    if INGEST_MODE == "streaming":
+        streaming.compact_streaming(manifest)
+    else:
+        svc.compact_segments(manifest)
 
 
 def main():
-    ingest_inbox()
+    if sys.argv[1:] == ["compact"]:
+        with IngestionLock():
+            compact()
+    elif INGEST_MODE == "streaming":
+        ingest_inbox_streaming()
+    else:
+        ingest_inbox()
+    logging.info("Peak memory %.0fMB", streaming.peak_memory_bytes() / 2**20)
 
 
 if __name__ == "__main__":
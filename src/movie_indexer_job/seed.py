@@ -7,6 +7,7 @@ import boto3
 from botocore.exceptions import ClientError
 
 from indexer.config import AWS_ENDPOINT_URL, AWS_REGION, AWS_INBOX_BUCKET_NAME, AWS_ARCHIVE_BUCKET_NAME, AWS_STORAGE_BUCKET_NAME
+from indexer.service import publish_main_db
 
 
 def create_buckets():
@@ -33,7 +34,8 @@ def seed_inbox():
 
 def seed_db():
     client = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
-    client.upload_file('data/seed_data.json', AWS_STORAGE_BUCKET_NAME, 'db.json')
+    with open('data/seed_data.json', 'rb') as f:
+        publish_main_db(f, client)
 
 
 def main():
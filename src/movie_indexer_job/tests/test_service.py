@@ -1,10 +1,17 @@
 import json
 import os
+import zlib
+from typing import Dict
+
 import boto3
+import pytest
 from moto import mock_s3
 
-from indexer.config import AWS_REGION, AWS_INBOX_BUCKET_NAME, AWS_STORAGE_BUCKET_NAME, AWS_ARCHIVE_BUCKET_NAME
+from indexer.config import AWS_REGION, AWS_INBOX_BUCKET_NAME, AWS_STORAGE_BUCKET_NAME, AWS_ARCHIVE_BUCKET_NAME, BINARY_SNAPSHOT_KEY, \
+    CHANGELOG_PREFIX, MAIN_DB_POINTER_KEY, MAIN_DB_PREFIX, SNAPSHOT_MANIFEST_KEY, SNAPSHOT_SEGMENT_PREFIX, SNAPSHOT_SHARD_PREFIX
+from indexer.snapshot import FORMAT_VERSION, HEADER, MAGIC, encode_snapshot
 import indexer.service as svc
+import indexer.streaming as streaming
 
 
 def get_s3_client():
@@ -164,6 +171,38 @@ def test_can_write_main_db():
     assert json.dumps(db, sort_keys=True) == json.dumps(newdb, sort_keys=True)
 
 
+@mock_s3
+def test_main_db_is_published_behind_a_pointer():
+    s3 = get_s3_client()
+
+    create_main_db(s3)
+    db = svc.read_main_db(s3)
+    svc.write_main_db(db, s3)
+    first = svc.read_main_db_pointer(s3)
+    # a stray object in the bucket is not picked up by readers
+    s3.put_object(Body=b"[]", Bucket=AWS_STORAGE_BUCKET_NAME, Key="db.json")
+
+    svc.write_main_db(db[:2], s3)
+    second = svc.read_main_db_pointer(s3)
+    svc.write_main_db(db[:1], s3)
+    third = svc.read_main_db_pointer(s3)
+
+    assert [first["version"], second["version"], third["version"]] == [1, 2, 3]
+    assert third["key"] == f"{MAIN_DB_PREFIX}{third['checksum']}.json.gz"
+    data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=third["key"])['Body'].read()
+    assert len(data) == third["size"]
+    assert json.loads(zlib.decompress(data, zlib.MAX_WBITS | 16)) == db[:1]
+    assert svc.read_main_db(s3) == db[:1]
+    # the db of the replaced pointer is kept, older ones are deleted
+    keys = [_['Key'] for _ in s3.list_objects(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=MAIN_DB_PREFIX)['Contents']]
+    assert sorted(keys) == sorted([second["key"], third["key"]])
+
+    # the object is verified against the pointer
+    s3.put_object(Body=json.dumps({**third, "size": third["size"] + 1}).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=MAIN_DB_POINTER_KEY)
+    with pytest.raises(ValueError):
+        svc.read_main_db(s3)
+
+
 @mock_s3
 def test_can_update_main_db():
     s3 = get_s3_client()
@@ -195,10 +234,324 @@ def test_can_archive_inbox_entries():
 
     entries = svc.read_inbox_entries(s3)
 
-    svc.archive_inbox_entries(entries, s3)
+    svc.archive_inbox_entries([key for key, _ in entries], s3)
 
     archive_entries = s3.list_objects_v2(Bucket=AWS_ARCHIVE_BUCKET_NAME)['Contents']
     assert len(archive_entries) == 2
+    archived = s3.get_object(Bucket=AWS_ARCHIVE_BUCKET_NAME, Key=archive_entries[0]['Key'])['Body'].read()
+    assert json.loads(archived) == entries[0][1]
 
     new_entries = svc.read_inbox_entries(s3)
     assert len(new_entries) == 0
+
+
+@mock_s3
+def test_archive_retries_failed_deletes(monkeypatch):
+    s3 = get_s3_client()
+    monkeypatch.setattr(svc, "ARCHIVE_DELETE_BATCH_SIZE", 1)
+    monkeypatch.setattr(svc.time, "sleep", lambda _: None)
+    create_inbox_entries(s3)
+
+    delete_objects = s3.delete_objects
+    calls = []
+
+    def flaky_delete_objects(**kwargs):
+        keys = [_["Key"] for _ in kwargs["Delete"]["Objects"]]
+        calls.append(keys)
+        if calls.count(["dummy1"]) == 1 and keys == ["dummy1"]:
+            return {"Errors": [{"Key": "dummy1", "Code": "InternalError", "Message": "try again"}]}
+        return delete_objects(**kwargs)
+
+    monkeypatch.setattr(s3, "delete_objects", flaky_delete_objects)
+    svc.archive_inbox_entries(["dummy1", "dummy2"], s3)
+
+    assert sorted(calls) == [["dummy1"], ["dummy1"], ["dummy2"]]
+    assert "Contents" not in s3.list_objects_v2(Bucket=AWS_INBOX_BUCKET_NAME)
+    assert len(s3.list_objects_v2(Bucket=AWS_ARCHIVE_BUCKET_NAME)['Contents']) == 2
+
+
+@mock_s3
+def test_can_write_binary_snapshot():
+    s3 = get_s3_client()
+
+    create_main_db(s3)
+
+    db = svc.read_main_db(s3)
+    svc.write_main_db(db, s3)
+
+    snapshot = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=BINARY_SNAPSHOT_KEY)['Body'].read()
+    magic, version, count, payload_length, checksum, _ = HEADER.unpack_from(snapshot)
+
+    assert magic == MAGIC
+    assert count == 3
+    assert payload_length == len(snapshot) - HEADER.size
+    assert checksum == zlib.crc32(snapshot[HEADER.size:])
+
+    # binary snapshot is not picked up as the json db
+    assert len(svc.read_main_db(s3)) == 3
+
+
+@pytest.mark.parametrize("budget", [1, 2**20])
+@mock_s3
+def test_both_modes_ingest_any_string_and_skip_invalid_movies(budget):
+    s3 = get_s3_client()
+    create_main_db(s3)
+    svc.write_main_db(svc.read_main_db(s3), s3)
+    nul_movie = {"title": "Nul\0Title", "year": 2018, "cast": ["A\0B"], "genres": ["Drama"]}
+    s3.put_object(Body=json.dumps([
+        nul_movie,
+        {"title": "Far Future", "year": 70000, "cast": [], "genres": []},
+        {"title": "No Year", "cast": [], "genres": []},
+        {"title": "Bad Cast", "year": 2018, "cast": [1], "genres": []},
+        "not a movie",
+    ]).encode(), Bucket=AWS_INBOX_BUCKET_NAME, Key="dummy1")
+    expected = svc.read_main_db(s3) + [nul_movie]
+
+    db = svc.read_main_db(s3)
+    entries = svc.read_inbox_entries(s3)
+    svc.update_main_db(db, entries)
+    assert db == expected
+    svc.write_main_db(db, s3)
+    snapshot = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=BINARY_SNAPSHOT_KEY)['Body'].read()
+    _, version, count, _, _, _ = HEADER.unpack_from(snapshot)
+    assert (version, count) == (FORMAT_VERSION, len(expected))
+    assert svc.read_snapshot_manifest(s3)["movies"] == len(expected)
+
+    # the next run starts from the published db and the inbox entry is ingested again by streaming
+    assert streaming.stream_ingest_inbox(s3, budget) == ["dummy1"]
+    streaming.compact_streaming(svc.read_snapshot_manifest(s3), s3, budget)
+    assert svc.read_main_db(s3) == expected
+    assert svc.read_snapshot_manifest(s3)["movies"] == len(expected)
+
+
+@mock_s3
+def test_can_write_sharded_snapshot(monkeypatch):
+    s3 = get_s3_client()
+    monkeypatch.setattr(svc, "SNAPSHOT_SHARD_SIZE", 2)
+
+    create_main_db(s3)
+    db = svc.read_main_db(s3)
+
+    shard_sets = []
+    for _ in range(3):
+        svc.write_main_db(db, s3)
+        manifest = json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)['Body'].read())
+        shard_sets.append(svc.shard_set_of(manifest["shards"][0]["key"]))
+
+    assert manifest["movies"] == 3
+    assert [shard["movies"] for shard in manifest["shards"]] == [2, 1]
+    for shard in manifest["shards"]:
+        body = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=shard["key"])['Body'].read()
+        assert (shard["encoding"], shard["size"]) == ("gzip", len(body))
+        snapshot = zlib.decompress(body, zlib.MAX_WBITS | 16)
+        assert HEADER.unpack_from(snapshot)[2] == shard["movies"]
+
+    # shards of the current and the previous manifest are kept
+    keys = [_['Key'] for _ in s3.list_objects_v2(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=SNAPSHOT_SHARD_PREFIX)['Contents']]
+    assert sorted({svc.shard_set_of(_) for _ in keys}) == sorted(set(shard_sets[1:]))
+
+    # shards and the manifest are not picked up as the json db
+    assert len(svc.read_main_db(s3)) == 3
+
+
+@mock_s3
+def test_read_inbox_entries_follows_listing_pages():
+    s3 = get_s3_client()
+    for number in range(1005):
+        s3.put_object(Body=json.dumps([{"title": f"Movie {number}", "year": 2000, "cast": [], "genres": []}]).encode(),
+                      Bucket=AWS_INBOX_BUCKET_NAME, Key=f"entry{number:05d}")
+    s3.put_object(Body=b"not json", Bucket=AWS_INBOX_BUCKET_NAME, Key="invalid")
+
+    entries = svc.read_inbox_entries(s3)
+
+    # invalid file is skipped, order is kept by timestamp and key
+    assert len(entries) == 1005
+    assert [_[0] for _ in entries] == sorted(_[0] for _ in entries)
+    assert entries[-1][1][0]["title"] == "Movie 1004"
+
+
+@mock_s3
+def test_read_inbox_entries_decodes_large_files_in_processes(monkeypatch):
+    s3 = get_s3_client()
+    monkeypatch.setattr(svc, "INBOX_PROCESS_DECODE_MIN_BYTES", 100)
+    monkeypatch.setattr(svc, "INBOX_DECODE_PROCESSES", 2)
+    create_inbox_entries(s3)
+    s3.put_object(Body=b"[]", Bucket=AWS_INBOX_BUCKET_NAME, Key="dummy3")
+    s3.put_object(Body=b"[" + b" " * 100 + b"{]", Bucket=AWS_INBOX_BUCKET_NAME, Key="dummy4")
+
+    entries = svc.read_inbox_entries(s3)
+
+    assert [_[0] for _ in entries] == ["dummy1", "dummy2", "dummy3"]
+    assert entries[1][1][0]["cast"][0] == "Bex Taylor-Klaus"
+    assert entries[2][1] == []
+
+
+@mock_s3
+def test_ingest_writes_delta_segments_and_compacts(monkeypatch):
+    s3 = get_s3_client()
+    monkeypatch.setattr(svc, "COMPACTION_MAX_SEGMENTS", 3)
+    monkeypatch.setattr(svc, "COMPACTION_MAX_SEGMENT_RATIO", 10)
+
+    create_main_db(s3)
+    svc.write_main_db(svc.read_main_db(s3), s3)
+    main_pointer = svc.read_main_db_pointer(s3)
+    manifest = svc.read_snapshot_manifest(s3)
+
+    create_inbox_entries(s3)
+    entries = svc.read_inbox_entries(s3)
+    manifest = svc.write_delta_segment(svc.merge_entries(entries), manifest, s3)
+    manifest = svc.write_delta_segment([{"title": "Hell Fest", "year": 2018, "cast": [], "genres": ["Comedy"]}], manifest, s3)
+    assert svc.write_delta_segment([], manifest, s3) is manifest
+
+    # the main db is not rewritten, segments are listed in order after the shards
+    assert svc.read_main_db_pointer(s3) == main_pointer
+    assert svc.read_snapshot_manifest(s3) == manifest
+    assert [_["movies"] for _ in manifest["segments"]] == [2, 1]
+    segment = json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=manifest["segments"][0]["key"])['Body'].read())
+    assert [_["title"] for _ in segment] == ["The Old Man & the Gun", "Hell Fest"]
+    assert not svc.needs_compaction(manifest)
+
+    manifest = svc.write_delta_segment([{"title": "Venom", "year": 2018, "cast": [], "genres": []}], manifest, s3)
+    assert svc.needs_compaction(manifest)
+    segment_keys = [_["key"] for _ in manifest["segments"]]
+
+    svc.compact_segments(manifest, s3)
+
+    db = svc.read_main_db(s3)
+    assert len(db) == 4
+    assert [_ for _ in db if _["title"] == "Hell Fest"][0]["genres"] == ["Comedy"]
+    assert [_ for _ in db if _["title"] == "Venom"][0]["cast"] == []
+    compacted = svc.read_snapshot_manifest(s3)
+    assert compacted["movies"] == 4 and "segments" not in compacted
+
+    # merged segments are deleted by the next compaction, once the manifest listing them is replaced
+    def stored_segments():
+        return [_['Key'] for _ in s3.list_objects_v2(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=SNAPSHOT_SEGMENT_PREFIX).get('Contents', [])]
+    assert stored_segments() == segment_keys
+    svc.compact_segments(compacted, s3)
+    assert stored_segments() == []
+
+
+@mock_s3
+def test_update_main_db_returns_changed_movies():
+    s3 = get_s3_client()
+
+    create_main_db(s3)
+    db = svc.read_main_db(s3)
+    unchanged = dict(db[1])
+
+    changed = svc.update_main_db(db, [
+        ("dummy1", [unchanged, {"title": "Venom", "year": 2018, "cast": [], "genres": []}]),
+        ("dummy2", [{"title": "Dunkirk", "year": 2017, "cast": [], "genres": []}, {"title": "Venom", "year": 2018, "cast": [], "genres": ["Comedy"]}]),
+    ])
+
+    # in the order of the first change, in the final state
+    assert [(_["title"], _["genres"]) for _ in changed] == [("Venom", ["Comedy"]), ("Dunkirk", [])]
+    assert changed[0] is db[2]
+
+
+@mock_s3
+def test_can_write_changelog_entries(monkeypatch):
+    s3 = get_s3_client()
+    monkeypatch.setattr(svc, "CHANGELOG_MAX_UPSERTS", 2)
+    monkeypatch.setattr(svc, "CHANGELOG_RETENTION", 2)
+
+    def read_entry(version):
+        return json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=svc.changelog_key(version))['Body'].read())
+
+    upserts = [{"title": "Venom", "year": 2018, "cast": [], "genres": []}]
+    assert svc.write_changelog_entry(upserts, s3, segment="main.segments/1.json") == 1
+    assert read_entry(1) == {"version": 1, "upserts": upserts, "segment": "main.segments/1.json"}
+    assert svc.write_changelog_entry(upserts * 3, s3) == 2
+    assert svc.write_changelog_entry(None, s3) == 3
+
+    # too many upserts or unknown changes make a reload entry, only the last versions are kept
+    assert read_entry(2) == {"version": 2, "reload": True}
+    assert read_entry(3) == {"version": 3, "reload": True}
+    assert svc.read_changelog_versions(s3) == [2, 3]
+    assert svc.changelog_key(3) == CHANGELOG_PREFIX + "000000000003.json"
+
+    # the change log is not mistaken for the json db
+    create_main_db(s3)
+    assert len(svc.read_main_db(s3)) == 3
+
+
+def test_update_main_db_keys_do_not_collide():
+    db = [{"title": "A1", "year": 999, "cast": [], "genres": []}]
+
+    svc.update_main_db(db, [("dummy1", [{"title": "A", "year": 1999, "cast": [], "genres": []}])])
+
+    assert [(_["title"], _["year"]) for _ in db] == [("A1", 999), ("A", 1999)]
+
+
+@mock_s3
+def test_streaming_ingest_matches_memory_mode(monkeypatch):
+    s3 = get_s3_client()
+    monkeypatch.setattr(svc, "COMPACTION_MAX_SEGMENTS", 2)
+
+    create_main_db(s3)
+    svc.write_main_db(svc.read_main_db(s3), s3)
+    create_inbox_entries(s3)
+    s3.put_object(Body=b'[{"title": "Venom", "year": 2018, "cast": [], "genres": ["Comedy"]}, {"title": "A", "year": 1999, "cast": [], "genres": []}]',
+                  Bucket=AWS_INBOX_BUCKET_NAME, Key="dummy3")
+    s3.put_object(Body=b'[{"title": "A1", "year": 999, "cast": [], "genres": []}]', Bucket=AWS_INBOX_BUCKET_NAME, Key="dummy4")
+    s3.put_object(Body=b'[{"title": "Truncated", "year"', Bucket=AWS_INBOX_BUCKET_NAME, Key="invalid")
+
+    expected = svc.read_main_db(s3)
+    svc.update_main_db(expected, svc.read_inbox_entries(s3))
+
+    # a budget below one movie writes a segment per movie and compacts them in a pass per movie
+    keys = streaming.stream_ingest_inbox(s3, budget=1)
+
+    assert sorted(keys) == ["dummy1", "dummy2", "dummy3", "dummy4"]
+    assert svc.read_main_db(s3) == expected
+    manifest = svc.read_snapshot_manifest(s3)
+    assert manifest["movies"] == 6 and "segments" not in manifest
+    assert "Contents" not in s3.list_objects_v2(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=BINARY_SNAPSHOT_KEY)
+
+
+@pytest.mark.parametrize("budget", [1, 2**20])
+@mock_s3
+def test_both_modes_apply_the_last_version_of_a_movie(budget):
+    s3 = get_s3_client()
+
+    def movie(title: str, genre: str) -> Dict:
+        return {"title": title, "year": 2018, "cast": [], "genres": [genre]}
+
+    # of duplicates in the db, the last one is updated
+    s3.put_object(Body=json.dumps([movie("Venom", "Drama"), movie("Hell Fest", "Horror"), movie("Venom", "Thriller")]).encode(),
+                  Bucket=AWS_STORAGE_BUCKET_NAME, Key="main")
+    svc.write_main_db(svc.read_main_db(s3), s3)
+    # two versions of the same movies in one batch, the last one wins
+    s3.put_object(Body=json.dumps([movie("Venom", "Comedy"), movie("Mandy", "Horror"), movie("Venom", "Action"), movie("Mandy", "Action")]).encode(),
+                  Bucket=AWS_INBOX_BUCKET_NAME, Key="dummy1")
+    # an invalid file adds nothing, even the movies before the error
+    s3.put_object(Body=b'[{"title": "Partial", "year": 2001, "cast": [], "genres": []}, {"title": "Trunc', Bucket=AWS_INBOX_BUCKET_NAME, Key="invalid")
+    expected = [movie("Venom", "Drama"), movie("Hell Fest", "Horror"), movie("Venom", "Action"), movie("Mandy", "Action")]
+
+    db = svc.read_main_db(s3)
+    entries = svc.read_inbox_entries(s3)
+    assert [key for key, _ in entries] == ["dummy1"]
+    svc.update_main_db(db, entries)
+    assert db == expected
+
+    assert streaming.stream_ingest_inbox(s3, budget) == ["dummy1"]
+    streaming.compact_streaming(svc.read_snapshot_manifest(s3), s3, budget)
+    assert svc.read_main_db(s3) == expected
+
+
+@mock_s3
+def test_streaming_ingest_without_snapshot_writes_base(monkeypatch):
+    s3 = get_s3_client()
+    monkeypatch.setattr(streaming, "CHUNK_SIZE", 16)
+
+    create_main_db(s3)
+    create_inbox_entries(s3)
+    expected = svc.read_main_db(s3)
+    svc.update_main_db(expected, svc.read_inbox_entries(s3))
+
+    streaming.stream_ingest_inbox(s3)
+
+    assert svc.read_main_db(s3) == expected
+    assert svc.read_snapshot_manifest(s3)["movies"] == 4
+    assert "Contents" not in s3.list_objects_v2(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=SNAPSHOT_SEGMENT_PREFIX)
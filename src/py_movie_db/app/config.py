@@ -1,3 +1,4 @@
+import os
 from os import environ
 
 AWS_ENDPOINT_URL = (
@@ -7,3 +8,61 @@ AWS_REGION = environ.get("AWS_DEFAULT_REGION")
 AWS_INBOX_BUCKET_NAME = environ.get("AWS_INBOX_BUCKET_NAME")
 AWS_STORAGE_BUCKET_NAME = environ.get("AWS_STORAGE_BUCKET_NAME")
 AWS_ARCHIVE_BUCKET_NAME = environ.get("AWS_ARCHIVE_BUCKET_NAME")
+# the json db is published as a content-addressed compressed object named by the pointer (version, key, size, checksum)
+MAIN_DB_POINTER_KEY = environ.get("MAIN_DB_POINTER_KEY", "main.pointer")
+MAIN_DB_PREFIX = environ.get("MAIN_DB_PREFIX", "main.db/")
+# binary snapshot published by the indexer next to the json db, preferred if present
+BINARY_SNAPSHOT_KEY = environ.get("BINARY_SNAPSHOT_KEY", "main.snapshot")
+# manifest of the snapshot split into shards, preferred over the single object snapshots
+SNAPSHOT_MANIFEST_KEY = environ.get("SNAPSHOT_MANIFEST_KEY", "main.manifest")
+SNAPSHOT_SHARD_PREFIX = environ.get("SNAPSHOT_SHARD_PREFIX", "main.shards/")
+# delta segments listed in the manifest, applied over the shards in order
+SNAPSHOT_SEGMENT_PREFIX = environ.get("SNAPSHOT_SEGMENT_PREFIX", "main.segments/")
+# change log of movies upserted by indexer runs (main.changes/<version>.json), polled every CHANGELOG_POLL_INTERVAL_SECONDS
+# and applied in place, 0 disables polling
+CHANGELOG_PREFIX = environ.get("CHANGELOG_PREFIX", "main.changes/")
+CHANGELOG_POLL_INTERVAL_SECONDS = float(environ.get("CHANGELOG_POLL_INTERVAL_SECONDS", "5"))
+# movies of an entry applied on the event loop at a time, between requests (~5ms for 100 movies of 300k)
+CHANGELOG_APPLY_CHUNK_SIZE = int(environ.get("CHANGELOG_APPLY_CHUNK_SIZE", "100"))
+# number of snapshot shards fetched and decoded concurrently (and of pooled S3 connections)
+SNAPSHOT_LOAD_WORKERS = int(environ.get("SNAPSHOT_LOAD_WORKERS", "8"))
+
+# search engine serving queries and optional candidate engine compared on a sample of queries in shadow mode
+SEARCH_ENGINE = environ.get("SEARCH_ENGINE", "planner")
+SHADOW_SEARCH_ENGINE = environ.get("SHADOW_SEARCH_ENGINE", "")
+SHADOW_SAMPLE_RATE = float(environ.get("SHADOW_SAMPLE_RATE", "0.01"))
+
+# whole-query result cache memory budget and entry time to live
+RESULT_CACHE_MAX_BYTES = int(environ.get("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL_SECONDS = float(environ.get("RESULT_CACHE_TTL_SECONDS", "3600"))
+# memory budget of the cache of encoded (and compressed) response bodies, same TTL as the result cache
+RESPONSE_CACHE_MAX_BYTES = int(environ.get("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# number of recently returned movies kept json encoded for assembling response bodies (~0.3KB each), 0 encodes every time
+JSON_FRAGMENT_CACHE_SIZE = int(environ.get("JSON_FRAGMENT_CACHE_SIZE", "50000"))
+
+# poll storage bucket for a new data snapshot every N seconds, 0 disables reloading
+RELOAD_INTERVAL_SECONDS = float(environ.get("RELOAD_INTERVAL_SECONDS", "60"))
+
+# number of workers forked by the pre-fork server (app/prefork.py)
+PREFORK_WORKERS = int(environ.get("PREFORK_WORKERS", str(os.cpu_count() or 1)))
+
+# maximum number of queries in one batch search request
+MAX_BATCH_SIZE = int(environ.get("MAX_BATCH_SIZE", "100"))
+
+# maximum number of top cast members returned by the facets endpoint
+MAX_FACET_TOP_K = int(environ.get("MAX_FACET_TOP_K", "100"))
+
+# top cast of filtered facet queries: counted over the matching movies for up to FACET_CAST_SCAN_LIMIT of them,
+# otherwise with bitsets of the FACET_CAST_BITSETS cast members with the most movies (number of movies / 8 bytes each)
+FACET_CAST_SCAN_LIMIT = int(environ.get("FACET_CAST_SCAN_LIMIT", "5000"))
+FACET_CAST_BITSETS = int(environ.get("FACET_CAST_BITSETS", "256"))
+
+# maximum number of suggestions returned by the autocomplete endpoint
+MAX_SUGGEST_TOP_K = int(environ.get("MAX_SUGGEST_TOP_K", "20"))
+
+# fraction of timed calls logged one per line, 0 disables logging
+PERF_LOG_SAMPLE_RATE = float(environ.get("PERF_LOG_SAMPLE_RATE", "0"))
+
+# searches slower than the threshold are kept in the slow query log (the last SLOW_QUERY_LOG_SIZE of them)
+SLOW_QUERY_THRESHOLD_MS = float(environ.get("SLOW_QUERY_THRESHOLD_MS", "5"))
+SLOW_QUERY_LOG_SIZE = int(environ.get("SLOW_QUERY_LOG_SIZE", "1000"))
@@ -1,25 +1,164 @@
+import asyncio
+import gc
+import logging
 import time
-from typing import Optional
+from typing import List, Optional
 
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException, BackgroundTasks
+from fastapi.responses import PlainTextResponse
 
 
-from movies.search_service import SearchService, SearchResponse
-from utils.perf_tools import PerfCounters, perf_counters
+from app.config import CHANGELOG_APPLY_CHUNK_SIZE, CHANGELOG_POLL_INTERVAL_SECONDS, MAX_BATCH_SIZE, MAX_FACET_TOP_K, MAX_SUGGEST_TOP_K, RELOAD_INTERVAL_SECONDS
+from movies.changelog import read_changelog
+from movies.cursor import InvalidCursorError
+from movies.responses import IDENTITY, choose_encoding
+from movies.models import ExplainResponse, FacetsResponse, SuggestResponse
+from movies.search_service import SearchService, SearchRequest, SearchResponse
+from movies.slow_query_log import SlowQuery
+from utils.memory import report_memory_usage
+from utils.perf_tools import PerfCountersReport, perf_counters
+from utils.profiling import ProfilingInProgressError, request_profiler
 
 app = FastAPI()
 
 search_service: Optional[SearchService] = None
+snapshot_reloader: Optional[asyncio.Task] = None
+# disabled in pre-forked workers, the parent process reloads data (see app/prefork.py)
+snapshot_reloading_enabled = RELOAD_INTERVAL_SECONDS > 0
+# enabled in pre-forked workers, which apply the change log to their copy of the data and leave reloads to the parent
+changelog_only_polling_enabled = False
 
 
 @app.on_event("startup")
 async def startup_event():
+    global search_service, snapshot_reloader
+    # the service is already loaded in pre-forked workers
+    if search_service is None:
+        search_service = SearchService()
+    perf_counters.set_info("snapshot_version", search_service.version)
+    perf_counters.set_info("changelog_version", str(search_service.changelog_version))
+    report_memory_usage()
+
+    if snapshot_reloading_enabled:
+        snapshot_reloader = asyncio.create_task(reload_snapshot_periodically(RELOAD_INTERVAL_SECONDS, CHANGELOG_POLL_INTERVAL_SECONDS))
+    elif changelog_only_polling_enabled and CHANGELOG_POLL_INTERVAL_SECONDS > 0:
+        snapshot_reloader = asyncio.create_task(apply_changelog_periodically(CHANGELOG_POLL_INTERVAL_SECONDS))
+
+
+async def reload_snapshot(s3=None, force: bool = False) -> bool:
+    """
+    Load a new data snapshot if it has changed in the storage bucket (or if forced) and swap it in.
+    The new service is built off the event loop while the current one keeps serving,
+    requests started before the swap finish on the old one.
+    Only one reload runs at a time, so there are at most two datasets in memory.
+    Returns True if the snapshot has been reloaded.
+    """
     global search_service
-    search_service = SearchService()
+
+    loop = asyncio.get_running_loop()
+    version = await loop.run_in_executor(None, SearchService.get_snapshot_version, s3)
+    if not force and search_service is not None and search_service.data_version == version:
+        return False
+
+    logging.info("Reloading data snapshot %s...", version)
+    start_time = time.perf_counter()
+    new_search_service = await loop.run_in_executor(None, SearchService, s3)
+
+    # atomic swap - handlers read the global once per request
+    search_service = new_search_service
+    perf_counters.increment("reload_snapshot", time.perf_counter() - start_time)
+    perf_counters.count("snapshot_reload")
+    perf_counters.set_info("snapshot_version", new_search_service.version)
+    perf_counters.set_info("changelog_version", str(new_search_service.changelog_version))
+
+    # the old service has reference cycles (engines), release its memory before the next reload
+    await loop.run_in_executor(None, gc.collect)
+    return True
+
+
+async def apply_changelog(s3=None, reload: bool = True) -> bool:
+    """
+    Apply the change log entries published since the applied version to the current service in place.
+    Entries are read off the event loop. Upserts are applied CHANGELOG_APPLY_CHUNK_SIZE movies at a time: the positions they replace
+    are located (most of the work) off the event loop, then the chunk is updated in place on it between requests,
+    so no request sees a partially applied movie and the loop is never blocked for long, whatever the size of the entry.
+    Suggestions are rebuilt off the event loop afterwards. Reload entries (and gaps in versions) reload the snapshot,
+    or only stop the entries from being applied if reload is False.
+    Returns True if any entry has been applied (or the snapshot reloaded).
+    """
+    service = search_service
+    if service is None:
+        return False
+
+    loop = asyncio.get_running_loop()
+    entries = await loop.run_in_executor(None, read_changelog, s3, service.changelog_version)
+    if not entries or search_service is not service:
+        return False
+
+    applied = 0
+    for entry in entries:
+        if entry['version'] <= service.changelog_version:
+            continue
+        if service.requires_reload(entry):
+            logging.info("Change log version %s requires reloading the data snapshot", entry['version'])
+            if not reload:
+                break
+            return await reload_snapshot(s3, force=True)
+        upserts = entry['upserts']
+        for start in range(0, len(upserts), CHANGELOG_APPLY_CHUNK_SIZE):
+            # only this task changes the service, so the located positions are still valid when the chunk is applied
+            located = await loop.run_in_executor(None, service.locate_upserts, upserts[start:start + CHANGELOG_APPLY_CHUNK_SIZE])
+            service.apply_located_upserts(*located)
+            await asyncio.sleep(0)
+        service.set_changelog_version(entry)
+        applied += 1
+    if not applied:
+        return False
+    perf_counters.count("changelog_entries_applied", applied)
+    perf_counters.set_info("changelog_version", str(service.changelog_version))
+
+    await loop.run_in_executor(None, service.build_suggestions)
+    return True
+
+
+async def apply_changelog_periodically(interval: float):
+    """
+    Apply the change log every interval seconds without ever reloading the snapshot (pre-forked workers, see app/prefork.py),
+    entries stop being applied at one requiring a reload until the process is replaced
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await apply_changelog(reload=False)
+        except Exception as e:
+            logging.error("Unable to apply change log: %s", repr(e))
+
+
+async def reload_snapshot_periodically(interval: float, changelog_interval: float = 0):
+    """
+    Apply the change log every changelog_interval seconds (if enabled) and check for a new snapshot every interval seconds,
+    one task does both, so change log entries are never applied during a reload
+    """
+    last_reload_check = time.monotonic()
+    while True:
+        await asyncio.sleep(min(interval, changelog_interval) if changelog_interval > 0 else interval)
+        if changelog_interval > 0:
+            try:
+                await apply_changelog()
+            except Exception as e:
+                logging.error("Unable to apply change log: %s", repr(e))
+        if time.monotonic() - last_reload_check >= interval:
+            last_reload_check = time.monotonic()
+            try:
+                await reload_snapshot()
+            except Exception as e:
+                logging.error("Unable to reload data snapshot: %s", repr(e))
 
 
 @app.get("/", response_model=SearchResponse)
-async def search(title_contains: str = "", year: int = 0, cast: str = "", genre: str = "", page: int = 0, page_size: int = 10):
+async def search(request: Request, background_tasks: BackgroundTasks,
+                 title_contains: str = "", year: int = 0, cast: str = "", genre: str = "", page: int = 0, page_size: int = 10,
+                 cursor: str = ""):
     """
     Search movies by title, year, cast and genre.
     Search parameters are combined using AND.
@@ -28,14 +167,108 @@ async def search(title_contains: str = "", year: int = 0, cast: str = "", genre:
     - **year**: filter movies from the year; ignored if 0
     - **cast**: filter movies having a cast member (full name is expected); ignored if empty
     - **genre**: filter movies which has the genre (full genre name is expected); ignored if empty
+    - **cursor**: cursor from the previous response to fetch the next page without rescanning; page is ignored if set
     """
 
-    if search_service is None:
+    # the service can be swapped by the snapshot reloader, use the same one for the whole request
+    service = search_service
+    if service is None:
+        raise HTTPException(status_code=500, detail="Service is starting")
+
+    encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    try:
+        body = service.cached_response_body(title_contains=title_contains, year=year, cast=cast, genre=genre, page=page, page_size=page_size,
+                                            cursor=cursor, encoding=encoding)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # compare the candidate engine on a sample of queries after the response is sent
+    shadow = service.shadow
+    if shadow is not None and shadow.should_sample():
+        background_tasks.add_task(shadow.compare, service.make_query(title_contains, year, cast, genre), page, page_size)
+
+    # pre-serialized body, skips response model validation and serialization
+    headers = {"Vary": "Accept-Encoding"}
+    if encoding != IDENTITY:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@app.post("/batch", response_model=List[SearchResponse])
+async def search_batch(requests: List[SearchRequest]):
+    """
+    Run several searches at once, e.g. all rows of a page.
+    Each search accepts the same parameters as the search endpoint, responses are returned in the same order.
+    Cached results are answered from the cache, the rest are evaluated together.
+    """
+
+    service = search_service
+    if service is None:
+        raise HTTPException(status_code=500, detail="Service is starting")
+
+    if len(requests) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch size is limited to {MAX_BATCH_SIZE} searches")
+
+    try:
+        return service.find_movies_batch(requests)
+    except InvalidCursorError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/facets", response_model=FacetsResponse)
+async def facets(title_contains: str = "", year: int = 0, cast: str = "", genre: str = "", top_k: int = 10):
+    """
+    Count movies matching the search filters (same as the search endpoint) per year, per genre
+    and for the top cast members.
+
+    - **top_k**: number of top cast members to count
+    """
+
+    service = search_service
+    if service is None:
         raise HTTPException(status_code=500, detail="Service is starting")
 
-    movies = search_service.cached_find_movies(title_contains=title_contains, year=year, cast=cast, genre=genre, page=page, page_size=page_size)
+    if not 0 <= top_k <= MAX_FACET_TOP_K:
+        raise HTTPException(status_code=400, detail=f"top_k is limited to {MAX_FACET_TOP_K}")
 
-    return movies
+    return service.find_facets(title_contains=title_contains, year=year, cast=cast, genre=genre, top_k=top_k)
+
+
+@app.get("/suggest", response_model=SuggestResponse)
+async def suggest(prefix: str, field: str = "title", top_k: int = 10):
+    """
+    Autocomplete for the search box, does not run a search.
+
+    - **prefix**: case insensitive beginning of the title or cast member name
+    - **field**: title or cast
+    - **top_k**: number of suggestions; shortest titles and cast members with the most movies come first
+    """
+
+    service = search_service
+    if service is None:
+        raise HTTPException(status_code=500, detail="Service is starting")
+
+    if not 0 <= top_k <= MAX_SUGGEST_TOP_K:
+        raise HTTPException(status_code=400, detail=f"top_k is limited to {MAX_SUGGEST_TOP_K}")
+
+    try:
+        return service.suggest(prefix=prefix, field=field, top_k=top_k)
+    except KeyError:
+        raise HTTPException(status_code=400, detail="field has to be title or cast")
+
+
+@app.get("/explain", response_model=ExplainResponse)
+async def explain(title_contains: str = "", year: int = 0, cast: str = "", genre: str = ""):
+    """
+    Internal - query plan of the search (index lookup or full scan, order of predicates)
+    with estimated vs actual rows of each step and the execution time; the query is run to the end
+    """
+
+    service = search_service
+    if service is None:
+        raise HTTPException(status_code=500, detail="Service is starting")
+
+    return service.explain(title_contains=title_contains, year=year, cast=cast, genre=genre)
 
 
 @app.get("/health/ready")
@@ -73,13 +306,53 @@ async def get_is_alive():
     return "{ok: true}"
 
 
-@app.get("/perf_counters", response_model=PerfCounters)
+@app.get("/perf_counters", response_model=PerfCountersReport)
 async def get_perf_counters():
     """
     Internal - get perf counters
+    latency_ms has p50/p95/p99/max of every timed function and http path;
+    event_counts include shadow engine comparison counters (shadow_compared, shadow_mismatch), snapshot reloads, applied change log entries;
+    info has the current snapshot version and the applied change log version
+    """
+
+    return perf_counters.report()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Internal - perf counters in Prometheus text format
+    """
+
+    return PlainTextResponse(perf_counters.prometheus_text(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/admin/profile", response_class=PlainTextResponse)
+async def profile_requests(requests: int = 100, seconds: float = 30, sort: str = "cumulative", limit: int = 50):
+    """
+    Internal - profile this process with cProfile until the next <requests> requests have finished or <seconds> have passed,
+    returns aggregated stats of the top <limit> functions sorted by <sort> (pstats sort key, e.g. cumulative, tottime)
+    """
+
+    try:
+        return await request_profiler.capture(requests, seconds, sort, limit)
+    except ProfilingInProgressError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.get("/admin/slow_queries", response_model=List[SlowQuery])
+async def get_slow_queries():
+    """
+    Internal - recent searches slower than SLOW_QUERY_THRESHOLD_MS, the most recent first
     """
 
-    return perf_counters
+    service = search_service
+    if service is None:
+        raise HTTPException(status_code=500, detail="Service is starting")
+
+    return service.slow_query_log.recent()
 
 
 @app.middleware("http")
@@ -93,4 +366,5 @@ async def add_process_time_header(request: Request, call_next):
     total_time = end_time - start_time
     key = "http_search_request" + request.url.path
     perf_counters.increment(key, total_time)
+    request_profiler.request_finished()
     return response
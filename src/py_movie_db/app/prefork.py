@@ -0,0 +1,178 @@
+"""
+Pre-fork serving mode.
+The dataset is loaded once in the parent process and frozen against GC, then uvicorn workers are forked
+and share its memory pages copy-on-write, so N workers cost close to one dataset.
+The parent polls for a new data snapshot, loads it and replaces the workers with ones forked from the new dataset.
+Change log entries are applied in place by each worker (keeping its caches), and by the parent, so workers forked later
+start from the changed dataset; entries requiring a reload are left to the parent, which reloads and replaces the workers.
+Pages touched by applied entries (changed rows, index postings, rebuilt suggestions) stop being shared,
+each worker holds its own copy of them until it is replaced by the next snapshot reload.
+
+Usage: python -m app.prefork [--host 0.0.0.0] [--port 80] [--workers N]
+"""
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import time
+from typing import List
+
+import uvicorn
+
+import app.main as main
+from app.config import CHANGELOG_POLL_INTERVAL_SECONDS, PREFORK_WORKERS, RELOAD_INTERVAL_SECONDS
+from movies.changelog import read_changelog
+from movies.search_service import SearchService
+from utils.memory import report_memory_usage
+
+
+class PreforkServer:
+
+    def __init__(self, host: str, port: int, workers: int, reload_interval: float = RELOAD_INTERVAL_SECONDS,
+                 changelog_interval: float = CHANGELOG_POLL_INTERVAL_SECONDS):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reload_interval = reload_interval
+        self.changelog_interval = changelog_interval
+        self.sock: socket.socket = None
+        self.worker_pids: List[int] = []
+        self.stopping = False
+
+    def load(self):
+        # unfreeze the previous dataset, so its reference cycles can be collected after the swap
+        gc.unfreeze()
+        main.search_service = SearchService()
+        main.snapshot_reloading_enabled = False
+        main.changelog_only_polling_enabled = self.changelog_interval > 0
+
+        # move everything loaded so far to the permanent generation:
+        # GC in workers won't traverse (and so won't copy) the shared pages
+        gc.collect()
+        gc.freeze()
+        report_memory_usage()
+
+    def spawn_worker(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker()
+        return pid
+
+    def run_worker(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            config = uvicorn.Config(main.app, use_colors=False)
+            uvicorn.Server(config).run(sockets=[self.sock])
+        finally:
+            os._exit(0)
+
+    def stop_workers(self, pids: List[int]):
+        """
+        Graceful shutdown, workers finish in-flight requests
+        """
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def respawn_dead_workers(self):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.worker_pids and not self.stopping:
+                logging.warning("Worker %s has exited, respawning", pid)
+                self.worker_pids[self.worker_pids.index(pid)] = self.spawn_worker()
+
+    def replace_workers(self):
+        old_pids, self.worker_pids = self.worker_pids, [self.spawn_worker() for _ in range(self.workers)]
+        self.stop_workers(old_pids)
+
+    def reload(self, force: bool = False):
+        try:
+            version = SearchService.get_snapshot_version()
+        except Exception as e:
+            logging.error("Unable to check data snapshot: %s", repr(e))
+            return
+        if not force and version == main.search_service.data_version:
+            return
+
+        logging.info("Reloading data snapshot %s...", version)
+        # at most two datasets: old workers keep serving until new ones are forked from the new dataset
+        self.load()
+        self.replace_workers()
+
+    def apply_changelog(self):
+        service = main.search_service
+        try:
+            entries = read_changelog(None, service.changelog_version)
+        except Exception as e:
+            logging.error("Unable to read change log: %s", repr(e))
+            return
+        if not entries:
+            return
+
+        for entry in entries:
+            if not service.apply_changelog_entry(entry):
+                logging.info("Change log version %s requires reloading the data snapshot", entry['version'])
+                self.reload(force=True)
+                return
+        # workers apply the entries themselves (see main.apply_changelog_periodically), re-forking them would drop their caches
+        service.build_suggestions()
+
+    def stop(self, *args):
+        self.stopping = True
+
+    def serve(self):
+        self.sock = socket.create_server((self.host, self.port))
+        self.sock.set_inheritable(True)
+
+        self.load()
+        self.worker_pids = [self.spawn_worker() for _ in range(self.workers)]
+        logging.info("Serving on %s:%s with %s workers", self.host, self.port, self.workers)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        last_reload_check = last_changelog_check = time.monotonic()
+        while not self.stopping:
+            time.sleep(1)
+            self.respawn_dead_workers()
+            if self.changelog_interval > 0 and time.monotonic() - last_changelog_check >= self.changelog_interval:
+                self.apply_changelog()
+                last_changelog_check = time.monotonic()
+            if self.reload_interval > 0 and time.monotonic() - last_reload_check >= self.reload_interval:
+                self.reload()
+                last_reload_check = time.monotonic()
+
+        self.stop_workers(self.worker_pids)
+        self.sock.close()
+
+
+def main_prefork():
+    parser = argparse.ArgumentParser(description="Pre-fork movie db API server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=80)
+    parser.add_argument("--workers", type=int, default=PREFORK_WORKERS)
+    args = parser.parse_args()
+
+    PreforkServer(args.host, args.port, args.workers).serve()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+
+    main_prefork()
@@ -0,0 +1,122 @@
+"""
+Synthetic movie catalogues for benchmarks - Zipf distributed title words, cast members, genres and years
+with per movie counts following the seed data, so the query shapes of the load runner hit realistic posting sizes
+"""
+import itertools
+import random
+from array import array
+from typing import List
+
+from movies.movie_table import MovieTable, StringDictionary
+
+# names queried by the load runner (src/load_runner/main.py), placed at fixed popularity ranks
+FREQUENT_WORDS = ["book", "dawn", "day", "fate", "word"]
+FAMOUS_CAST = ["Sean Connery", "Gillian Anderson", "Cate Blanchett", "Billy Bob Thornton"]
+
+# the most frequent title words of the seed data, then the load runner words at their seed data ranks
+STOP_WORDS = ["the", "of", "a", "in", "and", "to", "man", "love", "for", "on"]
+FREQUENT_WORD_RANKS = [290, 180, 70, 550, 1160]
+FAMOUS_CAST_RANKS = [10, 100, 50, 30]
+
+# genres of the seed data, the most frequent first
+GENRES = [
+    "Drama", "Comedy", "Western", "Crime", "Horror", "Musical", "Romance", "Action", "Adventure", "Thriller",
+    "Science Fiction", "Animated", "Mystery", "War", "Documentary", "Biography", "Noir", "Family", "Short", "Fantasy",
+    "Sports", "Suspense", "Historical", "Superhero", "Spy", "Satire", "Erotic", "Disaster", "Performance", "Teen",
+    "Martial Arts", "Slasher", "Political", "Dance", "Supernatural", "Live Action", "Sport", "Silent", "Independent",
+    "Legal", "Found Footage",
+]
+FIRST_YEAR = 1900
+LAST_YEAR = 2023
+
+# number of movies with 0, 1, 2... title words, cast members and genres in the seed data
+TITLE_LENGTH_WEIGHTS = [0, 3330, 8652, 8553, 4890, 2206, 680, 245, 140, 48, 21]
+CAST_COUNT_WEIGHTS = [924, 1726, 12390, 8417, 2115, 1055, 777, 494, 271, 232, 112, 88, 194]
+GENRE_COUNT_WEIGHTS = [901, 23223, 4320, 284, 48]
+
+# distinct title words and cast members per movie, as in the seed data
+WORDS_PER_MOVIE = 0.5
+CAST_PER_MOVIE = 0.54
+
+TITLE_WORD_EXPONENT = 1.0
+CAST_EXPONENT = 0.6
+GENRE_EXPONENT = 1.0
+YEAR_EXPONENT = 0.3
+
+SYLLABLES = [consonant + vowel for consonant in "bcdfghklmnprstvz" for vowel in "aeiou"]
+
+
+def zipf_cum_weights(count: int, exponent: float) -> List[float]:
+    """
+    Cumulative weights of ranks 1..count, the probability of rank k is proportional to k ** -exponent
+    """
+    return list(itertools.accumulate(rank ** -exponent for rank in range(1, count + 1)))
+
+
+def pseudo_words(count: int) -> List[str]:
+    """
+    Distinct pronounceable words of two or more syllables
+    """
+    words = []
+    for number in range(len(SYLLABLES), len(SYLLABLES) + count):
+        syllables = []
+        while number:
+            number, syllable = divmod(number, len(SYLLABLES))
+            syllables.append(SYLLABLES[syllable])
+        words.append("".join(syllables))
+    return words
+
+
+def title_vocabulary(movies: int) -> List[str]:
+    words = pseudo_words(max(int(movies * WORDS_PER_MOVIE), FREQUENT_WORD_RANKS[-1] + 1))
+    words[:len(STOP_WORDS)] = STOP_WORDS
+    for word, rank in zip(FREQUENT_WORDS, FREQUENT_WORD_RANKS):
+        words[rank] = word
+    return words
+
+
+def cast_vocabulary(movies: int) -> List[str]:
+    count = max(int(movies * CAST_PER_MOVIE), max(FAMOUS_CAST_RANKS) + 1)
+    first_names = [_.capitalize() for _ in pseudo_words(200)]
+    last_names = [_.capitalize() for _ in pseudo_words(count // len(first_names) + 1)]
+    names = [f"{first_names[number % len(first_names)]} {last_names[number // len(first_names)]}" for number in range(count)]
+    for name, rank in zip(FAMOUS_CAST, FAMOUS_CAST_RANKS):
+        names[rank] = name
+    return names
+
+
+def generate_catalogue(movies: int, seed: int = 0) -> MovieTable:
+    """
+    Generate a table of movies, the same for the same size and seed
+    """
+    rng = random.Random(seed)
+
+    words = title_vocabulary(movies)
+    title_lengths = rng.choices(range(len(TITLE_LENGTH_WEIGHTS)), TITLE_LENGTH_WEIGHTS, k=movies)
+    title_words = iter(rng.choices(words, cum_weights=zipf_cum_weights(len(words), TITLE_WORD_EXPONENT), k=sum(title_lengths)))
+    titles = [" ".join(_.capitalize() for _ in itertools.islice(title_words, length)) for length in title_lengths]
+    del title_words
+
+    # popular years are spread over the century
+    year_ranks = list(range(FIRST_YEAR, LAST_YEAR + 1))
+    rng.shuffle(year_ranks)
+    years = array('H', rng.choices(year_ranks, cum_weights=zipf_cum_weights(len(year_ranks), YEAR_EXPONENT), k=movies))
+
+    cast_names = cast_vocabulary(movies)
+    cast_counts = rng.choices(range(len(CAST_COUNT_WEIGHTS)), CAST_COUNT_WEIGHTS, k=movies)
+    cast_ids = iter(rng.choices(range(len(cast_names)), cum_weights=zipf_cum_weights(len(cast_names), CAST_EXPONENT), k=sum(cast_counts)))
+
+    genre_counts = rng.choices(range(len(GENRE_COUNT_WEIGHTS)), GENRE_COUNT_WEIGHTS, k=movies)
+    genre_ids = iter(rng.choices(range(len(GENRES)), cum_weights=zipf_cum_weights(len(GENRES), GENRE_EXPONENT), k=sum(genre_counts)))
+
+    table = MovieTable()
+    table.cast_names = StringDictionary.from_strings(cast_names)
+    table.genre_names = StringDictionary.from_strings(GENRES)
+    table.append_columns(
+        titles,
+        years,
+        (tuple(dict.fromkeys(itertools.islice(cast_ids, count))) for count in cast_counts),
+        (tuple(dict.fromkeys(itertools.islice(genre_ids, count))) for count in genre_counts),
+    )
+    table.finish_loading()
+    return table
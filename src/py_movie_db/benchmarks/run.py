@@ -0,0 +1,282 @@
+"""
+Search benchmark on synthetic catalogues (see benchmarks.catalogue), without S3:
+latency percentiles and throughput of find_movies and cached_find_movies for the query shapes of the load runner
+(src/load_runner/main.py), time to load the snapshot and build indexes and the memory of the loaded service.
+Results are compared with the stored baseline, a regression fails the run.
+
+    python -m benchmarks.run                            # 30k and 300k movies against benchmarks/baseline.json
+    python -m benchmarks.run --sizes 3000000            # 3M movies, needs several GB of memory
+    python -m benchmarks.run --update-baseline          # store the results as the new baseline (of the sizes run)
+"""
+import argparse
+import gc
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from app.config import AWS_STORAGE_BUCKET_NAME, BINARY_SNAPSHOT_KEY, SEARCH_ENGINE
+from benchmarks.catalogue import FAMOUS_CAST, FREQUENT_WORDS, generate_catalogue
+from movies.result_cache import ResultCache
+from movies.search_service import SearchService
+from movies.slow_query_log import SlowQueryLog
+from movies.snapshot import encode_snapshot
+from utils.memory import read_memory_usage
+
+DEFAULT_SIZES = [30_000, 300_000]
+DEFAULT_ITERATIONS = 500
+# queries of a shape are measured in several rounds, the best value of each stat is reported (as timeit does)
+ROUNDS = 3
+DEFAULT_TOLERANCE = 0.25
+# latency differences below this are timer and scheduling noise, not regressions
+LATENCY_SLACK_MS = 0.05
+PAGE_SIZE = 10
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# query shape returns title_contains, year, cast, genre and page of a random query
+QueryShape = Callable[[random.Random], Tuple[str, int, str, str, int]]
+
+QUERY_SHAPES: Dict[str, QueryShape] = {
+    "all": lambda rng: ("", 0, "", "", rng.randrange(3)),
+    "year": lambda rng: ("", 2000, "", "", rng.randrange(3)),
+    "year_genre": lambda rng: ("", 2000, "", "Comedy", rng.randrange(3)),
+    "cast_genre": lambda rng: ("", 0, "Sean Connery", "Comedy", rng.randrange(3)),
+    "title": lambda rng: (rng.choice(FREQUENT_WORDS), 0, "", "", 0),
+    "complex": lambda rng: (rng.choice(FREQUENT_WORDS), rng.randrange(1990, 2010), rng.choice(FAMOUS_CAST), rng.choice(["Drama", "Comedy"]), 0),
+}
+METHODS = ["find_movies", "cached_find_movies"]
+
+# compared metrics, higher values are regressions unless listed in HIGHER_IS_BETTER
+COMPARED_METRICS = ("p50_ms", "p95_ms", "qps", "startup_s", "memory_mb")
+HIGHER_IS_BETTER = ("qps",)
+
+
+class InMemoryS3:
+    """
+    Stand-in of the S3 client serving a single binary snapshot to SearchService.load_file
+    """
+
+    def __init__(self, snapshot: bytes):
+        self.snapshot = snapshot
+        self.etag = hashlib.md5(snapshot).hexdigest()
+
+    def list_objects(self, Bucket: str) -> Dict:
+        return {"Contents": [{"Key": BINARY_SNAPSHOT_KEY, "ETag": f'"{self.etag}"'}]}
+
+    def get_paginator(self, operation_name: str) -> "InMemoryS3":
+        return self
+
+    def paginate(self, Bucket: str, Prefix: str = "", **kwargs) -> List[Dict]:
+        return [{"Contents": [_ for _ in self.list_objects(Bucket)["Contents"] if _["Key"].startswith(Prefix)]}]
+
+    def head_object(self, Bucket: str, Key: str) -> Dict:
+        if Bucket != AWS_STORAGE_BUCKET_NAME or Key != BINARY_SNAPSHOT_KEY:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ETag": f'"{self.etag}"'}
+
+    def get_object(self, Bucket: str, Key: str) -> Dict:
+        if Bucket != AWS_STORAGE_BUCKET_NAME or Key != BINARY_SNAPSHOT_KEY:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": f"No object {Bucket}/{Key}"}}, "GetObject")
+        return {"ETag": f'"{self.etag}"', "Body": io.BytesIO(self.snapshot)}
+
+
+@dataclass
+class LatencyStats:
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    max_ms: float
+    qps: float
+
+
+@dataclass
+class CatalogueResult:
+    """
+    - startup_s: time to load the snapshot and build indexes
+    - memory_mb: resident memory growth of the process after loading the service
+    - latency: stats per query shape and method
+    """
+    movies: int
+    startup_s: float
+    memory_mb: float
+    bytes_per_movie: float
+    latency: Dict[str, Dict[str, LatencyStats]]
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def measure(method: Callable, queries: List[Tuple[str, int, str, str, int]]) -> LatencyStats:
+    latencies = []
+    perf_counter = time.perf_counter
+    start_time = perf_counter()
+    for title_contains, year, cast, genre, page in queries:
+        query_start = perf_counter()
+        method(title_contains, year, cast, genre, page, PAGE_SIZE)
+        latencies.append(perf_counter() - query_start)
+    elapsed = perf_counter() - start_time
+
+    latencies.sort()
+    return LatencyStats(
+        p50_ms=percentile(latencies, 0.5) * 1000,
+        p95_ms=percentile(latencies, 0.95) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        max_ms=latencies[-1] * 1000,
+        qps=len(queries) / elapsed,
+    )
+
+
+def benchmark_catalogue(movies: int, iterations: int, engine: str, seed: int) -> CatalogueResult:
+    gc.collect()
+    rss_before = read_memory_usage().get("rss", 0)
+    snapshot = encode_snapshot(generate_catalogue(movies, seed))
+    gc.collect()
+
+    start_time = time.perf_counter()
+    service = SearchService(InMemoryS3(snapshot), engine=engine, shadow_engine="",
+                            result_cache=ResultCache(), response_cache=ResultCache(), slow_query_log=SlowQueryLog())
+    startup = time.perf_counter() - start_time
+    del snapshot
+    gc.collect()
+    memory = read_memory_usage().get("rss", 0) - rss_before
+
+    rng = random.Random(seed)
+    latency: Dict[str, Dict[str, LatencyStats]] = {}
+    for shape_name, shape in QUERY_SHAPES.items():
+        queries = [shape(rng) for _ in range(iterations)]
+        latency[shape_name] = {}
+        for method_name in METHODS:
+            method = getattr(service, method_name)
+            # warm up the code paths (and the result cache, as the repeated queries of the load runner do)
+            measure(method, queries[:iterations // 10])
+            rounds = [measure(method, queries) for _ in range(ROUNDS)]
+            latency[shape_name][method_name] = LatencyStats(
+                p50_ms=min(_.p50_ms for _ in rounds),
+                p95_ms=min(_.p95_ms for _ in rounds),
+                p99_ms=min(_.p99_ms for _ in rounds),
+                max_ms=min(_.max_ms for _ in rounds),
+                qps=max(_.qps for _ in rounds),
+            )
+
+    return CatalogueResult(
+        movies=movies,
+        startup_s=startup,
+        memory_mb=memory / 2**20,
+        bytes_per_movie=memory / movies,
+        latency=latency,
+    )
+
+
+def flatten(results: List[CatalogueResult]) -> Dict[str, float]:
+    """
+    Metrics keyed by movies/metric and movies/shape/method/metric
+    """
+    metrics = {}
+    for result in results:
+        for key, value in asdict(result).items():
+            if key == "latency":
+                for shape_name, methods in value.items():
+                    for method_name, stats in methods.items():
+                        for stat, stat_value in stats.items():
+                            metrics[f"{result.movies}/{shape_name}/{method_name}/{stat}"] = stat_value
+            elif key != "movies":
+                metrics[f"{result.movies}/{key}"] = value
+    return metrics
+
+
+def compare_with_baseline(metrics: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """
+    Descriptions of the metrics which are worse than the baseline by more than the tolerance,
+    metrics missing in the baseline are not compared
+    """
+    regressions = []
+    for key, value in metrics.items():
+        metric = key.rsplit("/", 1)[-1]
+        base = baseline.get(key)
+        if metric not in COMPARED_METRICS or not base:
+            continue
+        if metric in HIGHER_IS_BETTER:
+            # throughput is compared as the mean time per query
+            regressed = 1000 / value > 1000 / base * (1 + tolerance) + LATENCY_SLACK_MS
+        else:
+            slack = LATENCY_SLACK_MS if metric.endswith("_ms") else 0
+            regressed = value > base * (1 + tolerance) + slack
+        if regressed:
+            regressions.append(f"{key}: {value:.3f} vs baseline {base:.3f}")
+    return regressions
+
+
+def print_results(results: List[CatalogueResult]):
+    for result in results:
+        print(f"{result.movies} movies: startup {result.startup_s:.2f}s, "
+              f"memory {result.memory_mb:.1f}MB ({result.bytes_per_movie:.0f} bytes/movie)")
+        print(f"  {'shape':<12} {'method':<20} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9} {'qps':>9}")
+        for shape_name, methods in result.latency.items():
+            for method_name, stats in methods.items():
+                print(f"  {shape_name:<12} {method_name:<20} {stats.p50_ms:>9.3f} {stats.p95_ms:>9.3f} "
+                      f"{stats.p99_ms:>9.3f} {stats.max_ms:>9.3f} {stats.qps:>9.0f}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark SearchService on synthetic catalogues")
+    parser.add_argument("--sizes", type=lambda value: [int(_) for _ in value.split(",")], default=DEFAULT_SIZES,
+                        help="comma separated catalogue sizes, e.g. 30000,300000,3000000")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS, help="queries per shape and method")
+    parser.add_argument("--engine", default=SEARCH_ENGINE)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="allowed relative regression")
+    parser.add_argument("--update-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--output", help="also write the results as json to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for movies in args.sizes:
+        results.append(benchmark_catalogue(movies, args.iterations, args.engine, args.seed))
+        print_results(results[-1:])
+        gc.collect()
+    metrics = flatten(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump([asdict(_) for _ in results], f, indent=2)
+
+    if args.update_baseline:
+        # metrics of sizes which were not run are kept
+        stored_metrics = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                stored_metrics = json.load(f)["metrics"]
+        baseline = {
+            "environment": {"python": platform.python_version(), "machine": platform.machine(),
+                            "engine": args.engine, "iterations": args.iterations, "seed": args.seed},
+            "metrics": {**stored_metrics, **metrics},
+        }
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Baseline stored in {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline in {args.baseline}, run with --update-baseline to store one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(metrics, baseline["metrics"], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,38 @@
+"""
+Change log of the movies upserted by indexer runs - main.changes/<version>.json objects with consecutive versions,
+each either {"version": n, "upserts": [movies]} or {"version": n, "reload": true} if the snapshot has to be reloaded.
+Upserts of a run writing a delta segment name it as "segment", so servers applying them know their data matches the manifest listing it
+"""
+import json
+from typing import Dict, List
+
+import boto3
+
+from app.config import AWS_ENDPOINT_URL, AWS_STORAGE_BUCKET_NAME, CHANGELOG_PREFIX
+
+
+def changelog_key(version: int) -> str:
+    # zero padded, so keys are listed in the version order
+    return f"{CHANGELOG_PREFIX}{version:012d}.json"
+
+
+def read_changelog_version(s3) -> int:
+    """
+    The latest published version, 0 if there is none
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    keys = [item['Key'] for page in paginator.paginate(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=CHANGELOG_PREFIX) for item in page.get('Contents', [])]
+    return int(keys[-1][len(CHANGELOG_PREFIX):].split(".", 1)[0]) if keys else 0
+
+
+def read_changelog(s3=None, after_version: int = 0) -> List[Dict]:
+    """
+    Entries published after the version, in the version order
+    """
+    if s3 is None:
+        s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+
+    paginator = s3.get_paginator("list_objects_v2")
+    pages = paginator.paginate(Bucket=AWS_STORAGE_BUCKET_NAME, Prefix=CHANGELOG_PREFIX, StartAfter=changelog_key(after_version))
+    return [json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=item['Key'])['Body'].read())
+            for page in pages for item in page.get('Contents', [])]
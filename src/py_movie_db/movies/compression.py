@@ -0,0 +1,52 @@
+"""
+Decompression of objects published by the indexer as streams - gzip, or zstd if the zstandard package is installed
+(the decompression part of indexer/compression.py of the indexer job, keep them in sync)
+"""
+import hashlib
+import zlib
+from typing import Iterable, Iterator
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+
+def new_decompressor(encoding: str):
+    if encoding == "gzip":
+        return zlib.decompressobj(zlib.MAX_WBITS | 16)
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unsupported compression {encoding}")
+
+
+def iter_decompressed(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    """
+    Decompress a stream of chunks
+
+    :raises ValueError: if the stream is not valid or truncated
+    """
+    decompressor = new_decompressor(encoding)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+    # older zstandard versions don't report the end of the frame, the checksum of the object covers truncation then
+    if not getattr(decompressor, "eof", True):
+        raise ValueError("Compressed stream is truncated")
+
+
+def iter_verified(chunks: Iterable[bytes], size: int, checksum: str) -> Iterator[bytes]:
+    """
+    Pass the chunks through, checking their total size and sha256 checksum once the stream ends
+
+    :raises ValueError: if the contents do not match
+    """
+    digest = hashlib.sha256()
+    received = 0
+    for chunk in chunks:
+        digest.update(chunk)
+        received += len(chunk)
+        yield chunk
+    if received != size or digest.hexdigest() != checksum:
+        raise ValueError(f"Object of {received} bytes does not match the expected {size} bytes and checksum {checksum}")
@@ -0,0 +1,31 @@
+"""
+Opaque pagination cursors - resume position in the movies list bound to the snapshot version
+"""
+import base64
+import binascii
+
+
+class InvalidCursorError(ValueError):
+    """
+    Cursor is malformed or was issued for another snapshot version
+    """
+
+
+def encode_cursor(version: str, position: int) -> str:
+    return base64.urlsafe_b64encode(f"{version}:{position}".encode()).decode()
+
+
+def decode_cursor(cursor: str, version: str) -> int:
+    """
+    Returns the position to resume the search from
+    """
+    try:
+        cursor_version, position = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit(":", 1)
+        position = int(position)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursorError("Malformed cursor")
+
+    if cursor_version != version or position < 0:
+        raise InvalidCursorError("Cursor has expired, data has been reloaded")
+
+    return position
@@ -0,0 +1,204 @@
+"""
+Search engines - strategies to evaluate a query against the loaded movies
+"""
+import itertools
+from typing import Dict, Iterator, List, NamedTuple, Optional, Type
+
+from movies.indexes import intersect_postings
+
+
+class SearchQuery(NamedTuple):
+    """
+    Search predicates combined using AND, empty or 0 values are ignored
+    """
+    title_contains: str  # normalized
+    year: int
+    cast: str
+    genre: str
+
+
+class SearchEngine:
+    """
+    Base search engine.
+    Engines yield positions of matching movies in the movies list order starting from the start position,
+    so any two engines return the same pages for the same query.
+    """
+
+    name = ""
+
+    def __init__(self, service):
+        self.service = service
+
+    def find_positions(self, query: SearchQuery, start: int = 0) -> Iterator[int]:
+        raise NotImplementedError()
+
+    def find_positions_batch(self, queries: List[SearchQuery], starts: List[int], limits: List[int]) -> List[List[int]]:
+        """
+        Evaluate several queries, returns up to limit matching positions from the start position for each query
+        """
+        return [list(itertools.islice(self.find_positions(query, start), limit))
+                for query, start, limit in zip(queries, starts, limits)]
+
+
+def scan_batch(table, queries: List[SearchQuery], starts: List[int], limits: List[int]) -> List[List[int]]:
+    """
+    Evaluate several queries in one shared pass over the movies,
+    the pass stops as soon as every query has got its limit of matches
+    """
+    results: List[List[int]] = [[] for _ in queries]
+
+    # (result index, start, limit, predicates with cast and genre resolved to dictionary ids)
+    active = []
+    for i, (query, start, limit) in enumerate(zip(queries, starts, limits)):
+        title_contains, year, cast, genre = query
+        cast_id = table.cast_names.get_id(cast) if cast else None
+        genre_id = table.genre_names.get_id(genre) if genre else None
+        if limit <= 0 or (cast and cast_id is None) or (genre and genre_id is None):
+            continue
+        active.append((i, start, limit, title_contains, year, cast_id, genre_id))
+
+    if not active:
+        return results
+
+    first_start = min(_[1] for _ in active)
+    columns = itertools.islice(zip(table.titles_normalized, table.years, table.cast_ids, table.genre_ids), first_start, None)
+    for position, (title_normalized, item_year, cast_ids, genre_ids) in enumerate(columns, first_start):
+        filled = False
+        for i, start, limit, title_contains, year, cast_id, genre_id in active:
+            if (position >= start
+                    and (not title_contains or title_contains in title_normalized)
+                    and (year == 0 or year == item_year)
+                    and (cast_id is None or cast_id in cast_ids)
+                    and (genre_id is None or genre_id in genre_ids)):
+                results[i].append(position)
+                filled = filled or len(results[i]) >= limit
+
+        if filled:
+            active = [_ for _ in active if len(results[_[0]]) < _[2]]
+            if not active:
+                break
+
+    return results
+
+
+class ScanEngine(SearchEngine):
+    """
+    Reference engine - full scan of movies evaluating all the predicates.
+    Batches of queries are evaluated in one shared scan.
+    """
+
+    name = "scan"
+
+    def find_positions(self, query: SearchQuery, start: int = 0) -> Iterator[int]:
+        title_contains, year, cast, genre = query
+        table = self.service.movies_list
+
+        cast_id = table.cast_names.get_id(cast) if cast else None
+        genre_id = table.genre_names.get_id(genre) if genre else None
+        if (cast and cast_id is None) or (genre and genre_id is None):
+            return iter(())
+
+        columns = itertools.islice(zip(table.titles_normalized, table.years, table.cast_ids, table.genre_ids), start, None)
+        return (position for position, (title_normalized, item_year, cast_ids, genre_ids) in enumerate(columns, start)
+                if (not title_contains or title_contains in title_normalized)
+                and (year == 0 or year == item_year)
+                and (cast_id is None or cast_id in cast_ids)
+                and (genre_id is None or genre_id in genre_ids))
+
+    def find_positions_batch(self, queries: List[SearchQuery], starts: List[int], limits: List[int]) -> List[List[int]]:
+        return scan_batch(self.service.movies_list, queries, starts, limits)
+
+
+class IndexEngine(SearchEngine):
+    """
+    Evaluate conditions using inverted indexes for year, cast and genre and trigram index for title,
+    title substring is confirmed on the intersected candidates.
+    Queries without indexable conditions (e.g. title shorter than 3 chars only) fall back to the full scan,
+    in batches such queries share one scan.
+    """
+
+    name = "index"
+
+    def get_postings(self, query: SearchQuery) -> List:
+        """
+        Posting lists of the indexable predicates, empty if the query has to be evaluated by the scan
+        """
+        title_contains, year, cast, genre = query
+        service = self.service
+        table = service.movies_list
+
+        postings = []
+        if title_contains:
+            postings.extend(service.title_index.lookup(title_contains) or [])
+        if year != 0:
+            postings.append(service.year_index.get(year))
+        if cast:
+            postings.append(service.cast_index.get(table.cast_names.get_id(cast)))
+        if genre:
+            postings.append(service.genre_index.get(table.genre_names.get_id(genre)))
+        return postings
+
+    def find_positions(self, query: SearchQuery, start: int = 0) -> Iterator[int]:
+        title_contains = query.title_contains
+        postings = self.get_postings(query)
+
+        titles_normalized = self.service.movies_list.titles_normalized
+        if not postings:
+            return (position for position, title_normalized in enumerate(itertools.islice(titles_normalized, start, None), start)
+                    if not title_contains or title_contains in title_normalized)
+
+        # candidates come in the movies list order, so pagination is the same as for the full scan
+        candidates = intersect_postings(postings, start)
+        if not title_contains:
+            return candidates
+        return (position for position in candidates if title_contains in titles_normalized[position])
+
+    def find_positions_batch(self, queries: List[SearchQuery], starts: List[int], limits: List[int]) -> List[List[int]]:
+        results: List[Optional[List[int]]] = [None] * len(queries)
+        scanned = []
+        for i, (query, start, limit) in enumerate(zip(queries, starts, limits)):
+            if self.get_postings(query):
+                results[i] = list(itertools.islice(self.find_positions(query, start), limit))
+            else:
+                scanned.append(i)
+
+        scan_results = scan_batch(self.service.movies_list, [queries[_] for _ in scanned], [starts[_] for _ in scanned], [limits[_] for _ in scanned])
+        for i, positions in zip(scanned, scan_results):
+            results[i] = positions
+        return results
+
+
+class PlannerEngine(SearchEngine):
+    """
+    Evaluate the plan chosen by the statistics-based planner (see movies.planner):
+    posting list of the most selective indexed predicate or the full scan, whichever is estimated cheaper,
+    then the remaining predicates in ascending order of estimated rows.
+    In batches queries planned as scans share one scan.
+    """
+
+    name = "planner"
+
+    def find_positions(self, query: SearchQuery, start: int = 0) -> Iterator[int]:
+        return self.service.planner.plan(query).execute(start)
+
+    def find_positions_batch(self, queries: List[SearchQuery], starts: List[int], limits: List[int]) -> List[List[int]]:
+        results: List[Optional[List[int]]] = [None] * len(queries)
+        scanned = []
+        for i, (query, start, limit) in enumerate(zip(queries, starts, limits)):
+            plan = self.service.planner.plan(query)
+            if plan.strategy == "scan":
+                scanned.append(i)
+            else:
+                results[i] = list(itertools.islice(plan.execute(start), limit))
+
+        scan_results = scan_batch(self.service.movies_list, [queries[_] for _ in scanned], [starts[_] for _ in scanned], [limits[_] for _ in scanned])
+        for i, positions in zip(scanned, scan_results):
+            results[i] = positions
+        return results
+
+
+SEARCH_ENGINES: Dict[str, Type[SearchEngine]] = {
+    ScanEngine.name: ScanEngine,
+    IndexEngine.name: IndexEngine,
+    PlannerEngine.name: PlannerEngine,
+}
@@ -0,0 +1,247 @@
+"""
+Facet counts (movies per year, per genre, top cast members) for search filters
+"""
+import heapq
+import itertools
+from array import array
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from movies.engines import SearchQuery
+from movies.indexes import PostingIndex
+
+BIT_FLAGS = bytes.maketrans(b"01", b"\0\1")
+# bitsets with less than 1 of this many bits set are iterated with bytes.find
+SPARSE_BITSET_RATIO = 16
+
+
+def to_bitset(positions: Iterable[int], size: int) -> int:
+    """
+    Bitset of positions as python int, bit i is set if position i is present
+    """
+    data = bytearray((size + 7) // 8)
+    for position in positions:
+        data[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(data, "little")
+
+
+def iter_bitset(bits: int) -> Iterator[int]:
+    """
+    Positions of the set bits in ascending order
+    """
+    # binary digits from the lowest bit as 0/1 bytes
+    flags = bin(bits)[:1:-1].encode().translate(BIT_FLAGS)
+    if bits.bit_count() * SPARSE_BITSET_RATIO < len(flags):
+        # compress visits every digit, find skips the zero runs of sparse sets in C
+        return _iter_flags(flags)
+    return itertools.compress(itertools.count(), flags)
+
+
+def _iter_flags(flags: bytes) -> Iterator[int]:
+    find = flags.find
+    position = find(1)
+    while position >= 0:
+        yield position
+        position = find(1, position + 1)
+
+
+class FacetIndex:
+    """
+    Per-value bitsets of low cardinality attributes (years, genres), built on load.
+    Counts of a facet value are popcounts of the value bitset ANDed with the filter bitset.
+    Cast is a high cardinality attribute: overall top cast is precomputed for unfiltered queries,
+    top cast of up to cast_scan_limit matching movies is counted over the movies, of more matching movies
+    from the cast members with the most movies down, with bitsets of the first cast_bitsets of them (see count_top_cast).
+    """
+
+    def __init__(self, service, top_k_limit: int, cast_bitsets: int, cast_scan_limit: int):
+        table = service.movies_list
+        self.service = service
+        self.size = len(table)
+        self.all_bits = (1 << self.size) - 1
+        self.year_bits: Dict[int, int] = self._bitsets(service.year_index)
+        self.genre_bits: Dict[int, int] = self._bitsets(service.genre_index)
+        # (cast id, number of movies) sorted by the number of movies
+        self.top_k_limit = top_k_limit
+        self.top_cast: List[Tuple[int, int]] = self._top_cast((cast_id, len(postings)) for cast_id, postings in service.cast_index.postings.items())
+
+        # cast members by the number of their movies on load, sorted as array indexes (tuples of all of them take longer)
+        cast_ids = array('I', service.cast_index.postings.keys())
+        cast_counts = array('I', map(len, service.cast_index.postings.values()))
+        order = sorted(range(len(cast_ids)), key=cast_counts.__getitem__, reverse=True)
+        # the ones with the most movies have bitsets, (cast id, number of movies) of them sorted by the number of movies;
+        # the others are kept in the order of their numbers of movies on load, those changed since are counted aside
+        self.cast_scan_limit = cast_scan_limit
+        self.cast_candidates: List[Tuple[int, int]] = [(cast_ids[_], cast_counts[_]) for _ in order[:cast_bitsets]]
+        self.cast_bits: Dict[int, int] = {cast_id: to_bitset(service.cast_index.get(cast_id), self.size) for cast_id, _ in self.cast_candidates}
+        self.other_cast_ids = array('I', map(cast_ids.__getitem__, order[cast_bitsets:]))
+        self.other_cast_counts = array('I', map(cast_counts.__getitem__, order[cast_bitsets:]))
+        self.changed_cast_ids: Set[int] = set()
+        # average number of cast members of a movie, the cost of counting over the matching movies
+        self.cast_per_movie = sum(cast_counts) / max(self.size, 1)
+
+    def _bitsets(self, index: PostingIndex) -> Dict:
+        return {value: to_bitset(postings, self.size) for value, postings in index.postings.items()}
+
+    @staticmethod
+    def _count_order(item: Tuple[int, int]) -> Tuple[int, int]:
+        # more movies first, ties by cast id, so every way of counting returns the same top cast
+        return item[1], -item[0]
+
+    def _top_cast(self, counts: Iterable[Tuple[int, int]], top_k: Optional[int] = None) -> List[Tuple[int, int]]:
+        return heapq.nlargest(self.top_k_limit if top_k is None else top_k, counts, key=self._count_order)
+
+    def update(self, replaced: Dict[int, Tuple[Tuple[int, ...], Tuple[int, ...]]], appended: range, cast_ids: Iterable[int]):
+        """
+        Update the bitsets after movies have been changed in place (see MovieTable.upsert):
+        genres and cast bitsets of the replaced movies, years, genres and cast bitsets of the appended ones;
+        top cast and the cast bitset candidates are refreshed with the counts of the given cast ids
+        """
+        table = self.service.movies_list
+        self.size = len(table)
+        self.all_bits = (1 << self.size) - 1
+
+        cast_bits = self.cast_bits
+        for position, (old_cast_ids, old_genre_ids) in replaced.items():
+            bit = 1 << position
+            for genre_id in old_genre_ids:
+                self.genre_bits[genre_id] = self.genre_bits.get(genre_id, 0) & ~bit
+            for genre_id in table.genre_ids[position]:
+                self.genre_bits[genre_id] = self.genre_bits.get(genre_id, 0) | bit
+            for cast_id in old_cast_ids:
+                if cast_id in cast_bits:
+                    cast_bits[cast_id] &= ~bit
+            for cast_id in table.cast_ids[position]:
+                if cast_id in cast_bits:
+                    cast_bits[cast_id] |= bit
+        for position in appended:
+            bit = 1 << position
+            self.year_bits[table.years[position]] = self.year_bits.get(table.years[position], 0) | bit
+            for genre_id in table.genre_ids[position]:
+                self.genre_bits[genre_id] = self.genre_bits.get(genre_id, 0) | bit
+            for cast_id in table.cast_ids[position]:
+                if cast_id in cast_bits:
+                    cast_bits[cast_id] |= bit
+        self.genre_bits = {genre_id: bits for genre_id, bits in self.genre_bits.items() if bits}
+
+        # cast members not in the top list have at most as many movies as its last one, unless they have been changed
+        cast_index = self.service.cast_index
+        lowest = self.top_cast[-1][1] if len(self.top_cast) == self.top_k_limit else 0
+        counts = dict(self.top_cast)
+        counts.update((cast_id, len(cast_index.get(cast_id))) for cast_id in cast_ids)
+        top_cast = self._top_cast((cast_id, count) for cast_id, count in counts.items() if count)
+        if len(top_cast) < self.top_k_limit and lowest or top_cast and top_cast[-1][1] < lowest:
+            # top cast members have fewer movies now, others may take their places
+            top_cast = self._top_cast((cast_id, len(postings)) for cast_id, postings in cast_index.postings.items())
+        self.top_cast = top_cast
+
+        # candidates keep their bitsets, the others are no longer where their number of movies on load placed them
+        candidates = dict(self.cast_candidates)
+        for cast_id in cast_ids:
+            if cast_id in cast_bits:
+                candidates[cast_id] = len(cast_index.get(cast_id))
+            else:
+                self.changed_cast_ids.add(cast_id)
+        self.cast_candidates = sorted(candidates.items(), key=self._count_order, reverse=True)
+
+    def filter_bits(self, query: SearchQuery) -> int:
+        """
+        Bitset of movies matching the query
+        """
+        service = self.service
+        table = service.movies_list
+        title_contains, year, cast, genre = query
+
+        bits = self.all_bits
+        if year != 0:
+            bits &= self.year_bits.get(year, 0)
+        if genre:
+            bits &= self.genre_bits.get(table.genre_names.get_id(genre), 0)
+        if cast:
+            bits &= to_bitset(service.cast_index.get(table.cast_names.get_id(cast)), self.size)
+        if title_contains and bits == self.all_bits:
+            # title substring has no precomputed bitset, evaluate it with the engine
+            bits = to_bitset(service.engine.find_positions(SearchQuery(title_contains, 0, "", "")), self.size)
+        elif title_contains and bits:
+            # confirm title substring on the movies matching the other filters only
+            titles_normalized = table.titles_normalized
+            bits = to_bitset((position for position in iter_bitset(bits) if title_contains in titles_normalized[position]), self.size)
+        return bits
+
+    def count(self, query: SearchQuery, top_k: int) -> Tuple[int, Dict[int, int], Dict[str, int], Dict[str, int]]:
+        """
+        Returns total number of matching movies, counts per year, per genre and of top_k cast members
+        """
+        table = self.service.movies_list
+        bits = self.filter_bits(query)
+        total = bits.bit_count()
+
+        years = {year: count for year, year_bits in sorted(self.year_bits.items())
+                 if (count := (bits & year_bits).bit_count())}
+        genres = {table.genre_names.decode(genre_id): count for genre_id, genre_bits in self.genre_bits.items()
+                  if (count := (bits & genre_bits).bit_count())}
+        genres = dict(sorted(genres.items(), key=lambda _: (-_[1], _[0])))
+
+        if bits == self.all_bits:
+            top_cast = self.top_cast[:top_k]
+        else:
+            top_cast = self.count_top_cast(bits, total, top_k) if total > self.cast_scan_limit else None
+            if top_cast is None:
+                counter = Counter(itertools.chain.from_iterable(map(table.cast_ids.__getitem__, iter_bitset(bits))))
+                top_cast = self._top_cast(counter.items(), top_k)
+        cast = {table.cast_names.decode(cast_id): count for cast_id, count in top_cast}
+
+        return total, years, genres, cast
+
+    def count_top_cast(self, bits: int, total: int, top_k: int) -> Optional[List[Tuple[int, int]]]:
+        """
+        Top cast of the total movies of the bitset, counted for the cast members from the most movies down
+        until the next one has fewer movies than the top_k-th count, none of the rest can take its place:
+        popcounts of the cast bitsets ANDed with the bitset, then look-ups of the other cast members' movies in the bitset digits.
+        Returns None once more movies would be looked up than there are cast ids of the matching movies to count over.
+        """
+        if top_k <= 0:
+            return []
+        # (count, -cast id) of the top cast so far, the top_k-th first
+        top: List[Tuple[int, int]] = []
+
+        def add(cast_id: int, count: int):
+            if not count:
+                return
+            if len(top) < top_k:
+                heapq.heappush(top, (count, -cast_id))
+            elif (count, -cast_id) > top[0]:
+                heapq.heapreplace(top, (count, -cast_id))
+
+        def result() -> List[Tuple[int, int]]:
+            return [(-negative_id, count) for count, negative_id in sorted(top, reverse=True)]
+
+        for cast_id, movies in self.cast_candidates:
+            if len(top) == top_k and movies < top[0][0]:
+                break
+            add(cast_id, (bits & self.cast_bits[cast_id]).bit_count())
+
+        # the other cast members had at most as many movies as the candidates on load, those changed since may have more
+        cast_index = self.service.cast_index
+        changed = self.changed_cast_ids
+        if len(top) == top_k and not changed and (not self.other_cast_counts or self.other_cast_counts[0] < top[0][0]):
+            return result()
+        flags = bin(bits)[:1:-1].encode().translate(BIT_FLAGS).ljust(self.size, b"\0")
+        budget = total * self.cast_per_movie
+
+        def look_up(cast_id: int) -> bool:
+            nonlocal budget
+            postings = cast_index.get(cast_id)
+            budget -= len(postings)
+            add(cast_id, sum(map(flags.__getitem__, postings)))
+            return budget >= 0
+
+        for cast_id in changed:
+            if not (len(top) == top_k and len(cast_index.get(cast_id)) < top[0][0]) and not look_up(cast_id):
+                return None
+        for cast_id, movies in zip(self.other_cast_ids, self.other_cast_counts):
+            if len(top) == top_k and movies < top[0][0]:
+                break
+            if cast_id not in changed and not look_up(cast_id):
+                return None
+        return result()
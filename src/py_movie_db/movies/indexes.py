@@ -0,0 +1,106 @@
+"""
+Inverted indexes over the movies list
+"""
+import itertools
+from array import array
+from bisect import bisect_left
+from typing import Dict, Hashable, Iterator, List, Optional, Set
+
+# positions are stored as compact unsigned int arrays, sorted ascending
+POSITION_TYPECODE = 'I'
+EMPTY_POSTINGS = array(POSITION_TYPECODE)
+
+
+class PostingIndex:
+    """
+    Maps a value (year, cast member, genre) to the sorted positions of movies having it
+    """
+
+    def __init__(self):
+        self.postings: Dict[Hashable, array] = {}
+
+    def add(self, value: Hashable, position: int):
+        # positions are added in the movies list order, so posting lists stay sorted
+        postings = self.postings.get(value)
+        if postings is None:
+            postings = self.postings[value] = array(POSITION_TYPECODE)
+        postings.append(position)
+
+    def insert(self, value: Hashable, position: int):
+        """
+        Add a position anywhere in the movies list (e.g. of a movie replaced in place), keeping the posting list sorted
+        """
+        postings = self.postings.get(value)
+        if postings is None:
+            postings = self.postings[value] = array(POSITION_TYPECODE)
+        offset = bisect_left(postings, position)
+        if offset == len(postings) or postings[offset] != position:
+            postings.insert(offset, position)
+
+    def remove(self, value: Hashable, position: int):
+        postings = self.postings.get(value)
+        if postings is None:
+            return
+        offset = bisect_left(postings, position)
+        if offset < len(postings) and postings[offset] == position:
+            del postings[offset]
+        if not postings:
+            del self.postings[value]
+
+    def get(self, value: Hashable) -> array:
+        return self.postings.get(value, EMPTY_POSTINGS)
+
+    def __len__(self):
+        return len(self.postings)
+
+
+def intersect_postings(postings: List[array], start: int = 0) -> Iterator[int]:
+    """
+    Lazily intersect sorted posting lists, skipping positions below start.
+    Candidates are taken from the smallest list and probed in the others using bisect,
+    so the cost is proportional to the size of the most selective predicate.
+    Positions are yielded in ascending order, i.e. in the movies list order.
+    """
+    postings = sorted(postings, key=len)
+    smallest, others = postings[0], postings[1:]
+    # search offsets only move forward as candidates are ascending
+    offsets = [bisect_left(other, start) for other in others]
+
+    for position in itertools.islice(smallest, bisect_left(smallest, start), None):
+        for i, other in enumerate(others):
+            offset = bisect_left(other, position, offsets[i])
+            if offset == len(other):
+                # no larger positions left in this list, nothing else can match
+                return
+            offsets[i] = offset
+            if other[offset] != position:
+                break
+        else:
+            yield position
+
+
+class TrigramIndex(PostingIndex):
+    """
+    Maps character trigrams of normalized titles to the sorted positions of movies containing them.
+    Intersection of trigram posting lists gives candidates for the substring search,
+    which still have to be confirmed with the real substring check.
+    """
+
+    GRAM_SIZE = 3
+
+    @staticmethod
+    def trigrams(text: str) -> Set[str]:
+        return {text[i:i + TrigramIndex.GRAM_SIZE] for i in range(len(text) - TrigramIndex.GRAM_SIZE + 1)}
+
+    def add_text(self, text: str, position: int):
+        for trigram in self.trigrams(text):
+            self.add(trigram, position)
+
+    def lookup(self, substring: str) -> Optional[List[array]]:
+        """
+        Posting lists of all trigrams of the substring,
+        None if the substring is too short to be served by the index
+        """
+        if len(substring) < self.GRAM_SIZE:
+            return None
+        return [self.get(trigram) for trigram in self.trigrams(substring)]
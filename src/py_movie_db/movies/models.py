@@ -0,0 +1,94 @@
+"""
+Movie records and search responses as returned by the API
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+
+@dataclass
+class Movie:
+    title: str
+    title_normalized: str
+    year: int
+    cast: Set[str]
+    genres: Set[str]
+
+    @staticmethod
+    def normalize_title(title: str) -> str:
+        return title.lower()
+
+    @staticmethod
+    def from_json_dict(item: Dict):
+        return Movie(
+            title=item["title"],
+            title_normalized=Movie.normalize_title(item["title"]),
+            year=item["year"],
+            cast=set(item["cast"]),
+            genres=set(item["genres"])
+        )
+
+
+@dataclass
+class SearchResponse:
+    items: List[Movie]
+    page: int
+    size: int
+    has_more: bool
+    cursor: Optional[str] = None
+
+
+@dataclass
+class SearchRequest:
+    """
+    Search parameters, see find_movies
+    """
+    title_contains: str = ""
+    year: int = 0
+    cast: str = ""
+    genre: str = ""
+    page: int = 0
+    page_size: int = 10
+    cursor: str = ""
+
+
+@dataclass
+class FacetsResponse:
+    """
+    Number of movies matching the search filters: total, per year, per genre and of the top cast members
+    """
+    total: int
+    years: Dict[int, int]
+    genres: Dict[str, int]
+    cast: Dict[str, int]
+
+
+@dataclass
+class SuggestResponse:
+    """
+    Titles or cast names starting with the prefix, best first
+    """
+    items: List[str]
+
+
+@dataclass
+class ExplainStep:
+    """
+    Plan step: index (posting list), scan (full pass over a column) or filter (check of the candidates)
+    """
+    predicate: str
+    access: str
+    estimated_rows: int
+    actual_rows: int
+
+
+@dataclass
+class ExplainResponse:
+    """
+    Query plan chosen by the planner with estimated and actual number of rows after each step
+    """
+    strategy: str
+    steps: List[ExplainStep]
+    estimated_cost: float
+    estimated_rows: int
+    actual_rows: int
+    elapsed_ms: float
@@ -0,0 +1,245 @@
+"""
+Compact columnar storage of movies
+"""
+import itertools
+import sys
+from array import array
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from movies.models import Movie
+from movies.responses import encode_json
+
+
+class StringDictionary:
+    """
+    Shared dictionary of strings (cast members, genres) - maps strings to integer ids and back
+    """
+
+    def __init__(self):
+        self.strings: List[str] = []
+        self.ids: Dict[str, int] = {}
+
+    @staticmethod
+    def from_strings(strings: List[str]) -> "StringDictionary":
+        dictionary = StringDictionary()
+        dictionary.strings = [sys.intern(_) for _ in strings]
+        dictionary.ids = {value: value_id for value_id, value in enumerate(dictionary.strings)}
+        return dictionary
+
+    def encode(self, value: str) -> int:
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.strings)
+            self.strings.append(sys.intern(value))
+        return value_id
+
+    def get_id(self, value: str) -> Optional[int]:
+        """
+        Id of the string or None if the string is unknown
+        """
+        return self.ids.get(value)
+
+    def decode(self, value_id: int) -> str:
+        return self.strings[value_id]
+
+    def __len__(self):
+        return len(self.strings)
+
+
+class MovieTable(Sequence):
+    """
+    Movies stored as parallel columns, position in the columns is the movie position in the list:
+    - titles, titles_normalized: lists of strings
+    - years: compact unsigned short array
+    - cast_ids, genre_ids: tuples of ids into the shared cast and genre dictionaries,
+      identical tuples are shared between movies (e.g. most movies have one of few genre combinations)
+
+    Indexing the table materializes a Movie record, this is meant to be done only for returned results.
+    """
+
+    def __init__(self):
+        self.titles: List[str] = []
+        self.titles_normalized: List[str] = []
+        self.years = array('H')
+        self.cast_ids: List[Tuple[int, ...]] = []
+        self.genre_ids: List[Tuple[int, ...]] = []
+        self.cast_names = StringDictionary()
+        self.genre_names = StringDictionary()
+        # json of recently returned movies as returned by the API, see json_fragment
+        self.json_fragments: "OrderedDict[int, bytes]" = OrderedDict()
+        self.json_fragments_max_size = 0
+        # load-time cache to share identical id tuples
+        self._id_tuples: Dict[Tuple[int, ...], Tuple[int, ...]] = {}
+
+    def append(self, title: str, year: int, cast: Iterable[str], genres: Iterable[str]):
+        title_normalized = Movie.normalize_title(title)
+        self.titles.append(title)
+        # share the string if normalization did not change it
+        self.titles_normalized.append(title if title_normalized == title else title_normalized)
+        self.years.append(year)
+        self.cast_ids.append(self._share(tuple(dict.fromkeys(self.cast_names.encode(_) for _ in cast))))
+        self.genre_ids.append(self._share(tuple(dict.fromkeys(self.genre_names.encode(_) for _ in genres))))
+
+    def append_columns(self, titles: List[str], years: array, cast_ids: Iterable[Tuple[int, ...]], genre_ids: Iterable[Tuple[int, ...]]):
+        """
+        Append already dictionary-encoded movies, ids refer to the table dictionaries
+        """
+        normalize_title = Movie.normalize_title
+        self.titles.extend(titles)
+        self.titles_normalized.extend(title if title == title_normalized else title_normalized
+                                      for title, title_normalized in zip(titles, map(normalize_title, titles)))
+        self.years.extend(years)
+        self.cast_ids.extend(map(self._share, cast_ids))
+        self.genre_ids.extend(map(self._share, genre_ids))
+
+    def extend(self, other: "MovieTable"):
+        """
+        Append movies of another table (e.g. a snapshot shard), ids are re-encoded into the table dictionaries
+        """
+        cast_ids = [self.cast_names.encode(_) for _ in other.cast_names.strings]
+        genre_ids = [self.genre_names.encode(_) for _ in other.genre_names.strings]
+        # id tuples are shared in the other table too, re-encode every distinct tuple once
+        remapped: Dict[Tuple[int, ...], Tuple[int, ...]] = {}
+
+        def remap(ids: Tuple[int, ...], mapping: List[int]) -> Tuple[int, ...]:
+            new_ids = remapped.get(ids)
+            if new_ids is None:
+                new_ids = remapped[ids] = self._share(tuple(mapping[_] for _ in ids))
+            return new_ids
+
+        self.titles.extend(other.titles)
+        self.titles_normalized.extend(other.titles_normalized)
+        self.years.extend(other.years)
+        self.cast_ids.extend(remap(_, cast_ids) for _ in other.cast_ids)
+        remapped.clear()
+        self.genre_ids.extend(remap(_, genre_ids) for _ in other.genre_ids)
+
+    def upsert(self, other: "MovieTable", candidates: Optional[Callable[[str, int], Iterable[int]]] = None) \
+            -> Tuple[Dict[int, Tuple[Tuple[int, ...], Tuple[int, ...]]], range]:
+        """
+        Apply movies of another table (e.g. a delta segment) with last-writer-wins semantics:
+        a movie replaces the one with the same title and year in place (the last one, if there are several, as the indexer does),
+        other movies are appended in their order. Of several movies with the same title and year in the other table the last one is applied.
+        Positions of the other movies do not change, as title and year are the same only cast and genres of a replaced movie change.
+
+        :param candidates: positions which may hold the movie of the title and year (e.g. found by indexes),
+            all the movies are scanned if not given
+        :returns: the replaced positions with their previous cast and genre ids, and the range of appended positions
+        """
+        return self.apply_upserts(other, *self.locate_upserts(other, candidates))
+
+    def locate_upserts(self, other: "MovieTable", candidates: Optional[Callable[[str, int], Iterable[int]]] = None) \
+            -> Tuple[Dict[int, int], List[int]]:
+        """
+        First step of upsert, which only reads the table: finds the positions replaced by movies of the other table.
+        Returns the other table positions of the replacing movies by the replaced positions, and of the appended movies in their order
+        """
+        latest: Dict[Tuple[str, int], int] = {}
+        for position, key in enumerate(zip(other.titles, other.years)):
+            latest[key] = position
+        titles = {title for title, _ in latest}
+
+        # titles are checked first, so only the rows with an upserted title build a key, from the end so the last duplicate is replaced
+        years = self.years
+        if candidates is None:
+            positions = (position for position in range(len(self.titles) - 1, -1, -1) if self.titles[position] in titles)
+        else:
+            positions = sorted(set(itertools.chain.from_iterable(candidates(title, year) for title, year in latest)), reverse=True)
+        replacing = {}
+        for position in positions:
+            if self.titles[position] in titles:
+                other_position = latest.pop((self.titles[position], years[position]), None)
+                if other_position is not None:
+                    replacing[position] = other_position
+        return replacing, sorted(latest.values())
+
+    def apply_upserts(self, other: "MovieTable", replacing: Dict[int, int], appending: List[int]) \
+            -> Tuple[Dict[int, Tuple[Tuple[int, ...], Tuple[int, ...]]], range]:
+        """
+        Second step of upsert, with the positions found by locate_upserts (the table must not have changed since)
+        """
+        cast_ids = [self.cast_names.encode(_) for _ in other.cast_names.strings]
+        genre_ids = [self.genre_names.encode(_) for _ in other.genre_names.strings]
+
+        def encode_ids(other_position: int) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+            return (self._share(tuple(cast_ids[_] for _ in other.cast_ids[other_position])),
+                    self._share(tuple(genre_ids[_] for _ in other.genre_ids[other_position])))
+
+        replaced = {}
+        for position, other_position in replacing.items():
+            replaced[position] = self.cast_ids[position], self.genre_ids[position]
+            # title and year are the same, only the ids change
+            self.cast_ids[position], self.genre_ids[position] = encode_ids(other_position)
+
+        # rows are encoded before any column grows, so the appended rows are complete when readers
+        # on other threads (the shadow comparator) can reach them, titles are the last, as the table length
+        appended_ids = [encode_ids(_) for _ in appending]
+        appended = range(len(self.titles), len(self.titles) + len(appending))
+        self.years.extend([other.years[_] for _ in appending])
+        self.cast_ids.extend([ids[0] for ids in appended_ids])
+        self.genre_ids.extend([ids[1] for ids in appended_ids])
+        self.titles_normalized.extend([other.titles_normalized[_] for _ in appending])
+        self.titles.extend([other.titles[_] for _ in appending])
+        return replaced, appended
+
+    def _share(self, ids: Tuple[int, ...]) -> Tuple[int, ...]:
+        return self._id_tuples.setdefault(ids, ids)
+
+    def finish_loading(self):
+        """
+        Drop load-time structures
+        """
+        self._id_tuples = {}
+
+    def encode_json_fragment(self, position: int) -> bytes:
+        cast_names = self.cast_names.strings
+        genre_names = self.genre_names.strings
+        return encode_json({
+            "title": self.titles[position],
+            "title_normalized": self.titles_normalized[position],
+            "year": self.years[position],
+            "cast": [cast_names[_] for _ in self.cast_ids[position]],
+            "genres": [genre_names[_] for _ in self.genre_ids[position]],
+        })
+
+    def json_fragment(self, position: int) -> bytes:
+        """
+        Json of the movie, the last json_fragments_max_size returned ones are kept encoded
+        (every movie would cost ~2x the memory of the table)
+        """
+        fragment = self.json_fragments.get(position)
+        if fragment is not None:
+            self.json_fragments.move_to_end(position)
+            return fragment
+        fragment = self.encode_json_fragment(position)
+        if self.json_fragments_max_size > 0:
+            self.json_fragments[position] = fragment
+            if len(self.json_fragments) > self.json_fragments_max_size:
+                self.json_fragments.popitem(last=False)
+        return fragment
+
+    @staticmethod
+    def from_json_dicts(items: Iterable[Dict]) -> "MovieTable":
+        table = MovieTable()
+        for item in items:
+            table.append(item["title"], item["year"], item["cast"], item["genres"])
+        table.finish_loading()
+        return table
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[_] for _ in range(*position.indices(len(self)))]
+
+        cast_names = self.cast_names.strings
+        genre_names = self.genre_names.strings
+        return Movie(
+            title=self.titles[position],
+            title_normalized=self.titles_normalized[position],
+            year=self.years[position],
+            cast={cast_names[_] for _ in self.cast_ids[position]},
+            genres={genre_names[_] for _ in self.genre_ids[position]}
+        )
@@ -0,0 +1,259 @@
+"""
+Statistics-based query planner - chooses between an index lookup and the full scan
+and orders the predicates by estimated selectivity
+"""
+import itertools
+import operator
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+# relative costs per movie of:
+# a sequential pass over a column (evaluated in C by map/compress)
+SCAN_ROW_COST = 0.25
+# iterating a posting list
+INDEX_ROW_COST = 0.5
+# checking a predicate of a candidate position (python call)
+FILTER_ROW_COST = 1.0
+
+SCAN = "scan"
+INDEX = "index"
+FILTER = "filter"
+EMPTY = "empty"
+
+
+class Statistics:
+    """
+    Cardinality statistics collected on load:
+    movies per year, per genre and per cast member, title trigram frequencies (posting list sizes),
+    distribution of title lengths and number of titles containing each character
+    """
+
+    def __init__(self, service):
+        table = service.movies_list
+        self.movies = len(table)
+        self.year_counts = {year: len(postings) for year, postings in service.year_index.postings.items()}
+        self.genre_counts = {genre_id: len(postings) for genre_id, postings in service.genre_index.postings.items()}
+        self.cast_counts = {cast_id: len(postings) for cast_id, postings in service.cast_index.postings.items()}
+        self.title_index = service.title_index
+
+        # titles_at_least[n] - number of titles having at least n characters
+        length_counts = Counter(map(len, table.titles_normalized))
+        self.titles_at_least = array('I', [0] * (max(length_counts, default=0) + 1))
+        total = 0
+        for length in range(len(self.titles_at_least) - 1, -1, -1):
+            total += length_counts.get(length, 0)
+            self.titles_at_least[length] = total
+
+        self.char_counts = Counter(itertools.chain.from_iterable(map(set, table.titles_normalized)))
+
+    def update(self, service, years: Iterable[int], genre_ids: Iterable[int], cast_ids: Iterable[int], appended_titles: Iterable[str]):
+        """
+        Refresh the statistics after movies have been changed in place: counts of the given values and titles of appended movies
+        """
+        self.movies = len(service.movies_list)
+        for counts, index, values in ((self.year_counts, service.year_index, years), (self.genre_counts, service.genre_index, genre_ids),
+                                      (self.cast_counts, service.cast_index, cast_ids)):
+            for value in values:
+                count = len(index.get(value))
+                if count:
+                    counts[value] = count
+                else:
+                    counts.pop(value, None)
+
+        for title_normalized in appended_titles:
+            if len(title_normalized) >= len(self.titles_at_least):
+                self.titles_at_least.extend([0] * (len(title_normalized) + 1 - len(self.titles_at_least)))
+            for length in range(len(title_normalized) + 1):
+                self.titles_at_least[length] += 1
+            self.char_counts.update(set(title_normalized))
+
+    def estimate_title(self, title_contains: str) -> float:
+        """
+        Estimated number of titles containing the substring:
+        the rarest trigram for substrings served by the trigram index,
+        otherwise frequencies of the characters assuming independence
+        """
+        if len(title_contains) >= len(self.titles_at_least):
+            return 0
+        rows = self.titles_at_least[len(title_contains)]
+
+        postings = self.title_index.lookup(title_contains)
+        if postings is not None:
+            return min([rows] + [len(_) for _ in postings])
+        for char in set(title_contains):
+            rows *= self.char_counts.get(char, 0) / self.movies
+        return rows
+
+
+class Predicate(NamedTuple):
+    """
+    Search condition: test(column[position], value) is true for matching movies
+    """
+    description: str
+    column: Sequence
+    test: Callable[[Any, Any], bool]
+    value: Any
+    estimated_rows: float
+    # sorted positions to drive the index plan
+    postings: Optional[array]
+    # postings are exactly the matches, otherwise candidates (the rarest trigram of the title)
+    exact_postings: bool = True
+
+
+class PlanStep(NamedTuple):
+    description: str
+    access: str
+    estimated_rows: float
+
+
+class QueryPlan:
+    """
+    Plan of a query:
+    - index: iterate the posting list of the most selective indexed predicate, check the remaining predicates
+    - scan: sequential pass over the column of the most selective predicate, check the remaining predicates
+    - empty: some predicate matches no movies
+    Remaining predicates are checked in ascending order of estimated rows.
+    """
+
+    def __init__(self, strategy: str, steps: List[PlanStep], driver: Optional[Predicate], filters: List[Predicate],
+                 movies: int, cost: float):
+        self.strategy = strategy
+        self.steps = steps
+        self.driver = driver
+        self.filters = filters
+        self.movies = movies
+        self.cost = cost
+
+    @property
+    def estimated_rows(self) -> float:
+        return self.steps[-1].estimated_rows if self.steps else self.movies
+
+    def scanned_rows(self, start: int = 0) -> int:
+        """
+        Rows read by the access path if the plan runs to the end:
+        the posting list of the index plan, movies from the start position for the scan
+        """
+        if self.strategy == INDEX:
+            postings = self.driver.postings
+            return len(postings) - bisect_left(postings, start)
+        if self.strategy == SCAN:
+            return max(self.movies - start, 0)
+        return 0
+
+    def execute(self, start: int = 0, counts: Optional[List[int]] = None) -> Iterator[int]:
+        """
+        Positions of matching movies from the start position in the movies list order.
+        If counts are passed, rows produced by each step are counted into them (see explain).
+        """
+        if self.strategy == EMPTY:
+            return iter(())
+
+        filters = self.filters
+        if self.strategy == INDEX:
+            postings = self.driver.postings
+            positions = itertools.islice(postings, bisect_left(postings, start), None)
+        elif filters:
+            first, filters = filters[0], filters[1:]
+            positions = itertools.compress(itertools.count(start),
+                                           map(first.test, itertools.islice(first.column, start, None), itertools.repeat(first.value)))
+        else:
+            positions = iter(range(start, self.movies))
+
+        step = 0
+        if counts is not None:
+            positions = counted(positions, counts, step)
+        for predicate in filters:
+            positions = filter(lambda position, column=predicate.column, test=predicate.test, value=predicate.value: test(column[position], value),
+                               positions)
+            step += 1
+            if counts is not None:
+                positions = counted(positions, counts, step)
+        return positions
+
+
+def counted(positions: Iterator[int], counts: List[int], step: int) -> Iterator[int]:
+    for position in positions:
+        counts[step] += 1
+        yield position
+
+
+class QueryPlanner:
+    """
+    Picks the cheapest plan using load time statistics, estimates of combined predicates assume independence
+    """
+
+    def __init__(self, service, statistics: Statistics):
+        self.service = service
+        self.statistics = statistics
+
+    def predicates(self, query: Tuple[str, int, str, str]) -> List[Predicate]:
+        title_contains, year, cast, genre = query
+        service = self.service
+        table = service.movies_list
+        statistics = self.statistics
+
+        predicates = []
+        if title_contains:
+            trigram_postings = service.title_index.lookup(title_contains)
+            predicates.append(Predicate(f"title contains '{title_contains}'", table.titles_normalized, operator.contains, title_contains,
+                                        statistics.estimate_title(title_contains), min(trigram_postings, key=len) if trigram_postings else None,
+                                        exact_postings=False))
+        if year != 0:
+            predicates.append(Predicate(f"year = {year}", table.years, operator.eq, year,
+                                        statistics.year_counts.get(year, 0), service.year_index.get(year)))
+        if cast:
+            cast_id = table.cast_names.get_id(cast)
+            predicates.append(Predicate(f"cast has '{cast}'", table.cast_ids, operator.contains, cast_id,
+                                        statistics.cast_counts.get(cast_id, 0), service.cast_index.get(cast_id)))
+        if genre:
+            genre_id = table.genre_names.get_id(genre)
+            predicates.append(Predicate(f"genre has '{genre}'", table.genre_ids, operator.contains, genre_id,
+                                        statistics.genre_counts.get(genre_id, 0), service.genre_index.get(genre_id)))
+        return sorted(predicates, key=lambda _: _.estimated_rows)
+
+    def plan(self, query: Tuple[str, int, str, str]) -> QueryPlan:
+        movies = self.statistics.movies
+        predicates = self.predicates(query)
+
+        if movies == 0 or any(_.estimated_rows == 0 for _ in predicates):
+            return QueryPlan(EMPTY, [PlanStep(_.description, EMPTY, 0) for _ in predicates], None, [], movies, 0)
+
+        plans = [self.scan_plan(predicates, movies)]
+        for driver in predicates:
+            if driver.postings is not None:
+                plans.append(self.index_plan(driver, predicates, movies))
+        return min(plans, key=lambda _: _.cost)
+
+    @staticmethod
+    def scan_plan(predicates: List[Predicate], movies: int) -> QueryPlan:
+        steps = []
+        rows = movies
+        cost = movies * SCAN_ROW_COST
+        for i, predicate in enumerate(predicates):
+            if i > 0:
+                cost += rows * FILTER_ROW_COST
+            rows *= predicate.estimated_rows / movies
+            steps.append(PlanStep(predicate.description, SCAN if i == 0 else FILTER, rows))
+        return QueryPlan(SCAN, steps, None, predicates, movies, cost)
+
+    @staticmethod
+    def index_plan(driver: Predicate, predicates: List[Predicate], movies: int) -> QueryPlan:
+        rows = len(driver.postings)
+        cost = rows * INDEX_ROW_COST
+        steps = [PlanStep(driver.description if driver.exact_postings else driver.description + " (trigram candidates)", INDEX, rows)]
+        filters = []
+        for predicate in predicates:
+            if predicate is driver:
+                if predicate.exact_postings:
+                    continue
+                # candidates of the title index still have to be confirmed by the substring check
+                selectivity = min(predicate.estimated_rows / rows, 1)
+            else:
+                selectivity = predicate.estimated_rows / movies
+            cost += rows * FILTER_ROW_COST
+            rows *= selectivity
+            steps.append(PlanStep(predicate.description, FILTER, rows))
+            filters.append(predicate)
+        return QueryPlan(INDEX, steps, driver, filters, movies, cost)
@@ -0,0 +1,61 @@
+"""
+Pre-serialized search response bodies
+"""
+import gzip
+import json
+from typing import Callable, Dict, List, Optional
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+IDENTITY = "identity"
+
+# compressors in the order of preference
+COMPRESSORS: Dict[str, Callable[[bytes], bytes]] = {}
+if brotli is not None:
+    COMPRESSORS["br"] = lambda body: brotli.compress(body, quality=5)
+COMPRESSORS["gzip"] = lambda body: gzip.compress(body, compresslevel=6, mtime=0)
+
+
+def encode_json(value) -> bytes:
+    # same format as fastapi JSONResponse
+    return json.dumps(value, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_search_response(item_fragments: List[bytes], page: int, size: int, has_more: bool, cursor: Optional[str]) -> bytes:
+    """
+    SearchResponse json assembled from pre-encoded movie fragments
+    """
+    return b"".join((
+        b'{"items":[', b",".join(item_fragments),
+        b'],"page":', encode_json(page),
+        b',"size":', encode_json(size),
+        b',"has_more":', encode_json(has_more),
+        b',"cursor":', encode_json(cursor),
+        b"}",
+    ))
+
+
+def choose_encoding(accept_encoding: str) -> str:
+    """
+    Preferred supported content encoding accepted by the client, q-values other than q=0 are not ranked
+    """
+    accepted = set()
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip().lower())
+
+    for encoding in COMPRESSORS:
+        if encoding in accepted or "*" in accepted:
+            return encoding
+    return IDENTITY
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == IDENTITY:
+        return body
+    return COMPRESSORS[encoding](body)
@@ -0,0 +1,112 @@
+"""
+Whole-query result cache
+"""
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Callable, Hashable, Optional, Tuple, Union
+
+from app.config import RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_BYTES
+from utils.perf_tools import perf_counters
+
+CachedValue = Union[array, bytes]
+
+# approximate memory overhead of a cache entry (key tuple, strings, ordered dict node)
+ENTRY_OVERHEAD_BYTES = 256
+
+
+class ResultCache:
+    """
+    Caches the full ordered list of matching positions per query, so every page of the query is served from one entry.
+    Values are arrays or bytes (e.g. encoded responses).
+    - LRU eviction when the total size goes over the byte budget
+    - entries expire after the TTL
+    - the cache is cleared when the data snapshot version changes
+
+    Counters: <name>_hit, <name>_miss, <name>_eviction, <name>_expired, <name>_invalidated
+    """
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_MAX_BYTES, ttl: float = RESULT_CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic, name: str = "result_cache"):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.version: Optional[str] = None
+        self.size_bytes = 0
+        self.entries: "OrderedDict[Hashable, Tuple[float, CachedValue]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(value: CachedValue) -> int:
+        return ENTRY_OVERHEAD_BYTES + memoryview(value).nbytes
+
+    def _check_version(self, version: str):
+        if version != self.version:
+            self.entries.clear()
+            self.size_bytes = 0
+            self.version = version
+
+    def get(self, key: Hashable, version: str) -> Optional[CachedValue]:
+        with self.lock:
+            self._check_version(version)
+            entry = self.entries.get(key)
+            if entry is None:
+                perf_counters.count(self.name + "_miss")
+                return None
+
+            expires_at, value = entry
+            if expires_at <= self.clock():
+                self._remove(key)
+                perf_counters.count(self.name + "_expired")
+                perf_counters.count(self.name + "_miss")
+                return None
+
+            self.entries.move_to_end(key)
+            perf_counters.count(self.name + "_hit")
+            return value
+
+    def put(self, key: Hashable, version: str, value: CachedValue):
+        size = self.entry_size(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            self._check_version(version)
+            if key in self.entries:
+                self._remove(key)
+
+            while self.entries and self.size_bytes + size > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                perf_counters.count(self.name + "_eviction")
+
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.size_bytes += size
+
+    def invalidate(self, version: str, predicate: Callable[[Hashable], bool]) -> int:
+        """
+        Remove entries of the data version whose key matches the predicate (e.g. queries matching changed movies),
+        returns the number of removed entries
+        """
+        with self.lock:
+            if version != self.version:
+                return 0
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                self._remove(key)
+        perf_counters.count(self.name + "_invalidated", len(keys))
+        return len(keys)
+
+    def _remove(self, key: Hashable):
+        _, value = self.entries.pop(key)
+        self.size_bytes -= self.entry_size(value)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# shared between data reloads, entries of the previous snapshot are dropped on the version change
+result_cache = ResultCache()
+# final response bodies per page and content encoding
+response_cache = ResultCache(max_bytes=RESPONSE_CACHE_MAX_BYTES, name="response_cache")
@@ -1,45 +1,51 @@
+import bisect
 import sys
-import functools
 import itertools
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
-from app.config import AWS_ENDPOINT_URL, AWS_STORAGE_BUCKET_NAME
+from app.config import AWS_ENDPOINT_URL, AWS_STORAGE_BUCKET_NAME, BINARY_SNAPSHOT_KEY, MAX_FACET_TOP_K, MAX_SUGGEST_TOP_K, SEARCH_ENGINE, SHADOW_SEARCH_ENGINE, \
+    SHADOW_SAMPLE_RATE, SNAPSHOT_LOAD_WORKERS, SNAPSHOT_MANIFEST_KEY, SNAPSHOT_SEGMENT_PREFIX, SNAPSHOT_SHARD_PREFIX, CHANGELOG_PREFIX, \
+    MAIN_DB_POINTER_KEY, MAIN_DB_PREFIX, JSON_FRAGMENT_CACHE_SIZE, FACET_CAST_BITSETS, FACET_CAST_SCAN_LIMIT
+from movies.changelog import read_changelog_version
+from movies.compression import iter_decompressed, iter_verified
+from movies.cursor import encode_cursor, decode_cursor
+from movies.engines import SEARCH_ENGINES, SearchQuery
+from movies.facets import FacetIndex
+from movies.indexes import POSITION_TYPECODE, PostingIndex, TrigramIndex
+from movies.json_stream import iter_json_array
+from movies.models import ExplainResponse, ExplainStep, FacetsResponse, Movie, SearchRequest, SearchResponse, SuggestResponse
+from movies.movie_table import MovieTable
+from movies.planner import QueryPlanner, Statistics
+from movies.responses import IDENTITY, compress, encode_search_response
+from movies.result_cache import ResultCache, result_cache as shared_result_cache, response_cache as shared_response_cache
+from movies.shadow import ShadowComparator
+from movies.slow_query_log import SlowQuery, SlowQueryLog, slow_query_log as shared_slow_query_log
+from movies.snapshot import SnapshotFormatError, decode_snapshot
+from movies.suggest import PrefixVocabulary
 from utils.perf_tools import measure_time_elapsed
-from dataclasses import dataclass
 import json
-from typing import Iterable, List, Dict, Set, Optional
+from typing import Iterable, Iterator, List, Dict, Set, Optional, Tuple
 
+# size of chunks the json db is read from the S3 stream in
+JSON_CHUNK_SIZE = 64 * 1024
+# applying more changed movies clears the result caches, checking every cached query against them would cost more than recomputing
+MAX_SELECTIVE_INVALIDATION = 1000
 
-@dataclass
-class Movie:
-    title: str
-    title_normalized: str
-    year: int
-    cast: Set[str]
-    genres: Set[str]
 
-    @staticmethod
-    def normalize_title(title: str) -> str:
-        return title.lower()
+def segmented_version(version: str, segment_key: str) -> str:
+    return f"{version}+{segment_key}"
 
-    @staticmethod
-    def from_json_dict(item: Dict):
-        return Movie(
-            title=item["title"],
-            title_normalized=Movie.normalize_title(item["title"]),
-            year=item["year"],
-            cast=set(item["cast"]),
-            genres=set(item["genres"])
-        )
 
-
-@dataclass
-class SearchResponse:
-    items: List[Movie]
-    page: int
-    size: int
-    has_more: bool
+def is_missing(error: ClientError) -> bool:
+    # get_object reports NoSuchKey, head_object (a response without a body) only the status
+    return error.response.get('Error', {}).get('Code') in ("NoSuchKey", "404")
 
 
 class SearchService:
@@ -63,30 +69,364 @@ class SearchService:
                 dct[sys.intern(k)] = v
         return dct
 
-    def __init__(self, s3=None):
+    def __init__(self, s3=None, engine: str = SEARCH_ENGINE, shadow_engine: str = SHADOW_SEARCH_ENGINE,
+                 result_cache: Optional[ResultCache] = None, response_cache: Optional[ResultCache] = None,
+                 slow_query_log: Optional[SlowQueryLog] = None):
+        self.result_cache = shared_result_cache if result_cache is None else result_cache
+        self.response_cache = shared_response_cache if response_cache is None else response_cache
+        self.slow_query_log = shared_slow_query_log if slow_query_log is None else slow_query_log
+        # incremented before and after a change is applied in place, see apply_located_upserts
+        self.change_sequence = 0
         self.movies_list = self.load_file(s3)
+        self.build_indexes()
+        self.build_statistics()
+        self.build_facets()
+        self.build_suggestions()
+        self.movies_list.json_fragments_max_size = JSON_FRAGMENT_CACHE_SIZE
 
-    @measure_time_elapsed
-    def load_file(self, s3) -> List[Movie]:
+        self.engine = SEARCH_ENGINES[engine](self)
+        self.shadow: Optional[ShadowComparator] = None
+        if shadow_engine:
+            self.shadow = ShadowComparator(self, self.engine, SEARCH_ENGINES[shadow_engine](self), SHADOW_SAMPLE_RATE)
+
+    @staticmethod
+    def select_snapshot(s3) -> Dict:
+        """
+        Snapshot to load data from, found by reading known keys rather than listing the bucket: the manifest
+        of the sharded snapshot if present, then the binary snapshot, then the json db named by its pointer.
+        Buckets written before the pointer was introduced fall back to the first listed json db.
+        Returns the key and the version of the snapshot (and of its data, if segments are appended to it), with the parsed manifest or pointer
+        """
+        try:
+            data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+            manifest = json.loads(data['Body'].read())
+            # cursors are bound to the base of the sharded snapshot, positions do not change as segments are appended,
+            # the data version includes the last segment, which is noticed by reloads even if it never arrives through the change log
+            version = manifest.get('base') or data['ETag'].strip('"')
+            segments = manifest.get('segments')
+            return {"key": SNAPSHOT_MANIFEST_KEY, "version": version,
+                    "data_version": segmented_version(version, segments[-1]['key']) if segments else version, "manifest": manifest}
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+        try:
+            data = s3.head_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=BINARY_SNAPSHOT_KEY)
+            return {"key": BINARY_SNAPSHOT_KEY, "version": data['ETag'].strip('"')}
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+        try:
+            data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=MAIN_DB_POINTER_KEY)
+            pointer = json.loads(data['Body'].read())
+            return {"key": pointer['key'], "version": pointer['checksum'], "pointer": pointer}
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+
+        for item in s3.list_objects(Bucket=AWS_STORAGE_BUCKET_NAME).get('Contents', []):
+            if not item['Key'].startswith((SNAPSHOT_SHARD_PREFIX, SNAPSHOT_SEGMENT_PREFIX, CHANGELOG_PREFIX, MAIN_DB_PREFIX)):
+                return {"key": item['Key'], "version": item['ETag'].strip('"')}
+
+        raise Exception("Unable to read data from S3")
+
+    @staticmethod
+    def get_snapshot_version(s3=None) -> str:
+        """
+        Version of the data which is going to be loaded by load_file, compared to data_version of the loaded service
+        """
         if s3 is None:
             s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
 
-        bucket_name = AWS_STORAGE_BUCKET_NAME
+        snapshot = SearchService.select_snapshot(s3)
+        return snapshot.get('data_version', snapshot['version'])
 
-        s3objects = s3.list_objects(Bucket=bucket_name)
-        for item in s3objects.get('Contents'):
-            data = s3.get_object(Bucket=bucket_name, Key=item.get('Key'))
-            contents = data['Body'].read()
-            json_str = contents.decode("utf-8")
-            json_data = json.loads(json_str, object_pairs_hook=SearchService.deduplicate_strings)
-            return [Movie.from_json_dict(_) for _ in json_data]
+    @measure_time_elapsed
+    def load_file(self, s3) -> MovieTable:
+        if s3 is None:
+            # one client is shared by the shard loading threads, connections are pooled and reused
+            s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL, config=Config(max_pool_connections=SNAPSHOT_LOAD_WORKERS))
 
-        raise Exception("Unable to read data from S3")
+        # the change log is published after the data, so the loaded data includes at least the changes up to this version
+        self.changelog_version = read_changelog_version(s3)
+        snapshot = self.select_snapshot(s3)
+        # snapshot version to bind pagination cursors to the loaded data
+        self.version = snapshot['version']
+        # version of the loaded data including delta segments and applied change log entries, see get_snapshot_version
+        self.data_version = snapshot.get('data_version', self.version)
+        # the shared result caches are bound to the data as loaded (another load of the same base may include other segments),
+        # changes applied in place later invalidate the affected entries instead
+        self.cache_version = self.data_version
+
+        if 'manifest' in snapshot:
+            return self.load_sharded_snapshot(s3, snapshot['manifest'])
+        if 'pointer' in snapshot:
+            return self.load_shard(s3, {**snapshot['pointer'], "format": "json"})
+        data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=snapshot['key'])
+        # the object may have been replaced since it was selected
+        self.version = self.data_version = self.cache_version = data['ETag'].strip('"')
+        if snapshot['key'] == BINARY_SNAPSHOT_KEY:
+            return self.load_binary_snapshot(data['Body'].read())
+        return self.load_json_snapshot(data['Body'].iter_chunks(JSON_CHUNK_SIZE))
+
+    @staticmethod
+    @measure_time_elapsed
+    def load_sharded_snapshot(s3, manifest: Dict) -> MovieTable:
+        """
+        Load the base snapshot shards listed in the manifest, followed by the delta segments written since the base,
+        which are applied in order with last-writer-wins semantics (see MovieTable.upsert)
+        """
+        table = MovieTable()
+        for shard_table in SearchService.iter_shard_tables(s3, manifest['shards']):
+            table.extend(shard_table)
+        if len(table) != manifest['movies']:
+            raise SnapshotFormatError(f"Sharded snapshot has {len(table)} movies, {manifest['movies']} expected")
+
+        for segment_table in SearchService.iter_shard_tables(s3, manifest.get('segments', [])):
+            table.upsert(segment_table)
+        table.finish_loading()
+        return table
+
+    @staticmethod
+    def iter_shard_tables(s3, shards: Iterable[Dict]) -> Iterator[MovieTable]:
+        """
+        Load shards (or segments) using a bounded pool of threads, tables are yielded in the given order.
+        At most SNAPSHOT_LOAD_WORKERS shards are loading or waiting to be consumed at a time,
+        so memory stays close to the size of the loaded table.
+        """
+        shards = iter(shards)
+        with ThreadPoolExecutor(max_workers=SNAPSHOT_LOAD_WORKERS) as executor:
+            pending = deque(executor.submit(SearchService.load_shard, s3, shard) for shard in itertools.islice(shards, SNAPSHOT_LOAD_WORKERS))
+            while pending:
+                shard_table = pending.popleft().result()
+                for shard in itertools.islice(shards, 1):
+                    pending.append(executor.submit(SearchService.load_shard, s3, shard))
+                yield shard_table
+                del shard_table
+
+    @staticmethod
+    def load_shard(s3, shard: Dict) -> MovieTable:
+        """
+        Load a shard, segment or the json db named by the pointer - verified against the size and checksum
+        and decompressed as it is downloaded if the entry has them
+        """
+        data = s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key=shard['key'])
+        chunks = data['Body'].iter_chunks(JSON_CHUNK_SIZE)
+        if 'checksum' in shard:
+            chunks = iter_verified(chunks, shard['size'], shard['checksum'])
+        if 'encoding' in shard:
+            chunks = iter_decompressed(chunks, shard['encoding'])
+        if shard['format'] == "binary":
+            return SearchService.load_binary_snapshot(b"".join(chunks))
+        table = SearchService.load_json_snapshot(chunks)
+        # parsing stops at the end of the array, the rest of the stream is read so that it is verified
+        for _ in chunks:
+            pass
+        return table
+
+    @staticmethod
+    @measure_time_elapsed
+    def load_binary_snapshot(contents: bytes) -> MovieTable:
+        return decode_snapshot(contents)
+
+    @staticmethod
+    @measure_time_elapsed
+    def load_json_snapshot(chunks: Iterable[bytes]) -> MovieTable:
+        """
+        Parse the json db from a stream of chunks movie by movie, without holding the whole document in memory
+        """
+        return MovieTable.from_json_dicts(iter_json_array(chunks, object_pairs_hook=SearchService.deduplicate_strings))
+
+    @measure_time_elapsed
+    def build_indexes(self):
+        """
+        Build inverted indexes (value -> sorted movie positions) for exact match predicates
+        and trigram index for title substring search; cast and genre are indexed by dictionary ids
+        """
+        self.year_index = PostingIndex()
+        self.cast_index = PostingIndex()
+        self.genre_index = PostingIndex()
+        self.title_index = TrigramIndex()
+
+        table = self.movies_list
+        for position, (title_normalized, year, cast_ids, genre_ids) in enumerate(zip(table.titles_normalized, table.years, table.cast_ids, table.genre_ids)):
+            self.title_index.add_text(title_normalized, position)
+            self.year_index.add(year, position)
+            for cast_id in cast_ids:
+                self.cast_index.add(cast_id, position)
+            for genre_id in genre_ids:
+                self.genre_index.add(genre_id, position)
+
+    @measure_time_elapsed
+    def build_statistics(self):
+        """
+        Collect cardinality statistics for the query planner
+        """
+        self.statistics = Statistics(self)
+        self.planner = QueryPlanner(self, self.statistics)
+
+    @measure_time_elapsed
+    def build_facets(self):
+        """
+        Build bitsets of years, genres and the cast members with the most movies for facet counts
+        """
+        self.facet_index = FacetIndex(self, MAX_FACET_TOP_K, FACET_CAST_BITSETS, FACET_CAST_SCAN_LIMIT)
+
+    @measure_time_elapsed
+    def build_suggestions(self):
+        """
+        Build sorted vocabularies for prefix autocomplete:
+        titles with the shortest (closest to the prefix) first, cast names with the most movies first
+        """
+        table = self.movies_list
+        self.suggestions: Dict[str, PrefixVocabulary] = {
+            "title": PrefixVocabulary(((title_normalized, title, -len(title)) for title, title_normalized in zip(table.titles, table.titles_normalized)),
+                                      MAX_SUGGEST_TOP_K),
+            "cast": PrefixVocabulary(((Movie.normalize_title(name), name, len(self.cast_index.get(cast_id))) for cast_id, name in enumerate(table.cast_names.strings)),
+                                     MAX_SUGGEST_TOP_K),
+        }
+
+    def apply_changelog_entry(self, entry: Dict) -> bool:
+        """
+        Apply the next change log entry (see movies.changelog) in place, entries up to the applied version are skipped.
+        Returns False if the snapshot has to be reloaded instead (see requires_reload)
+        """
+        if entry['version'] <= self.changelog_version:
+            return True
+        if self.requires_reload(entry):
+            return False
+        self.apply_upserts(entry['upserts'])
+        self.set_changelog_version(entry)
+        return True
+
+    def requires_reload(self, entry: Dict) -> bool:
+        """
+        Whether the snapshot has to be reloaded instead of applying a change log entry after the applied version -
+        for reload entries and entries after a gap in versions
+        """
+        return entry['version'] != self.changelog_version + 1 or bool(entry.get('reload'))
+
+    def set_changelog_version(self, entry: Dict):
+        """
+        Record the upserts of the change log entry as applied
+        """
+        self.changelog_version = entry['version']
+        if entry.get('segment'):
+            # the upserts are the movies of the segment, the loaded data matches the snapshot with the segment appended
+            self.data_version = segmented_version(self.version, entry['segment'])
+
+    def apply_upserts(self, movies: List[Dict]):
+        """
+        Apply upserted movies to the loaded data in place, see locate_upserts and apply_located_upserts
+        """
+        self.apply_located_upserts(*self.locate_upserts(movies))
+
+    @measure_time_elapsed
+    def locate_upserts(self, movies: List[Dict]) -> Tuple[MovieTable, Dict[int, int], List[int]]:
+        """
+        Parse upserted movies and find the positions they replace (see MovieTable.locate_upserts), which takes most of the time of upserts.
+        Only reads the loaded data, so it can run in another thread while requests are served, but not while changes are applied
+        """
+        upserts = MovieTable.from_json_dicts(movies)
+        # movies of the title and year are among the matches of the title as a substring in the year
+        replacing, appending = self.movies_list.locate_upserts(upserts, lambda title, year: self.planner.plan(self.make_query(title, year, "", "")).execute())
+        return upserts, replacing, appending
 
     @measure_time_elapsed
-    def find_movies(self, title_contains: str, year: int, cast: str, genre: str, page: int, page_size: int) -> SearchResponse:
+    def apply_located_upserts(self, upserts: MovieTable, replacing: Dict[int, int], appending: List[int]):
+        """
+        Apply upserted movies located by locate_upserts to the loaded data in place, updating indexes, statistics and facets.
+        Positions of the other movies do not change, so pagination cursors stay valid and cached results
+        are invalidated only for the queries matching a changed movie before or after the change.
+        Not thread safe, meant to run on the serving thread between requests; suggestions are not updated,
+        build_suggestions rebuilds them (and can run in another thread).
+        """
+        # odd while the change is applied, the shadow comparator running in other threads discards comparisons overlapping it
+        self.change_sequence += 1
+        try:
+            table = self.movies_list
+            replaced, appended = table.apply_upserts(upserts, replacing, appending)
+            cast_names = table.cast_names.strings
+            genre_names = table.genre_names.strings
+
+            # (title, year, cast, genres) of the changed movies before and after the change
+            changed = []
+            touched_cast_ids: Set[int] = set()
+            touched_genre_ids: Set[int] = set()
+            for position, (old_cast_ids, old_genre_ids) in replaced.items():
+                cast_ids, genre_ids = table.cast_ids[position], table.genre_ids[position]
+                for old_ids, new_ids, index, touched in ((old_cast_ids, cast_ids, self.cast_index, touched_cast_ids),
+                                                         (old_genre_ids, genre_ids, self.genre_index, touched_genre_ids)):
+                    for value_id in set(old_ids) - set(new_ids):
+                        index.remove(value_id, position)
+                    for value_id in set(new_ids) - set(old_ids):
+                        index.insert(value_id, position)
+                    touched.update(old_ids, new_ids)
+                changed.append((table.titles_normalized[position], table.years[position],
+                                {cast_names[_] for _ in old_cast_ids}, {genre_names[_] for _ in old_genre_ids}))
+                changed.append((table.titles_normalized[position], table.years[position],
+                                {cast_names[_] for _ in cast_ids}, {genre_names[_] for _ in genre_ids}))
+                table.json_fragments.pop(position, None)
+
+            for position in appended:
+                title_normalized, year, cast_ids, genre_ids = table.titles_normalized[position], table.years[position], table.cast_ids[position], table.genre_ids[position]
+                self.title_index.add_text(title_normalized, position)
+                self.year_index.add(year, position)
+                for cast_id in cast_ids:
+                    self.cast_index.add(cast_id, position)
+                for genre_id in genre_ids:
+                    self.genre_index.add(genre_id, position)
+                touched_cast_ids.update(cast_ids)
+                touched_genre_ids.update(genre_ids)
+                changed.append((title_normalized, year, {cast_names[_] for _ in cast_ids}, {genre_names[_] for _ in genre_ids}))
+
+            self.statistics.update(self, {table.years[_] for _ in appended}, touched_genre_ids, touched_cast_ids,
+                                   [table.titles_normalized[_] for _ in appended])
+            self.facet_index.update(replaced, appended, touched_cast_ids)
+            self.invalidate_cached_results(changed)
+        finally:
+            self.change_sequence += 1
+
+    def invalidate_cached_results(self, changed: List[Tuple[str, int, Set[str], Set[str]]]):
+        """
+        Remove cached results and responses of the queries matching any of the (normalized title, year, cast, genres) movies
         """
-        Perform full scan of movies to evaluate conditions.
+        if len(changed) > MAX_SELECTIVE_INVALIDATION:
+            self.result_cache.invalidate(self.cache_version, lambda key: True)
+            self.response_cache.invalidate(self.cache_version, lambda key: True)
+            return
+
+        # candidates of a query are the changed movies of its cast, year or genre
+        by_cast: Dict[str, List] = {}
+        by_year: Dict[int, List] = {}
+        by_genre: Dict[str, List] = {}
+        for movie in changed:
+            for name in movie[2]:
+                by_cast.setdefault(name, []).append(movie)
+            by_year.setdefault(movie[1], []).append(movie)
+            for name in movie[3]:
+                by_genre.setdefault(name, []).append(movie)
+
+        def matches(query: SearchQuery) -> bool:
+            title_contains, year, cast, genre = query
+            if cast:
+                candidates = by_cast.get(cast, ())
+            elif year:
+                candidates = by_year.get(year, ())
+            elif genre:
+                candidates = by_genre.get(genre, ())
+            else:
+                candidates = changed
+            return any(title_contains in title_normalized and year in (0, movie_year) and (not cast or cast in movie_cast) and (not genre or genre in movie_genres)
+                       for title_normalized, movie_year, movie_cast, movie_genres in candidates)
+
+        self.result_cache.invalidate(self.cache_version, matches)
+        # response cache keys start with the search parameters as requested
+        self.response_cache.invalidate(self.cache_version, lambda key: matches(self.make_query(*key[:4])))
+
+    @measure_time_elapsed
+    def find_movies(self, title_contains: str, year: int, cast: str, genre: str, page: int, page_size: int, cursor: str = "") -> SearchResponse:
+        """
+        Evaluate conditions using the configured search engine (see movies.engines).
         Filter conditions are evaluated using AND.
         Note: Total count is not calculated, instead a flag has_more returned if more items exist.
 
@@ -94,44 +434,229 @@ class SearchService:
         :params year: filter movies from the year; ignored if 0
         :params cast: filter movies having a cast member (full name is expected); ignored if empty
         :params genre: filter movies which has the genre (full genre name is expected); ignored if empty
+        :params cursor: continue the search after the previous page (cursor value of the previous response); page is ignored if set
 
         :returns: Dict with paginated result
         - items: list of movies
         - page: page number (value of page parameter)
         - page_size: page size (value of page parameter)
         - has_more: whether there are more records, page+1 has to be requested in this case if more results are needed
+        - cursor: if there are more records, cursor to request the next page without rescanning the previous ones
+
+        :raises InvalidCursorError: if the cursor is malformed or the data has been reloaded since it was issued
+        """
+
+        start_time = time.perf_counter()
+        query = self.make_query(title_contains, year, cast, genre)
+        start = decode_cursor(cursor, self.version) if cursor else 0
+        if cursor:
+            response = self.paginate(self.engine.find_positions(query, start), page, page_size, skip=0)
+        else:
+            response = self.paginate(self.engine.find_positions(query), page, page_size)
+
+        elapsed = time.perf_counter() - start_time
+        if self.slow_query_log.is_slow(elapsed):
+            self.log_slow_query("find_movies", query, page, page_size, cursor, start, "none", None, elapsed)
+        return response
+
+    def log_slow_query(self, method: str, query: SearchQuery, page: int, page_size: int, cursor: str, start: int,
+                       cache: str, rows_matched: Optional[int], elapsed: float):
+        plan = self.planner.plan(query)
+        self.slow_query_log.add(SlowQuery(
+            timestamp=time.time(),
+            method=method,
+            title_contains=query.title_contains,
+            year=query.year,
+            cast=query.cast,
+            genre=query.genre,
+            page=page,
+            page_size=page_size,
+            cursor=cursor,
+            cache=cache,
+            plan=plan.strategy,
+            rows_scanned=plan.scanned_rows(start) if cache != "hit" else 0,
+            rows_matched=rows_matched,
+            elapsed_ms=elapsed * 1000
+        ))
+
+    @measure_time_elapsed
+    def find_facets(self, title_contains: str, year: int, cast: str, genre: str, top_k: int = 10) -> FacetsResponse:
+        """
+        Count movies matching the filters (same as find_movies) per year, per genre and for the top_k cast members.
+        Counts are popcounts of bitsets, no movies are materialized.
+
+        :returns: FacetsResponse
+        - total: number of matching movies
+        - years: year -> number of movies, in year order
+        - genres: genre -> number of movies, most frequent first
+        - cast: cast member -> number of movies for top_k cast members, most frequent first
+        """
+        query = self.make_query(title_contains, year, cast, genre)
+        total, years, genres, cast_counts = self.facet_index.count(query, min(top_k, MAX_FACET_TOP_K))
+        return FacetsResponse(total=total, years=years, genres=genres, cast=cast_counts)
+
+    @measure_time_elapsed
+    def suggest(self, prefix: str, field: str = "title", top_k: int = 10) -> SuggestResponse:
+        """
+        Autocomplete titles or cast names by a case insensitive prefix
+
+        :params field: title or cast
+        :raises KeyError: if the field is not supported
         """
+        return SuggestResponse(items=self.suggestions[field].suggest(Movie.normalize_title(prefix), top_k))
 
-        title_contains = Movie.normalize_title(title_contains)
+    def explain(self, title_contains: str, year: int, cast: str, genre: str) -> ExplainResponse:
+        """
+        Plan of the query chosen by the planner, the query is run to count actual rows of every step
+        """
+        plan = self.planner.plan(self.make_query(title_contains, year, cast, genre))
 
-        # slice data for pagination, this will stop the scan if sufficient items found
-        generator = (item for item in self.movies_list
-                     if (not title_contains or title_contains in item.title_normalized)
-                     and (year == 0 or year == item.year)
-                     and (not cast or cast in item.cast)
-                     and (not genre or genre in item.genres))
+        counts = [0] * len(plan.steps)
+        start_time = time.perf_counter()
+        actual_rows = sum(1 for _ in plan.execute(counts=counts))
+        elapsed = time.perf_counter() - start_time
 
-        iterator = itertools.islice(generator, page*page_size, page*page_size+page_size+1)
-        items = list(iterator)
+        return ExplainResponse(
+            strategy=plan.strategy,
+            steps=[ExplainStep(predicate=step.description, access=step.access, estimated_rows=round(step.estimated_rows), actual_rows=count)
+                   for step, count in zip(plan.steps, counts)],
+            estimated_cost=round(plan.cost, 1),
+            estimated_rows=round(plan.estimated_rows),
+            actual_rows=actual_rows,
+            elapsed_ms=round(elapsed * 1000, 3)
+        )
+
+    @staticmethod
+    def make_query(title_contains: str, year: int, cast: str, genre: str) -> SearchQuery:
+        return SearchQuery(Movie.normalize_title(title_contains), year, cast, genre)
+
+    def slice_page(self, positions: Iterable[int], page_size: int, skip: int) -> Tuple[List[int], bool, Optional[str]]:
+        """
+        Slice matching positions for pagination, this will stop the search if sufficient items found.
+        Returns positions of the page, has_more flag and the cursor of the next page.
+        """
+        page_positions = list(itertools.islice(positions, skip, skip+page_size+1))
 
         # flag if we have more items
-        if len(items) > page_size:
-            has_more = True
-            items.pop()
-        else:
-            has_more = False
+        if len(page_positions) > page_size:
+            page_positions.pop()
+            # resume right after the last returned movie
+            return page_positions, True, encode_cursor(self.version, page_positions[-1] + 1 if page_positions else 0)
 
+        return page_positions, False, None
+
+    def paginate(self, positions: Iterable[int], page: int, page_size: int, skip: Optional[int] = None) -> SearchResponse:
+        """
+        Paginated response, only the returned page is materialized into Movie records.
+        By default page*page_size matches are skipped.
+        """
+        if skip is None:
+            skip = page*page_size
+        page_positions, has_more, cursor = self.slice_page(positions, page_size, skip)
+
+        movies_list = self.movies_list
         return SearchResponse(
-            items=items,
+            items=[movies_list[position] for position in page_positions],
             page=page,
             size=page_size,
-            has_more=has_more
+            has_more=has_more,
+            cursor=cursor
         )
 
+    def cached_page(self, title_contains: str, year: int, cast: str, genre: str, page: int, page_size: int, cursor: str = "") -> Tuple[List[int], bool, Optional[str]]:
+        """
+        Page positions, has_more flag and the next page cursor of the query.
+        All the matching positions of the query are cached once and any page of the query is sliced from them.
+        """
+        start_time = time.perf_counter()
+        query = self.make_query(title_contains, year, cast, genre)
+        positions = self.result_cache.get(query, self.cache_version)
+        cache = "hit"
+        if positions is None:
+            positions = array(POSITION_TYPECODE, self.engine.find_positions(query))
+            self.result_cache.put(query, self.cache_version, positions)
+            cache = "miss"
+
+        page_slice = self.slice_cached_page(positions, page, page_size, cursor)
+        elapsed = time.perf_counter() - start_time
+        if self.slow_query_log.is_slow(elapsed):
+            self.log_slow_query("cached_page", query, page, page_size, cursor, 0, cache, len(positions), elapsed)
+        return page_slice
+
+    def slice_cached_page(self, positions: array, page: int, page_size: int, cursor: str) -> Tuple[List[int], bool, Optional[str]]:
+        skip = page*page_size
+        if cursor:
+            skip = bisect.bisect_left(positions, decode_cursor(cursor, self.version))
+        return self.slice_page(positions[skip:skip+page_size+1], page_size, skip=0)
+
     @measure_time_elapsed
-    @functools.lru_cache(maxsize=16384)
-    def cached_find_movies(self, *args, **kwargs):
+    def find_movies_batch(self, requests: List[SearchRequest]) -> List[SearchResponse]:
+        """
+        Evaluate several searches at once.
+        Queries found in the result cache are answered from it,
+        the rest are evaluated together by the engine (e.g. in one shared scan) up to the requested page.
+        """
+        pages: List[Optional[Tuple[List[int], bool, Optional[str]]]] = [None] * len(requests)
+
+        # (request index, query, start position, number of matches to skip)
+        misses = []
+        for i, request in enumerate(requests):
+            query = self.make_query(request.title_contains, request.year, request.cast, request.genre)
+            positions = self.result_cache.get(query, self.cache_version)
+            if positions is not None:
+                pages[i] = self.slice_cached_page(positions, request.page, request.page_size, request.cursor)
+            elif request.cursor:
+                misses.append((i, query, decode_cursor(request.cursor, self.version), 0))
+            else:
+                misses.append((i, query, 0, request.page*request.page_size))
+
+        if misses:
+            matches = self.engine.find_positions_batch([_[1] for _ in misses], [_[2] for _ in misses],
+                                                       [skip + requests[i].page_size + 1 for i, _, _, skip in misses])
+            for (i, _, _, skip), positions in zip(misses, matches):
+                pages[i] = self.slice_page(positions, requests[i].page_size, skip)
+
+        movies_list = self.movies_list
+        return [
+            SearchResponse(
+                items=[movies_list[position] for position in page_positions],
+                page=request.page,
+                size=request.page_size,
+                has_more=has_more,
+                cursor=next_cursor
+            )
+            for request, (page_positions, has_more, next_cursor) in zip(requests, pages)
+        ]
+
+    @measure_time_elapsed
+    def cached_find_movies(self, title_contains: str, year: int, cast: str, genre: str, page: int, page_size: int, cursor: str = "") -> SearchResponse:
         """
         Cached version of find_movies
         """
-        return self.find_movies(*args, **kwargs)
+        page_positions, has_more, next_cursor = self.cached_page(title_contains, year, cast, genre, page, page_size, cursor)
+
+        movies_list = self.movies_list
+        return SearchResponse(
+            items=[movies_list[position] for position in page_positions],
+            page=page,
+            size=page_size,
+            has_more=has_more,
+            cursor=next_cursor
+        )
+
+    @measure_time_elapsed
+    def cached_response_body(self, title_contains: str, year: int, cast: str, genre: str, page: int, page_size: int, cursor: str = "",
+                             encoding: str = IDENTITY) -> bytes:
+        """
+        Cached version of find_movies as final response bytes in the content encoding,
+        assembled from movie json fragments (see MovieTable.json_fragment)
+        """
+        key = (title_contains, year, cast, genre, page, page_size, cursor, encoding)
+        body = self.response_cache.get(key, self.cache_version)
+        if body is None:
+            page_positions, has_more, next_cursor = self.cached_page(title_contains, year, cast, genre, page, page_size, cursor)
+            json_fragment = self.movies_list.json_fragment
+            body = encode_search_response([json_fragment(position) for position in page_positions], page, page_size, has_more, next_cursor)
+            body = compress(body, encoding)
+            self.response_cache.put(key, self.cache_version, body)
+        return body
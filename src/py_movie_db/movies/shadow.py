@@ -0,0 +1,64 @@
+"""
+Shadow mode - run a candidate engine next to the serving one and compare results
+"""
+import logging
+import random
+import time
+
+from movies.engines import SearchEngine, SearchQuery
+from utils.perf_tools import perf_counters
+
+
+class ShadowComparator:
+    """
+    Compares a candidate engine against the serving engine on a sample of live queries.
+    Comparison is expected to run off the request path (e.g. as a background task).
+    Counters:
+    - shadow_compared / shadow_mismatch: number of compared queries and of queries with different results
+    - shadow_discarded: number of comparisons overlapping a change applied in place, the engines may have read a partial change
+    - shadow_<engine>: latency of each engine on the compared queries
+    """
+
+    def __init__(self, service, engine: SearchEngine, candidate: SearchEngine, sample_rate: float):
+        self.service = service
+        self.engine = engine
+        self.candidate = candidate
+        self.sample_rate = sample_rate
+
+    def should_sample(self) -> bool:
+        return random.random() < self.sample_rate
+
+    def run(self, engine: SearchEngine, query: SearchQuery, page: int, page_size: int):
+        start_time = time.perf_counter()
+        response = self.service.paginate(engine.find_positions(query), page, page_size)
+        perf_counters.increment("shadow_" + engine.name, time.perf_counter() - start_time)
+        return response
+
+    def overlapped_change(self, change_sequence: int) -> bool:
+        # the sequence is odd while a change is applied
+        return change_sequence % 2 == 1 or self.service.change_sequence != change_sequence
+
+    def compare(self, query: SearchQuery, page: int, page_size: int) -> bool:
+        """
+        Run the query on both engines, returns True if results are the same (or if the comparison is discarded)
+        """
+        change_sequence = self.service.change_sequence
+        try:
+            expected = self.run(self.engine, query, page, page_size)
+            actual = self.run(self.candidate, query, page, page_size)
+        except (IndexError, KeyError, TypeError):
+            if not self.overlapped_change(change_sequence):
+                raise
+        if self.overlapped_change(change_sequence):
+            perf_counters.count("shadow_discarded")
+            return True
+
+        perf_counters.count("shadow_compared")
+        if expected.items == actual.items and expected.has_more == actual.has_more:
+            return True
+
+        perf_counters.count("shadow_mismatch")
+        logging.warning("Shadow engine %s mismatch for query %s page %s/%s: %s items (has_more=%s) vs %s items (has_more=%s)",
+                        self.candidate.name, query, page, page_size,
+                        len(expected.items), expected.has_more, len(actual.items), actual.has_more)
+        return False
@@ -0,0 +1,59 @@
+"""
+Bounded in-memory log of slow searches
+"""
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, List, Optional
+
+from app.config import SLOW_QUERY_LOG_SIZE, SLOW_QUERY_THRESHOLD_MS
+
+
+@dataclass
+class SlowQuery:
+    """
+    - method: service method which evaluated the query
+    - cache: hit or miss of the result cache, none for uncached methods
+    - plan: plan strategy (index, scan or empty)
+    - rows_scanned: rows read by the plan access path (posting list or the movies from the start position)
+    - rows_matched: number of matching movies, if the query was evaluated to the end
+    """
+    timestamp: float
+    method: str
+    title_contains: str
+    year: int
+    cast: str
+    genre: str
+    page: int
+    page_size: int
+    cursor: str
+    cache: str
+    plan: str
+    rows_scanned: int
+    rows_matched: Optional[int]
+    elapsed_ms: float
+
+
+class SlowQueryLog:
+    """
+    Keeps the last max_entries queries which took longer than the threshold
+    """
+
+    def __init__(self, threshold_ms: float = SLOW_QUERY_THRESHOLD_MS, max_entries: int = SLOW_QUERY_LOG_SIZE):
+        self.threshold = threshold_ms / 1000
+        self.entries: Deque[SlowQuery] = deque(maxlen=max_entries)
+
+    def is_slow(self, elapsed: float) -> bool:
+        return elapsed >= self.threshold
+
+    def add(self, entry: SlowQuery):
+        # deque append is atomic, no lock is needed
+        self.entries.append(entry)
+
+    def recent(self) -> List[SlowQuery]:
+        """
+        Logged queries, the most recent first
+        """
+        return list(reversed(self.entries))
+
+
+slow_query_log = SlowQueryLog()
@@ -0,0 +1,164 @@
+"""
+Binary movie snapshot, published by movie_indexer_job next to the json db.
+Keep the layout in sync with indexer/snapshot.py.
+
+All numbers are little-endian.
+Header (32 bytes):
+- magic b"MOVIEDB\\0"
+- format version (uint32)
+- number of movies (uint32)
+- payload length (uint64)
+- CRC32 of the payload (uint32), reserved (uint32)
+Payload is a sequence of sections, each prefixed with its length (uint64) and padded to 8 bytes:
+- titles: string table
+- years: uint16 array
+- cast names: string table
+- cast offsets: uint32 array (number of movies + 1), cast ids: uint32 array
+- genre names: string table
+- genre offsets: uint32 array (number of movies + 1), genre ids: uint32 array
+String table is the number of strings n (uint32), offsets of the strings in code points (uint32 array of n + 1)
+and the utf-8 encoded strings concatenated, so strings may contain any character
+(format version 1, still read, joined them with NUL).
+Cast and genre ids of the movie i are ids[offsets[i]:offsets[i+1]].
+"""
+import itertools
+import struct
+import sys
+import zlib
+from array import array
+from typing import Iterator, List
+
+from movies.movie_table import MovieTable, StringDictionary
+
+MAGIC = b"MOVIEDB\0"
+FORMAT_VERSION = 2
+# versions decode_snapshot reads, snapshots of version 1 may still be published
+SUPPORTED_FORMAT_VERSIONS = (1, FORMAT_VERSION)
+HEADER = struct.Struct("<8sIIQII")
+SECTION_LENGTH = struct.Struct("<Q")
+STRING_COUNT = struct.Struct("<I")
+
+
+class SnapshotFormatError(Exception):
+    pass
+
+
+def _to_little_endian(values: array) -> bytes:
+    if sys.byteorder != "little":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_little_endian(typecode: str, data: memoryview) -> array:
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+def _encode_strings(strings: List[str]) -> bytes:
+    offsets = array('I', [0])
+    offsets.extend(itertools.accumulate(map(len, strings)))
+    return STRING_COUNT.pack(len(strings)) + _to_little_endian(offsets) + "".join(strings).encode("utf-8")
+
+
+def _decode_strings(data: memoryview, version: int = FORMAT_VERSION) -> List[str]:
+    count, = STRING_COUNT.unpack_from(data)
+    if version == 1:
+        if count == 0:
+            return []
+        strings = str(data[STRING_COUNT.size:], "utf-8").split("\0")
+        if len(strings) != count:
+            raise SnapshotFormatError("String table is corrupted")
+        return strings
+
+    text_offset = STRING_COUNT.size + (count + 1) * 4
+    if len(data) < text_offset:
+        raise SnapshotFormatError("String table is truncated")
+    offsets = _from_little_endian('I', data[STRING_COUNT.size:text_offset])
+    text = str(data[text_offset:], "utf-8")
+    if offsets[-1] != len(text):
+        raise SnapshotFormatError("String table is corrupted")
+    return [text[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+def _encode_csr(ids: List[tuple]) -> List[bytes]:
+    offsets = array('I', [0])
+    flat = array('I')
+    for item_ids in ids:
+        flat.extend(item_ids)
+        offsets.append(len(flat))
+    return [_to_little_endian(offsets), _to_little_endian(flat)]
+
+
+def _decode_csr(offsets: array, flat: array) -> Iterator[tuple]:
+    return (tuple(flat[start:end]) for start, end in zip(offsets, offsets[1:]))
+
+
+def encode_snapshot(table: MovieTable) -> bytes:
+    sections = [
+        _encode_strings(table.titles),
+        _to_little_endian(table.years),
+        _encode_strings(table.cast_names.strings),
+        *_encode_csr(table.cast_ids),
+        _encode_strings(table.genre_names.strings),
+        *_encode_csr(table.genre_ids),
+    ]
+
+    payload = bytearray()
+    for section in sections:
+        payload += SECTION_LENGTH.pack(len(section))
+        payload += section
+        payload += b"\0" * (-len(section) % 8)
+
+    return HEADER.pack(MAGIC, FORMAT_VERSION, len(table), len(payload), zlib.crc32(payload), 0) + payload
+
+
+def decode_snapshot(data: bytes) -> MovieTable:
+    """
+    Load movies from a binary snapshot.
+    Columns are copied from the buffer as whole arrays, per movie work is limited to building id tuples.
+    """
+    buffer = memoryview(data)
+    if len(buffer) < HEADER.size:
+        raise SnapshotFormatError("Snapshot is truncated")
+
+    magic, version, count, payload_length, checksum, _ = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise SnapshotFormatError("Not a movie snapshot")
+    if version not in SUPPORTED_FORMAT_VERSIONS:
+        raise SnapshotFormatError(f"Unsupported snapshot format version {version}")
+
+    payload = buffer[HEADER.size:]
+    if len(payload) != payload_length or zlib.crc32(payload) != checksum:
+        raise SnapshotFormatError("Snapshot checksum mismatch")
+
+    sections = []
+    offset = 0
+    while offset < len(payload):
+        length, = SECTION_LENGTH.unpack_from(payload, offset)
+        offset += SECTION_LENGTH.size
+        sections.append(payload[offset:offset + length])
+        offset += length + (-length % 8)
+
+    if len(sections) != 8:
+        raise SnapshotFormatError("Unexpected number of sections")
+    titles, years, cast_names, cast_offsets, cast_ids, genre_names, genre_offsets, genre_ids = sections
+
+    titles = _decode_strings(titles, version)
+    years = _from_little_endian('H', years)
+    cast_offsets = _from_little_endian('I', cast_offsets)
+    genre_offsets = _from_little_endian('I', genre_offsets)
+    if not len(titles) == len(years) == len(cast_offsets) - 1 == len(genre_offsets) - 1 == count:
+        raise SnapshotFormatError("Columns have different lengths")
+
+    table = MovieTable()
+    table.cast_names = StringDictionary.from_strings(_decode_strings(cast_names, version))
+    table.genre_names = StringDictionary.from_strings(_decode_strings(genre_names, version))
+    table.append_columns(titles, years,
+                         _decode_csr(cast_offsets, _from_little_endian('I', cast_ids)),
+                         _decode_csr(genre_offsets, _from_little_endian('I', genre_ids)))
+    table.finish_loading()
+    return table
@@ -0,0 +1,82 @@
+"""
+Prefix autocomplete over sorted vocabularies of titles and cast names
+"""
+import bisect
+import heapq
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+# prefixes matching more entries have their top suggestions precomputed, smaller ranges are ranked on request
+SCAN_LIMIT = 256
+
+
+class PrefixVocabulary:
+    """
+    Sorted normalized keys with display values and scores, a prefix matches a contiguous range found by bisect.
+    Suggestions are the range entries with the highest scores, ties in the key order.
+    Top suggestions of prefixes matching more than SCAN_LIMIT entries are precomputed,
+    so a lookup ranks at most SCAN_LIMIT entries regardless of the vocabulary size.
+    """
+
+    def __init__(self, entries: Iterable[Tuple[str, str, int]], top_k_limit: int):
+        """
+        :param entries: (normalized key, display value, score); the first value of duplicate keys is kept
+        :param top_k_limit: maximum number of suggestions
+        """
+        self.top_k_limit = top_k_limit
+        self.keys: List[str] = []
+        self.values: List[str] = []
+        self.scores = array('i')
+
+        unique = {}
+        for key, value, score in entries:
+            unique.setdefault(key, (value, score))
+        for key in sorted(unique):
+            value, score = unique[key]
+            self.keys.append(key)
+            self.values.append(value)
+            self.scores.append(score)
+
+        # prefix -> positions of the top suggestions
+        self.top_positions: Dict[str, List[int]] = {}
+        self._precompute(0, len(self.keys), 0)
+
+    def _rank(self, lo: int, hi: int, top_k: int) -> List[int]:
+        # nlargest is stable, equal scores keep the key order
+        return heapq.nlargest(top_k, range(lo, hi), key=self.scores.__getitem__)
+
+    def _precompute(self, lo: int, hi: int, depth: int):
+        """
+        Precompute suggestions of prefixes of length depth+1 within the range of a prefix of length depth
+        """
+        keys = self.keys
+        # keys equal to the prefix itself come first and have no longer prefix
+        while lo < hi and len(keys[lo]) <= depth:
+            lo += 1
+
+        while lo < hi:
+            prefix = keys[lo][:depth + 1]
+            end = self._prefix_end(prefix, lo, hi)
+            if end - lo > SCAN_LIMIT:
+                self.top_positions[prefix] = self._rank(lo, end, self.top_k_limit)
+                self._precompute(lo, end, depth + 1)
+            lo = end
+
+    def _prefix_end(self, prefix: str, lo: int, hi: int) -> int:
+        # the first key after all the keys starting with the prefix
+        return bisect.bisect_left(self.keys, prefix + "\U0010ffff", lo, hi)
+
+    def suggest(self, prefix: str, top_k: int) -> List[str]:
+        top_k = min(top_k, self.top_k_limit)
+        if not prefix:
+            return []
+
+        positions = self.top_positions.get(prefix)
+        if positions is None:
+            lo = bisect.bisect_left(self.keys, prefix)
+            positions = self._rank(lo, self._prefix_end(prefix, lo, len(self.keys)), top_k)
+        values = self.values
+        return [values[position] for position in positions[:top_k]]
+
+    def __len__(self):
+        return len(self.keys)
@@ -0,0 +1,61 @@
+from benchmarks.catalogue import FAMOUS_CAST, FREQUENT_WORDS, GENRES, generate_catalogue
+from benchmarks.run import METHODS, QUERY_SHAPES, benchmark_catalogue, compare_with_baseline, flatten
+
+
+def test_catalogue_is_deterministic():
+    table = generate_catalogue(2000, seed=1)
+    assert len(table) == 2000
+    assert table.titles == generate_catalogue(2000, seed=1).titles
+    assert table.titles != generate_catalogue(2000, seed=2).titles
+
+    assert set(FAMOUS_CAST) <= set(table.cast_names.strings)
+    assert table.genre_names.strings == GENRES
+    assert any("day" in _ for _ in table.titles_normalized)
+    assert all(1900 <= _ <= 2023 for _ in table.years)
+
+
+def test_catalogue_popularity_is_skewed():
+    table = generate_catalogue(5000)
+    genre_counts = [0] * len(GENRES)
+    for genre_ids in table.genre_ids:
+        for genre_id in genre_ids:
+            genre_counts[genre_id] += 1
+    assert genre_counts[0] > genre_counts[1] > 10 * genre_counts[-1]
+
+
+def test_benchmark_reports_every_shape_and_method():
+    result = benchmark_catalogue(2000, iterations=10, engine="planner", seed=0)
+    assert set(result.latency) == set(QUERY_SHAPES)
+    for methods in result.latency.values():
+        assert set(methods) == set(METHODS)
+        for stats in methods.values():
+            assert 0 < stats.p50_ms <= stats.p95_ms <= stats.p99_ms <= stats.max_ms
+            assert stats.qps > 0
+
+    metrics = flatten([result])
+    assert metrics["2000/title/find_movies/p50_ms"] == result.latency["title"]["find_movies"].p50_ms
+    assert metrics["2000/startup_s"] == result.startup_s
+
+
+def test_compare_with_baseline():
+    baseline = {
+        "1000/all/find_movies/p95_ms": 1.0,
+        "1000/all/find_movies/qps": 1000.0,
+        "1000/all/find_movies/max_ms": 1.0,
+        "1000/memory_mb": 100.0,
+    }
+    assert compare_with_baseline(dict(baseline), baseline, 0.25) == []
+    # within tolerance, not compared, missing in the baseline
+    assert compare_with_baseline({
+        "1000/all/find_movies/p95_ms": 1.2,
+        "1000/all/find_movies/max_ms": 10.0,
+        "1000/memory_mb": 120.0,
+        "2000/memory_mb": 500.0,
+    }, baseline, 0.25) == []
+
+    regressions = compare_with_baseline({
+        "1000/all/find_movies/p95_ms": 2.0,
+        "1000/all/find_movies/qps": 500.0,
+        "1000/memory_mb": 200.0,
+    }, baseline, 0.25)
+    assert [_.split(":")[0] for _ in regressions] == ["1000/all/find_movies/p95_ms", "1000/all/find_movies/qps", "1000/memory_mb"]
@@ -0,0 +1,231 @@
+import asyncio
+import json
+
+import pytest
+from moto import mock_s3
+
+import app.main as main
+from app.config import AWS_STORAGE_BUCKET_NAME, SNAPSHOT_MANIFEST_KEY, SNAPSHOT_SEGMENT_PREFIX, SNAPSHOT_SHARD_PREFIX
+from movies.changelog import changelog_key
+from tests.test_search_service import get_s3_client, create_main_db
+from utils.memory import read_memory_usage
+from utils.perf_tools import LatencyHistogram, PerfCounters, perf_counters
+from utils.profiling import ProfilingInProgressError, RequestProfiler
+
+
+@mock_s3
+def test_can_reload_snapshot():
+    s3 = get_s3_client()
+    create_main_db(s3)
+
+    main.search_service = None
+    assert asyncio.run(main.reload_snapshot(s3))
+    old_service = main.search_service
+    assert len(old_service.movies_list) == 3
+
+    # nothing changed
+    assert not asyncio.run(main.reload_snapshot(s3))
+    assert main.search_service is old_service
+
+    s3.put_object(Body=b'[{"title": "Venom", "year": 2018, "cast": [], "genres": []}]', Bucket=AWS_STORAGE_BUCKET_NAME, Key="main")
+
+    assert asyncio.run(main.reload_snapshot(s3))
+    assert main.search_service is not old_service
+    assert len(main.search_service.movies_list) == 1
+    assert perf_counters.info["snapshot_version"] == main.search_service.version
+    # requests started before the swap can still be served by the old service
+    assert len(old_service.find_movies(title_contains="", year=0, cast="", genre="", page=0, page_size=10).items) == 3
+
+    main.search_service = None
+
+
+@mock_s3
+def test_can_apply_changelog():
+    s3 = get_s3_client()
+    create_main_db(s3)
+
+    main.search_service = None
+    assert asyncio.run(main.reload_snapshot(s3))
+    service = main.search_service
+    assert not asyncio.run(main.apply_changelog(s3))
+
+    upserts = [{"title": "Venom", "year": 2018, "cast": ["Tom Hardy"], "genres": ["Comedy"]}]
+    s3.put_object(Body=json.dumps({"version": 1, "upserts": upserts}).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=changelog_key(1))
+
+    # applied in place, without a reload
+    assert asyncio.run(main.apply_changelog(s3))
+    assert main.search_service is service
+    assert service.find_movies(title_contains="", year=0, cast="", genre="Comedy", page=0, page_size=10).items[0].title == "Venom"
+    assert perf_counters.info["changelog_version"] == "1"
+    assert not asyncio.run(main.apply_changelog(s3))
+
+    # reload entries reload the snapshot, pre-forked workers leave it to the parent process
+    s3.put_object(Body=json.dumps({"version": 2, "reload": True}).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=changelog_key(2))
+    assert not asyncio.run(main.apply_changelog(s3, reload=False))
+    assert main.search_service is service
+    assert service.changelog_version == 1
+    assert asyncio.run(main.apply_changelog(s3))
+    assert main.search_service is not service
+    assert main.search_service.changelog_version == 2
+
+    main.search_service = None
+
+
+@mock_s3
+def test_changelog_entries_are_applied_in_chunks(monkeypatch):
+    s3 = get_s3_client()
+    create_main_db(s3)
+    monkeypatch.setattr(main, "CHANGELOG_APPLY_CHUNK_SIZE", 1)
+    main.search_service = None
+    assert asyncio.run(main.reload_snapshot(s3))
+    service = main.search_service
+
+    upserts = [{"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["War"]},
+               {"title": "Venom", "year": 2018, "cast": ["Tom Hardy"], "genres": ["Comedy"]},
+               {"title": "Dunkirk", "year": 2017, "cast": ["Fionn Whitehead"], "genres": ["War"]}]
+    s3.put_object(Body=json.dumps({"version": 1, "upserts": upserts}).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=changelog_key(1))
+
+    async def apply_and_serve():
+        # requests are served between the chunks
+        served = []
+
+        async def serve():
+            while True:
+                served.append(len(service.movies_list))
+                await asyncio.sleep(0)
+
+        server = asyncio.create_task(serve())
+        applied = await main.apply_changelog(s3)
+        server.cancel()
+        return applied, served
+
+    applied, served = asyncio.run(apply_and_serve())
+    assert applied
+    assert main.search_service is service
+    assert service.changelog_version == 1
+    # the movie appended by the first chunk is replaced by the last one
+    assert [(_.title, _.cast) for _ in service.movies_list][-2:] == [("Venom", {"Tom Hardy"}), ("Dunkirk", {"Fionn Whitehead"})]
+    assert len(service.movies_list) == 4
+    assert served[0] == 3 and served[-1] == 4
+
+    main.search_service = None
+@mock_s3
+def test_appended_segments_are_reloaded_without_changelog():
+    s3 = get_s3_client()
+    create_main_db(s3)
+    s3.copy_object(CopySource={"Bucket": AWS_STORAGE_BUCKET_NAME, "Key": "main"}, Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_SHARD_PREFIX + "1/0.json")
+    manifest = {"base": "1", "movies": 3, "shards": [{"key": SNAPSHOT_SHARD_PREFIX + "1/0.json", "format": "json", "movies": 3}]}
+
+    def append_segment(key, movies):
+        s3.put_object(Body=json.dumps(movies).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=key)
+        manifest["segments"] = manifest.get("segments", []) + [{"key": key, "format": "json", "movies": len(movies)}]
+        s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+    main.search_service = None
+    assert asyncio.run(main.reload_snapshot(s3))
+    service = main.search_service
+    # cached in the shared caches
+    assert [_.title for _ in service.cached_find_movies("", 0, "Tom Hardy", "", 0, 10).items] == ["Venom"]
+    body = service.cached_response_body("", 0, "Tom Hardy", "", 0, 10)
+
+    # change log polling disabled (or the change log entry not written), the segment is noticed by the reload check
+    append_segment(SNAPSHOT_SEGMENT_PREFIX + "2.json", [{"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["War"]}])
+    assert asyncio.run(main.reload_snapshot(s3))
+    assert main.search_service is not service
+    assert len(main.search_service.movies_list) == 4
+    # cursors are bound to the base, which did not change, cached results to the loaded data
+    assert main.search_service.version == service.version == "1"
+    assert [_.title for _ in main.search_service.cached_find_movies("", 0, "Tom Hardy", "", 0, 10).items] == ["Venom", "Dunkirk"]
+    assert main.search_service.cached_response_body("", 0, "Tom Hardy", "", 0, 10) != body
+    assert b"Dunkirk" in main.search_service.cached_response_body("", 0, "Tom Hardy", "", 0, 10)
+
+    # a segment applied from the change log is not reloaded
+    service = main.search_service
+    upserts = [{"title": "Inception", "year": 2010, "cast": ["Tom Hardy"], "genres": ["Action"]}]
+    append_segment(SNAPSHOT_SEGMENT_PREFIX + "3.json", upserts)
+    s3.put_object(Body=json.dumps({"version": 1, "upserts": upserts, "segment": SNAPSHOT_SEGMENT_PREFIX + "3.json"}).encode(),
+                  Bucket=AWS_STORAGE_BUCKET_NAME, Key=changelog_key(1))
+    assert asyncio.run(main.apply_changelog(s3))
+    assert not asyncio.run(main.reload_snapshot(s3))
+    assert main.search_service is service
+    assert len(service.movies_list) == 5
+
+    main.search_service = None
+
+
+def test_can_read_memory_usage(tmp_path):
+    smaps = tmp_path / "smaps_rollup"
+    smaps.write_text("""00400000-7ffd0000 ---p 00000000 00:00 0                          [rollup]
+Rss:              120000 kB
+Pss:               40000 kB
+Shared_Clean:      90000 kB
+Shared_Dirty:      20000 kB
+Private_Clean:      1000 kB
+Private_Dirty:      9000 kB
+""")
+
+    usage = read_memory_usage(str(smaps))
+
+    assert usage["rss"] == 120000 * 1024
+    assert usage["shared"] == 110000 * 1024
+    assert usage["unique"] == 10000 * 1024
+    assert usage["pss"] == 40000 * 1024
+    assert read_memory_usage(str(tmp_path / "missing")) == {}
+
+
+def test_latency_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for i in range(1, 101):
+        histogram.add(i / 1000)
+
+    assert histogram.count == 100
+    assert histogram.max == 0.1
+    # quantiles are upper bounds of ~19% wide buckets
+    assert 0.050 <= histogram.quantile(0.5) <= 0.050 * 1.19
+    assert 0.095 <= histogram.quantile(0.95) <= 0.095 * 1.19
+    assert histogram.quantile(0.99) <= 0.1
+    assert LatencyHistogram().quantile(0.5) == 0
+
+
+def test_can_export_prometheus_metrics():
+    counters = PerfCounters(log_sample_rate=0)
+    counters.increment("find_movies", 0.002)
+    counters.increment("find_movies", 0.003)
+    counters.count("result_cache_hit", 2)
+    counters.set_gauge("memory_rss_bytes", 1024)
+    counters.set_info("snapshot_version", 'v"1')
+
+    text = counters.prometheus_text()
+
+    assert 'movie_db_latency_seconds_bucket{key="find_movies",le="+Inf"} 2' in text
+    assert 'movie_db_latency_seconds_bucket{key="find_movies",le="0.002048"} 1' in text
+    assert 'movie_db_latency_seconds_count{key="find_movies"} 2' in text
+    assert 'movie_db_events_total{event="result_cache_hit"} 2' in text
+    assert "movie_db_memory_rss_bytes 1024" in text
+    assert 'movie_db_info{snapshot_version="v\\"1"} 1' in text
+
+    report = counters.report()
+    assert report.request_counts == {"find_movies": 2}
+    assert report.latency_ms["find_movies"].max == 3
+
+
+def test_can_profile_requests():
+    profiler = RequestProfiler()
+
+    async def capture():
+        task = asyncio.create_task(profiler.capture(requests=2, seconds=10))
+        await asyncio.sleep(0)
+        with pytest.raises(ProfilingInProgressError):
+            await profiler.capture(requests=1, seconds=1)
+        for _ in range(2):
+            sorted(range(1000), key=lambda _: -_)
+            profiler.request_finished()
+        return await task
+
+    stats = asyncio.run(capture())
+
+    assert stats.startswith("Profiled 2 requests")
+    assert "sorted" in stats
+    with pytest.raises(ValueError):
+        asyncio.run(profiler.capture(requests=1, seconds=1, sort="unknown"))
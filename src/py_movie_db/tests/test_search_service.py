@@ -1,11 +1,37 @@
+import gzip
+import hashlib
+import itertools
 import json
 import os
+import timeit
+import zlib
+from array import array
+from collections import Counter
+
 import boto3
 import pytest
 from moto import mock_s3
 
-from app.config import AWS_REGION, AWS_STORAGE_BUCKET_NAME
+from app.config import AWS_REGION, AWS_STORAGE_BUCKET_NAME, BINARY_SNAPSHOT_KEY, MAIN_DB_POINTER_KEY, MAIN_DB_PREFIX, MAX_FACET_TOP_K, \
+    SNAPSHOT_MANIFEST_KEY, SNAPSHOT_SEGMENT_PREFIX, SNAPSHOT_SHARD_PREFIX
+from benchmarks.catalogue import FAMOUS_CAST, generate_catalogue
+from benchmarks.run import InMemoryS3
+from movies.changelog import changelog_key
+from movies.cursor import InvalidCursorError
+from movies.engines import SEARCH_ENGINES, SearchEngine
+from movies.facets import FacetIndex, iter_bitset, to_bitset
+from movies.indexes import TrigramIndex, intersect_postings
+from movies.movie_table import MovieTable
+from movies.models import SearchRequest
+from movies.responses import choose_encoding
+from movies.result_cache import ResultCache
 from movies.search_service import SearchService
+from movies.shadow import ShadowComparator
+from movies.slow_query_log import SlowQueryLog
+from movies import suggest
+from movies.snapshot import HEADER, MAGIC, SECTION_LENGTH, STRING_COUNT, SnapshotFormatError, _encode_csr, decode_snapshot, \
+    encode_snapshot
+from utils.perf_tools import perf_counters
 
 
 def get_s3_client():
@@ -156,3 +182,712 @@ def test_can_find_movies_with_empty_page(svc):
     data = response.items
 
     assert len(data) == 0
+
+
+@mock_s3
+def test_can_find_movies_by_cast_and_genre(svc):
+    response = svc.find_movies(title_contains="", year=0, cast="Robert Redford", genre="Thriller", page=0, page_size=10)
+    data = response.items
+
+    assert len(data) == 1
+    assert data[0].title == "The Old Man & the Gun"
+    assert not response.has_more
+
+
+@mock_s3
+def test_indexed_results_keep_movies_list_order(svc):
+    response = svc.find_movies(title_contains="", year=2018, cast="", genre="Action", page=0, page_size=1)
+
+    assert response.items[0].title == "The Old Man & the Gun"
+    assert response.has_more
+
+    response = svc.find_movies(title_contains="", year=2018, cast="", genre="Action", page=1, page_size=1)
+
+    assert response.items[0].title == "Venom"
+    assert not response.has_more
+
+
+@mock_s3
+def test_can_find_no_movies_for_unknown_cast(svc):
+    response = svc.find_movies(title_contains="", year=2018, cast="Nobody", genre="", page=0, page_size=10)
+
+    assert len(response.items) == 0
+    assert not response.has_more
+
+
+def test_can_intersect_postings():
+    postings = [array('I', [1, 3, 5, 7, 9]), array('I', [3, 4, 5, 9]), array('I', [0, 3, 9, 11])]
+
+    assert list(intersect_postings(postings)) == [3, 9]
+    assert list(intersect_postings([array('I', [2, 4]), array('I')])) == []
+
+
+@mock_s3
+def test_can_find_movies_by_title_using_trigrams(svc):
+    response = svc.find_movies(title_contains="Man & the", year=0, cast="", genre="", page=0, page_size=10)
+    data = response.items
+
+    assert len(data) == 1
+    assert data[0].title == "The Old Man & the Gun"
+
+
+@mock_s3
+def test_trigram_candidates_are_confirmed_by_substring(svc):
+    # all trigrams of "the gun" are present in "The Old Man & the Gun", while "gun the" is not its substring
+    response = svc.find_movies(title_contains="gun the", year=0, cast="", genre="", page=0, page_size=10)
+
+    assert len(response.items) == 0
+
+
+@mock_s3
+def test_can_find_movies_by_short_title(svc):
+    response = svc.find_movies(title_contains="ve", year=2018, cast="", genre="", page=0, page_size=10)
+    data = response.items
+
+    assert len(data) == 1
+    assert data[0].title == "Venom"
+
+
+def test_trigram_index_lookup():
+    index = TrigramIndex()
+    index.add_text("venom", 0)
+    index.add_text("seven", 1)
+
+    assert index.lookup("ve") is None
+    assert [list(_) for _ in sorted(index.lookup("ven"), key=len)] == [[0, 1]]
+    assert list(intersect_postings(index.lookup("venom"))) == [0]
+
+
+@mock_s3
+def test_engines_return_same_results(svc):
+    queries = [("", 0, "", ""), ("the", 0, "", ""), ("e", 2018, "", "Action"), ("", 0, "Tom Hardy", ""), ("gun", 2018, "", "Drama")]
+
+    for title_contains, year, cast, genre in queries:
+        query = svc.make_query(title_contains, year, cast, genre)
+        results = [list(engine(svc).find_positions(query)) for engine in SEARCH_ENGINES.values()]
+        assert all(_ == results[0] for _ in results), query
+
+
+@mock_s3
+def test_shadow_engine_comparison():
+    s3 = get_s3_client()
+    create_main_db(s3)
+    svc = SearchService(s3, engine="scan", shadow_engine="index")
+
+    compared = perf_counters.event_counts.get("shadow_compared", 0)
+    mismatches = perf_counters.event_counts.get("shadow_mismatch", 0)
+
+    assert svc.shadow.compare(svc.make_query("the", 2018, "", ""), 0, 1)
+    assert perf_counters.event_counts["shadow_compared"] == compared + 1
+    assert perf_counters.event_counts.get("shadow_mismatch", 0) == mismatches
+
+
+@mock_s3
+def test_shadow_engine_mismatch_is_counted(svc):
+    class SkipFirstEngine(SearchEngine):
+        name = "skip_first"
+
+        def find_positions(self, query):
+            positions = svc.engine.find_positions(query)
+            next(positions, None)
+            return positions
+
+    shadow = ShadowComparator(svc, svc.engine, SkipFirstEngine(svc), sample_rate=1.)
+    mismatches = perf_counters.event_counts.get("shadow_mismatch", 0)
+
+    assert shadow.should_sample()
+    assert not shadow.compare(svc.make_query("", 2018, "", ""), 0, 10)
+    assert perf_counters.event_counts["shadow_mismatch"] == mismatches + 1
+
+
+@mock_s3
+def test_shadow_comparison_overlapping_a_change_is_discarded(svc):
+    class ChangingEngine(SearchEngine):
+        name = "changing"
+
+        def find_positions(self, query):
+            svc.apply_upserts([{"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["War"]}])
+            return svc.engine.find_positions(query)
+
+    shadow = ShadowComparator(svc, svc.engine, ChangingEngine(svc), sample_rate=1.)
+    compared = perf_counters.event_counts.get("shadow_compared", 0)
+    discarded = perf_counters.event_counts.get("shadow_discarded", 0)
+
+    # the new movie is found only by the candidate engine
+    assert shadow.compare(svc.make_query("", 0, "", ""), 0, 10)
+    svc.change_sequence += 1
+    assert shadow.compare(svc.make_query("", 0, "", ""), 0, 10)
+    assert perf_counters.event_counts["shadow_discarded"] == discarded + 2
+    assert perf_counters.event_counts.get("shadow_compared", 0) == compared
+
+
+def test_movie_table_stores_dictionary_encoded_movies():
+    table = MovieTable.from_json_dicts([
+        {"title": "Venom", "year": 2018, "cast": ["Tom Hardy", "Riz Ahmed"], "genres": ["Action", "Horror"]},
+        {"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["Action", "Horror"]},
+    ])
+
+    assert len(table) == 2
+    assert table.cast_ids[1] == (table.cast_names.get_id("Tom Hardy"),)
+    assert table.genre_ids[0] is table.genre_ids[1]
+    assert table.cast_names.get_id("Nobody") is None
+
+    movie = table[0]
+    assert movie.title == "Venom"
+    assert movie.title_normalized == "venom"
+    assert movie.year == 2018
+    assert movie.cast == {"Tom Hardy", "Riz Ahmed"}
+    assert movie.genres == {"Action", "Horror"}
+
+
+def test_movie_table_upsert_is_last_writer_wins():
+    table = MovieTable.from_json_dicts([
+        {"title": "Venom", "year": 2018, "cast": ["Tom Hardy", "Riz Ahmed"], "genres": ["Action", "Horror"]},
+        {"title": "Venom", "year": 1971, "cast": ["Simon Ward"], "genres": ["Horror"]},
+        {"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["War"]},
+        # of duplicates in the table the last one is replaced, as by the indexer
+        {"title": "Venom", "year": 1971, "cast": ["Sarah Miles"], "genres": ["Thriller"]},
+    ])
+    segment = MovieTable.from_json_dicts([
+        {"title": "Dunkirk", "year": 2017, "cast": ["Fionn Whitehead"], "genres": ["Drama"]},
+        {"title": "Inception", "year": 2010, "cast": ["Tom Hardy"], "genres": ["Action"]},
+        {"title": "Venom", "year": 2018, "cast": ["Tom Hardy"], "genres": ["Action"]},
+        {"title": "Dunkirk", "year": 2017, "cast": ["Fionn Whitehead", "Tom Hardy"], "genres": ["War"]},
+        {"title": "Venom", "year": 1971, "cast": ["Klaus Kinski"], "genres": ["Horror"]},
+    ])
+
+    table.upsert(segment)
+
+    assert [(_.title, _.year, _.cast, _.genres) for _ in table] == [
+        ("Venom", 2018, {"Tom Hardy"}, {"Action"}),
+        ("Venom", 1971, {"Simon Ward"}, {"Horror"}),
+        ("Dunkirk", 2017, {"Fionn Whitehead", "Tom Hardy"}, {"War"}),
+        ("Venom", 1971, {"Klaus Kinski"}, {"Horror"}),
+        ("Inception", 2010, {"Tom Hardy"}, {"Action"}),
+    ]
+    assert table.cast_names.get_id("Fionn Whitehead") is not None
+
+
+def test_movie_table_keeps_recent_json_fragments():
+    table = MovieTable.from_json_dicts([
+        {"title": "Venom", "year": 2018, "cast": ["Tom Hardy"], "genres": ["Action"]},
+        {"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["War"]},
+        {"title": "Inception", "year": 2010, "cast": ["Tom Hardy"], "genres": ["Action"]},
+    ])
+    table.json_fragments_max_size = 2
+
+    assert [table.json_fragment(_) for _ in (0, 1, 0, 2)] == [table.encode_json_fragment(_) for _ in (0, 1, 0, 2)]
+    assert list(table.json_fragments) == [0, 2]
+
+
+@mock_s3
+def test_can_find_movies_with_cursor(svc):
+    response = svc.find_movies(title_contains="e", year=0, cast="", genre="", page=0, page_size=1)
+    titles = [_.title for _ in response.items]
+
+    while response.has_more:
+        response = svc.find_movies(title_contains="e", year=0, cast="", genre="", page=0, page_size=1, cursor=response.cursor)
+        titles.extend(_.title for _ in response.items)
+
+    assert response.cursor is None
+    assert titles == [_.title for _ in svc.find_movies(title_contains="e", year=0, cast="", genre="", page=0, page_size=10).items]
+
+
+@mock_s3
+def test_cursor_continues_indexed_search(svc):
+    response = svc.find_movies(title_contains="", year=2018, cast="", genre="Action", page=0, page_size=1)
+    response = svc.find_movies(title_contains="", year=2018, cast="", genre="Action", page=0, page_size=1, cursor=response.cursor)
+
+    assert [_.title for _ in response.items] == ["Venom"]
+    assert not response.has_more
+
+
+@mock_s3
+def test_cursor_from_other_snapshot_is_rejected(svc):
+    response = svc.find_movies(title_contains="", year=0, cast="", genre="", page=0, page_size=1)
+    svc.version = "reloaded"
+
+    with pytest.raises(InvalidCursorError):
+        svc.find_movies(title_contains="", year=0, cast="", genre="", page=0, page_size=1, cursor=response.cursor)
+
+    with pytest.raises(InvalidCursorError):
+        svc.find_movies(title_contains="", year=0, cast="", genre="", page=0, page_size=1, cursor="garbage")
+
+
+@mock_s3
+def test_cached_pages_are_served_from_one_entry():
+    s3 = get_s3_client()
+    create_main_db(s3)
+    svc = SearchService(s3, result_cache=ResultCache())
+
+    hits = perf_counters.event_counts.get("result_cache_hit", 0)
+
+    pages = [svc.cached_find_movies(title_contains="e", year=0, cast="", genre="", page=page, page_size=1) for page in range(3)]
+
+    assert len(svc.result_cache) == 1
+    assert perf_counters.event_counts["result_cache_hit"] == hits + 2
+    assert pages == [svc.find_movies(title_contains="e", year=0, cast="", genre="", page=page, page_size=1) for page in range(3)]
+
+    response = svc.cached_find_movies(title_contains="e", year=0, cast="", genre="", page=0, page_size=1, cursor=pages[0].cursor)
+    assert response.items == pages[1].items
+    assert response.cursor == pages[1].cursor
+
+
+def test_result_cache_evicts_by_byte_budget():
+    entry = array('I', range(10))
+    cache = ResultCache(max_bytes=ResultCache.entry_size(entry) * 2, ttl=60)
+
+    cache.put("a", "v1", entry)
+    cache.put("b", "v1", entry)
+    assert cache.get("a", "v1") is entry
+
+    cache.put("c", "v1", entry)
+
+    assert len(cache) == 2
+    assert cache.get("b", "v1") is None
+    assert cache.get("a", "v1") is entry
+    assert cache.size_bytes == ResultCache.entry_size(entry) * 2
+
+
+def test_result_cache_expires_entries():
+    now = [0.]
+    cache = ResultCache(max_bytes=1024 * 1024, ttl=10, clock=lambda: now[0])
+
+    cache.put("a", "v1", array('I', [1]))
+    now[0] = 9.
+    assert cache.get("a", "v1") is not None
+
+    now[0] = 10.
+    assert cache.get("a", "v1") is None
+    assert cache.size_bytes == 0
+
+
+def test_result_cache_is_cleared_on_version_change():
+    cache = ResultCache(max_bytes=1024 * 1024, ttl=60)
+
+    cache.put("a", "v1", array('I', [1]))
+
+    assert cache.get("a", "v2") is None
+    assert len(cache) == 0
+
+
+@mock_s3
+def test_can_load_binary_snapshot(svc):
+    s3 = get_s3_client()
+    create_main_db(s3)
+    s3.put_object(Body=encode_snapshot(svc.movies_list), Bucket=AWS_STORAGE_BUCKET_NAME, Key=BINARY_SNAPSHOT_KEY)
+
+    binary_svc = SearchService(s3)
+
+    assert binary_svc.version == SearchService.get_snapshot_version(s3)
+    assert list(binary_svc.movies_list) == list(svc.movies_list)
+    assert binary_svc.movies_list.cast_ids == svc.movies_list.cast_ids
+    assert binary_svc.find_movies(title_contains="", year=2018, cast="Scott Haze", genre="Action", page=0, page_size=10) == \
+        svc.find_movies(title_contains="", year=2018, cast="Scott Haze", genre="Action", page=0, page_size=10)
+
+
+@mock_s3
+def test_corrupted_binary_snapshot_is_rejected(svc):
+    snapshot = bytearray(encode_snapshot(svc.movies_list))
+    snapshot[-1] ^= 0xff
+
+    with pytest.raises(SnapshotFormatError):
+        decode_snapshot(bytes(snapshot))
+
+    with pytest.raises(SnapshotFormatError):
+        decode_snapshot(b"not a snapshot")
+
+
+def test_binary_snapshot_keeps_any_string_and_reads_format_version_1():
+    items = [{"title": "Nul\0Title", "year": 2018, "cast": ["A\0B", ""], "genres": ["Drama"]},
+             {"title": "", "year": 65535, "cast": [], "genres": []}]
+    table = MovieTable.from_json_dicts(items)
+    assert list(decode_snapshot(encode_snapshot(table))) == list(table)
+
+    # snapshots of version 1, which joined the strings with NUL, are still read
+    v1_items = [{"title": "Venom", "year": 2018, "cast": ["Tom Hardy", "Michelle Williams"], "genres": ["Action"]},
+                {"title": "Mandy", "year": 2018, "cast": [], "genres": []}]
+    v1 = MovieTable.from_json_dicts(v1_items)
+
+    def v1_strings(strings):
+        return STRING_COUNT.pack(len(strings)) + "\0".join(strings).encode("utf-8")
+
+    sections = [v1_strings(v1.titles), v1.years.tobytes(), v1_strings(v1.cast_names.strings), *_encode_csr(v1.cast_ids),
+                v1_strings(v1.genre_names.strings), *_encode_csr(v1.genre_ids)]
+    payload = b"".join(SECTION_LENGTH.pack(len(section)) + section + b"\0" * (-len(section) % 8) for section in sections)
+    snapshot = HEADER.pack(MAGIC, 1, len(v1), len(payload), zlib.crc32(payload), 0) + payload
+    assert list(decode_snapshot(snapshot)) == list(v1)
+
+
+@mock_s3
+def test_can_get_pre_serialized_response_body(svc):
+    body = svc.cached_response_body(title_contains="e", year=0, cast="", genre="", page=0, page_size=2)
+    response = svc.find_movies(title_contains="e", year=0, cast="", genre="", page=0, page_size=2)
+
+    data = json.loads(body)
+    assert data["page"] == 0
+    assert data["size"] == 2
+    assert data["has_more"] == response.has_more
+    assert data["cursor"] == response.cursor
+    assert [_["title"] for _ in data["items"]] == [_.title for _ in response.items]
+    assert set(data["items"][0]["cast"]) == response.items[0].cast
+    assert set(data["items"][0]["genres"]) == response.items[0].genres
+    assert data["items"][0]["title_normalized"] == response.items[0].title_normalized
+    assert data["items"][0]["year"] == response.items[0].year
+
+    compressed = svc.cached_response_body(title_contains="e", year=0, cast="", genre="", page=0, page_size=2, encoding="gzip")
+    assert gzip.decompress(compressed) == body
+    assert svc.cached_response_body(title_contains="e", year=0, cast="", genre="", page=0, page_size=2, encoding="gzip") is compressed
+
+
+def test_can_choose_content_encoding():
+    assert choose_encoding("") == "identity"
+    assert choose_encoding("deflate") == "identity"
+    assert choose_encoding("gzip, deflate") in ("gzip", "br")
+    assert choose_encoding("gzip;q=0, identity") == "identity"
+
+
+@mock_s3
+def test_can_find_movies_batch(svc):
+    requests = [
+        SearchRequest(title_contains="e"),
+        SearchRequest(year=2018, genre="Action", page=1, page_size=1),
+        SearchRequest(cast="Tom Hardy"),
+        SearchRequest(title_contains="ve", page_size=1),
+        SearchRequest(cast="Nobody"),
+    ]
+    # one of the queries is answered from the cache
+    svc.cached_find_movies(title_contains="", year=0, cast="Tom Hardy", genre="", page=0, page_size=10)
+
+    for engine in SEARCH_ENGINES.values():
+        svc.engine = engine(svc)
+        responses = svc.find_movies_batch(requests)
+
+        assert responses == [svc.find_movies(title_contains=_.title_contains, year=_.year, cast=_.cast, genre=_.genre, page=_.page, page_size=_.page_size)
+                             for _ in requests]
+
+
+@mock_s3
+def test_can_find_movies_batch_with_cursor(svc):
+    first = svc.find_movies(title_contains="e", year=0, cast="", genre="", page=0, page_size=1)
+
+    responses = svc.find_movies_batch([SearchRequest(title_contains="e", page_size=1, cursor=first.cursor)])
+
+    assert responses[0].items == svc.find_movies(title_contains="e", year=0, cast="", genre="", page=1, page_size=1).items
+
+
+def test_bitset_round_trip():
+    positions = [0, 3, 8, 9, 63, 64, 200]
+
+    assert list(iter_bitset(to_bitset(positions, 201))) == positions
+    assert list(iter_bitset(0)) == []
+
+
+def test_can_find_facets(svc):
+    facets = svc.find_facets(title_contains="", year=0, cast="", genre="Action")
+
+    assert facets.total == 2
+    assert facets.years == {2018: 2}
+    assert facets.genres == {"Action": 2, "Thriller": 2, "Horror": 1, "Science Fiction": 1, "Superhero": 1}
+    assert len(facets.cast) == 10
+    assert facets.cast["Tom Hardy"] == 1
+
+
+def test_facets_match_search_results(svc):
+    for title_contains, year, cast, genre in [("", 0, "", ""), ("the", 0, "", ""), ("e", 2018, "", "Thriller"), ("o", 0, "Tom Hardy", ""),
+                                              ("", 2000, "", ""), ("", 0, "Nobody", "")]:
+        movies = svc.find_movies(title_contains=title_contains, year=year, cast=cast, genre=genre, page=0, page_size=100).items
+        facets = svc.find_facets(title_contains=title_contains, year=year, cast=cast, genre=genre, top_k=3)
+
+        assert facets.total == len(movies)
+        assert sum(facets.years.values()) == len(movies)
+        for genre_name, count in facets.genres.items():
+            assert count == sum(genre_name in movie.genres for movie in movies)
+        assert len(facets.cast) == min(3, len({name for movie in movies for name in movie.cast}))
+        for name, count in facets.cast.items():
+            assert count == sum(name in movie.cast for movie in movies)
+
+
+def catalogue_service(movies: int) -> SearchService:
+    return SearchService(InMemoryS3(encode_snapshot(generate_catalogue(movies))), shadow_engine="",
+                         result_cache=ResultCache(), response_cache=ResultCache(), slow_query_log=SlowQueryLog())
+
+
+def test_top_cast_of_many_matching_movies_is_counted_exactly():
+    service = catalogue_service(2000)
+    # few cast members have bitsets, cast of any filtered query is counted from them down
+    service.facet_index = FacetIndex(service, MAX_FACET_TOP_K, cast_bitsets=8, cast_scan_limit=0)
+    queries = [("", 0, "", "Drama"), ("", 0, "", "Comedy"), ("a", 0, "", ""), ("", 2000, "", ""), ("", 0, FAMOUS_CAST[0], ""), ("", 0, "New Star", "")]
+
+    def check_counts():
+        scanned = FacetIndex(service, MAX_FACET_TOP_K, cast_bitsets=0, cast_scan_limit=len(service.movies_list))
+        for query in queries:
+            for top_k in (1, 10, 100):
+                bits = scanned.filter_bits(service.make_query(*query))
+                top_cast = service.facet_index.count_top_cast(bits, bits.bit_count(), top_k)
+                assert top_cast is None or top_cast == scanned._top_cast(Counter(
+                    itertools.chain.from_iterable(service.movies_list.cast_ids[_] for _ in iter_bitset(bits))).items(), top_k)
+                assert service.facet_index.count(service.make_query(*query), top_k) == scanned.count(service.make_query(*query), top_k)
+        bits = scanned.filter_bits(service.make_query("", 0, "", "Drama"))
+        assert service.facet_index.count_top_cast(bits, bits.bit_count(), 10) is not None
+
+    check_counts()
+    # a new cast member takes over movies of the cast members with bitsets and of the others
+    service.apply_upserts([{"title": movie.title, "year": movie.year, "cast": ["New Star"] + sorted(movie.cast)[:1], "genres": ["Drama"]}
+                           for movie in itertools.islice(service.movies_list, 0, 2000, 5)])
+    check_counts()
+
+
+def test_facets_of_broad_filter_take_milliseconds():
+    service = catalogue_service(50_000)
+    bits = service.facet_index.filter_bits(service.make_query("", 0, "", "Drama"))
+    assert bits.bit_count() > 10_000
+    # top cast is counted with bitsets rather than over the matching movies
+    assert service.facet_index.count_top_cast(bits, bits.bit_count(), 10) is not None
+
+    elapsed = min(timeit.repeat(lambda: service.find_facets(title_contains="", year=0, cast="", genre="Drama"), number=1, repeat=5))
+    # counting over the matching movies took over 10ms
+    assert elapsed < 0.005
+
+
+def test_can_suggest_titles_and_cast(svc):
+    assert svc.suggest(prefix="the old", field="title").items == ["The Old Man & the Gun"]
+    assert svc.suggest(prefix="V", field="title").items == ["Venom"]
+    assert svc.suggest(prefix="x", field="title").items == []
+    assert svc.suggest(prefix="", field="title").items == []
+    assert svc.suggest(prefix="tom h", field="cast").items == ["Tom Hardy"]
+    assert svc.suggest(prefix="r", field="cast", top_k=3).items == ["Reid Scott", "Riz Ahmed", "Robert Redford"]
+
+    with pytest.raises(KeyError):
+        svc.suggest(prefix="a", field="genre")
+
+
+def test_prefix_vocabulary_ranks_large_ranges(monkeypatch):
+    monkeypatch.setattr(suggest, "SCAN_LIMIT", 2)
+    entries = [(value.lower(), value, score) for value, score in
+               [("Ab", 1), ("Abc", 5), ("Abd", 3), ("Abde", 4), ("B", 9), ("Ac", 2), ("Ab", 7)]]
+    vocabulary = suggest.PrefixVocabulary(entries, top_k_limit=3)
+
+    # prefixes with more than SCAN_LIMIT entries are precomputed
+    assert set(vocabulary.top_positions) == {"a", "ab"}
+    assert vocabulary.suggest("a", 10) == ["Abc", "Abde", "Abd"]
+    assert vocabulary.suggest("ab", 2) == ["Abc", "Abde"]
+    assert vocabulary.suggest("abd", 1) == ["Abde"]
+    assert vocabulary.suggest("ac", 3) == ["Ac"]
+    assert len(vocabulary) == 6
+
+
+def test_planner_chooses_index_or_scan(svc):
+    # the only Drama movie, the genre index is the most selective
+    plan = svc.planner.plan(svc.make_query("e", 2018, "", "Drama"))
+    assert plan.strategy == "index"
+    assert [step.description for step in plan.steps] == ["genre has 'Drama'", "title contains 'e'", "year = 2018"]
+
+    # every movie matches, the scan is cheaper than the posting list
+    assert svc.planner.plan(svc.make_query("", 2018, "", "")).strategy == "scan"
+    assert svc.planner.plan(svc.make_query("", 0, "Nobody", "")).strategy == "empty"
+
+
+def test_planner_statistics(svc):
+    statistics = svc.statistics
+
+    assert statistics.movies == 3
+    assert statistics.year_counts == {2018: 3}
+    assert statistics.estimate_title("venom") == 1
+    assert statistics.estimate_title("e") == 3
+    assert statistics.estimate_title("x" * 100) == 0
+
+
+def test_can_explain_query(svc):
+    explain = svc.explain(title_contains="the", year=0, cast="", genre="Action")
+
+    assert explain.actual_rows == len(svc.find_movies(title_contains="the", year=0, cast="", genre="Action", page=0, page_size=10).items)
+    assert explain.steps[-1].actual_rows == explain.actual_rows
+    assert [step.access for step in explain.steps][1:] == ["filter"] * (len(explain.steps) - 1)
+
+
+@mock_s3
+def test_can_load_sharded_snapshot(svc):
+    s3 = get_s3_client()
+    create_main_db(s3)
+    items = json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key="main")['Body'].read())
+
+    # shards may be binary or json, each has its own cast and genre dictionaries
+    s3.put_object(Body=encode_snapshot(MovieTable.from_json_dicts(items[:2])), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_SHARD_PREFIX + "1/0.snapshot")
+    s3.put_object(Body=json.dumps(items[2:]).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_SHARD_PREFIX + "1/1.json")
+    manifest = {"movies": 3, "shards": [{"key": SNAPSHOT_SHARD_PREFIX + "1/0.snapshot", "format": "binary", "movies": 2},
+                                        {"key": SNAPSHOT_SHARD_PREFIX + "1/1.json", "format": "json", "movies": 1}]}
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+
+    sharded_svc = SearchService(s3)
+
+    assert sharded_svc.version == SearchService.get_snapshot_version(s3)
+    assert list(sharded_svc.movies_list) == list(svc.movies_list)
+    assert sharded_svc.find_movies(title_contains="", year=0, cast="", genre="Action", page=0, page_size=10) == \
+        svc.find_movies(title_contains="", year=0, cast="", genre="Action", page=0, page_size=10)
+
+    manifest["movies"] = 4
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+    with pytest.raises(SnapshotFormatError):
+        SearchService(s3)
+
+
+@mock_s3
+def test_can_load_compressed_snapshots(svc):
+    s3 = get_s3_client()
+    create_main_db(s3)
+    items = json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key="main")['Body'].read())
+
+    # the json db named by the pointer is preferred over listed objects
+    body = gzip.compress(json.dumps(items).encode())
+    key = f"{MAIN_DB_PREFIX}{hashlib.sha256(body).hexdigest()}.json.gz"
+    s3.put_object(Body=body, Bucket=AWS_STORAGE_BUCKET_NAME, Key=key)
+    pointer = {"version": 1, "key": key, "size": len(body), "checksum": hashlib.sha256(body).hexdigest(), "encoding": "gzip"}
+    s3.put_object(Body=json.dumps(pointer).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=MAIN_DB_POINTER_KEY)
+    s3.put_object(Body=b"[]", Bucket=AWS_STORAGE_BUCKET_NAME, Key="db.json")
+
+    pointer_svc = SearchService(s3)
+    assert pointer_svc.version == SearchService.get_snapshot_version(s3) == pointer["checksum"]
+    assert list(pointer_svc.movies_list) == list(svc.movies_list)
+
+    # objects which don't match the pointer are not loaded
+    s3.put_object(Body=json.dumps({**pointer, "size": len(body) - 1}).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=MAIN_DB_POINTER_KEY)
+    with pytest.raises(ValueError):
+        SearchService(s3)
+
+    body = gzip.compress(encode_snapshot(MovieTable.from_json_dicts(items)))
+    s3.put_object(Body=body, Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_SHARD_PREFIX + "1/0.snapshot.gz")
+    manifest = {"base": "1", "movies": 3, "shards": [{"key": SNAPSHOT_SHARD_PREFIX + "1/0.snapshot.gz", "format": "binary", "encoding": "gzip",
+                                                      "size": len(body), "checksum": hashlib.sha256(body).hexdigest(), "movies": 3}]}
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+    assert list(SearchService(s3).movies_list) == list(svc.movies_list)
+
+
+@mock_s3
+def test_delta_segments_are_applied_over_sharded_snapshot(svc):
+    s3 = get_s3_client()
+    create_main_db(s3)
+    items = json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key="main")['Body'].read())
+
+    s3.put_object(Body=json.dumps(items).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_SHARD_PREFIX + "1/0.json")
+    segments = [
+        [{"title": "Venom", "year": 2018, "cast": ["Tom Hardy"], "genres": ["Comedy"]}],
+        [{"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["War"]},
+         {"title": "Venom", "year": 2018, "cast": ["Tom Hardy"], "genres": ["Sci-Fi"]}],
+    ]
+    for number, segment in enumerate(segments):
+        s3.put_object(Body=json.dumps(segment).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=f"{SNAPSHOT_SEGMENT_PREFIX}{number}.json")
+    manifest = {"movies": 3, "shards": [{"key": SNAPSHOT_SHARD_PREFIX + "1/0.json", "format": "json", "movies": 3}],
+                "segments": [{"key": f"{SNAPSHOT_SEGMENT_PREFIX}{number}.json", "format": "json", "movies": len(segment)}
+                             for number, segment in enumerate(segments)]}
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+
+    segmented_svc = SearchService(s3)
+
+    # Venom is replaced in place by the latest segment, Dunkirk is appended
+    assert [(_.title, _.genres) for _ in segmented_svc.movies_list] == \
+        [(_.title, {"Sci-Fi"} if _.title == "Venom" else _.genres) for _ in svc.movies_list] + [("Dunkirk", {"War"})]
+    assert [_.title for _ in segmented_svc.find_movies(title_contains="", year=0, cast="Tom Hardy", genre="", page=0, page_size=10).items] == \
+        ["Venom", "Dunkirk"]
+
+
+@mock_s3
+def test_upserts_are_applied_in_place(svc):
+    s3 = get_s3_client()
+    create_main_db(s3)
+    upserts = [{"title": "Venom", "year": 2018, "cast": ["Tom Hardy"], "genres": ["Comedy"]},
+               {"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["War"]}]
+    items = json.loads(s3.get_object(Bucket=AWS_STORAGE_BUCKET_NAME, Key="main")['Body'].read())
+    items = [upserts[0] if _["title"] == "Venom" else _ for _ in items] + upserts[1:]
+    s3.put_object(Body=json.dumps(items).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key="main")
+    loaded_svc = SearchService(s3, result_cache=ResultCache(), response_cache=ResultCache())
+
+    svc.result_cache = ResultCache()
+    svc.response_cache = ResultCache()
+    queries = [("", 0, "", ""), ("", 2018, "", "Action"), ("", 0, "", "Drama"), ("", 0, "Tom Hardy", ""), ("", 2017, "", ""),
+               ("venom", 0, "", ""), ("power", 0, "", ""), ("", 0, "", "War")]
+    for query in queries:
+        svc.cached_response_body(*query, page=0, page_size=10)
+    cursor = svc.find_movies(title_contains="", year=2018, cast="", genre="", page=0, page_size=1).cursor
+
+    svc.apply_upserts(upserts)
+
+    # only the queries matching Venom before or after the change or Dunkirk are invalidated
+    assert list(svc.result_cache.entries) == [svc.make_query(*_) for _ in [("", 0, "", "Drama"), ("power", 0, "", "")]]
+    assert len(svc.response_cache) == 2
+
+    for query in queries:
+        for engine in SEARCH_ENGINES.values():
+            assert list(engine(svc).find_positions(svc.make_query(*query))) == list(engine(loaded_svc).find_positions(svc.make_query(*query)))
+        assert svc.cached_response_body(*query, page=0, page_size=10) == loaded_svc.cached_response_body(*query, page=0, page_size=10)
+        assert svc.find_facets(*query) == loaded_svc.find_facets(*query)
+    # positions are kept, so cursors issued before the change continue
+    assert [_.title for _ in svc.find_movies(title_contains="", year=2018, cast="", genre="", page=0, page_size=10, cursor=cursor).items] == \
+        ["Power of the Air", "Venom"]
+    assert (svc.statistics.movies, svc.statistics.year_counts, svc.statistics.cast_counts) == \
+        (loaded_svc.statistics.movies, loaded_svc.statistics.year_counts, loaded_svc.statistics.cast_counts)
+    assert svc.statistics.char_counts == loaded_svc.statistics.char_counts
+    assert list(svc.statistics.titles_at_least) == list(loaded_svc.statistics.titles_at_least)
+
+
+def test_changelog_entries_are_applied_in_order(svc):
+    svc.changelog_version = 1
+    upserts = [{"title": "Dunkirk", "year": 2017, "cast": ["Tom Hardy"], "genres": ["War"]}]
+
+    assert svc.apply_changelog_entry({"version": 1, "upserts": upserts})
+    assert len(svc.movies_list) == 3
+    assert not svc.apply_changelog_entry({"version": 3, "upserts": upserts})
+    assert not svc.apply_changelog_entry({"version": 2, "reload": True})
+    assert svc.apply_changelog_entry({"version": 2, "upserts": upserts})
+    assert svc.changelog_version == 2
+    assert svc.suggest("dun").items == []
+    svc.build_suggestions()
+    assert svc.suggest("dun").items == ["Dunkirk"]
+
+
+@mock_s3
+def test_loaded_service_starts_at_latest_changelog_version():
+    s3 = get_s3_client()
+    create_main_db(s3)
+    for version in (1, 2):
+        s3.put_object(Body=json.dumps({"version": version, "upserts": []}).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=changelog_key(version))
+    manifest = {"base": "1", "movies": 0, "shards": []}
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+
+    service = SearchService(s3)
+
+    assert service.changelog_version == 2
+    assert service.version == service.data_version == SearchService.get_snapshot_version(s3) == "1"
+    manifest["segments"] = [{"key": SNAPSHOT_SEGMENT_PREFIX + "1.json", "format": "json", "movies": 1}]
+    s3.put_object(Body=b"[]", Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_SEGMENT_PREFIX + "1.json")
+    s3.put_object(Body=json.dumps(manifest).encode(), Bucket=AWS_STORAGE_BUCKET_NAME, Key=SNAPSHOT_MANIFEST_KEY)
+    # an appended segment changes the version of the data, not the base cursors are bound to
+    assert SearchService.get_snapshot_version(s3) == "1+" + SNAPSHOT_SEGMENT_PREFIX + "1.json"
+    assert SearchService(s3).version == "1"
+
+
+def test_json_snapshot_is_parsed_from_stream(svc):
+    contents = json.dumps([{"title": movie.title, "year": movie.year, "cast": sorted(movie.cast), "genres": sorted(movie.genres)}
+                           for movie in svc.movies_list], indent=2).encode()
+
+    table = SearchService.load_json_snapshot(contents[i:i + 5] for i in range(0, len(contents), 5))
+
+    assert list(table) == list(svc.movies_list)
+
+
+def test_slow_queries_are_logged(svc):
+    svc.slow_query_log = SlowQueryLog(threshold_ms=0, max_entries=2)
+
+    svc.find_movies(title_contains="E", year=0, cast="", genre="", page=0, page_size=1)
+    svc.cached_find_movies(title_contains="", year=2018, cast="", genre="Action", page=0, page_size=10)
+    svc.cached_find_movies(title_contains="", year=2018, cast="", genre="Action", page=0, page_size=10)
+
+    # bounded, the most recent first
+    hit, miss = svc.slow_query_log.recent()
+    assert (miss.method, miss.cache, miss.genre, miss.rows_matched) == ("cached_page", "miss", "Action", 2)
+    assert miss.rows_scanned == svc.planner.plan(svc.make_query("", 2018, "", "Action")).scanned_rows()
+    assert (hit.cache, hit.rows_scanned) == ("hit", 0)
+
+    svc.slow_query_log = SlowQueryLog(threshold_ms=10000)
+    svc.find_movies(title_contains="e", year=0, cast="", genre="", page=0, page_size=1)
+    assert svc.slow_query_log.recent() == []
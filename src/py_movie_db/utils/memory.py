@@ -0,0 +1,51 @@
+"""
+Process memory usage - shared vs unique resident memory, e.g. of pre-forked workers
+"""
+import logging
+import os
+from typing import Dict
+
+from utils.perf_tools import perf_counters
+
+SMAPS_ROLLUP = "/proc/self/smaps_rollup"
+
+
+def read_memory_usage(path: str = SMAPS_ROLLUP) -> Dict[str, int]:
+    """
+    Resident memory of the current process in bytes (linux only, empty dict otherwise):
+    - rss: total resident memory
+    - unique: pages used only by this process
+    - shared: pages shared with other processes, e.g. with the parent after fork
+    - pss: proportional share, sum of pss over workers is their real memory cost
+    """
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except OSError:
+        return {}
+
+    fields = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == "kB":
+            fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+
+    return {
+        "rss": fields.get("Rss", 0),
+        "unique": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+        "pss": fields.get("Pss", 0),
+    }
+
+
+def report_memory_usage():
+    """
+    Log memory usage and expose it as memory_*_bytes gauges
+    """
+    usage = read_memory_usage()
+    for key, value in usage.items():
+        perf_counters.set_gauge(f"memory_{key}_bytes", value)
+
+    if usage:
+        logging.info("Process %s memory: unique %.1fMb, shared %.1fMb, pss %.1fMb", os.getpid(),
+                     usage["unique"] / 2**20, usage["shared"] / 2**20, usage["pss"] / 2**20)
@@ -1,29 +1,191 @@
 """
-Basic function timing to output
+Function and request timing - latency histograms, event counters, gauges and info values,
+reported as json (/perf_counters) and in Prometheus text format (/metrics)
 """
 import functools
+import logging
+import math
+import random
+import re
+import threading
 import time
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, List
+
+from app.config import PERF_LOG_SAMPLE_RATE
+
+# histogram buckets are log-scaled: 4 buckets per doubling (~19% wide) from 1us to ~2 minutes
+MIN_LATENCY = 1e-6
+BUCKETS_PER_OCTAVE = 4
+OCTAVES = 27
+BUCKET_COUNT = BUCKETS_PER_OCTAVE * OCTAVES
+
+METRIC_PREFIX = "movie_db_"
+
+
+class LatencyHistogram:
+    """
+    Fixed bucket log-scaled histogram of durations in seconds,
+    quantiles are reported as the upper bound of the bucket (capped by the max)
+    """
+
+    def __init__(self):
+        # bucket i counts durations below upper_bound(i), the last one also counts longer ones
+        self.counts = [0] * BUCKET_COUNT
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    @staticmethod
+    def upper_bound(bucket: int) -> float:
+        return MIN_LATENCY * 2 ** ((bucket + 1) / BUCKETS_PER_OCTAVE)
+
+    @staticmethod
+    def bucket_of(elapsed: float) -> int:
+        if elapsed <= MIN_LATENCY:
+            return 0
+        bucket = int(math.log2(elapsed / MIN_LATENCY) * BUCKETS_PER_OCTAVE)
+        return bucket if bucket < BUCKET_COUNT else BUCKET_COUNT - 1
+
+    def add(self, elapsed: float):
+        self.counts[self.bucket_of(elapsed)] += 1
+        self.count += 1
+        self.sum += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def quantile(self, q: float) -> float:
+        if self.count == 0:
+            return 0.
+        rank = q * self.count
+        total = 0
+        for bucket, count in enumerate(self.counts):
+            total += count
+            if total >= rank and count:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
 
 
 @dataclass
-class PerfCounters:
+class LatencySummary:
+    """
+    Latency percentiles in milliseconds
+    """
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+
+@dataclass
+class PerfCountersReport:
     request_counts: Dict[str, int]
     elapsed_sum: Dict[str, float]
     avg_request_time: Dict[str, float]
+    latency_ms: Dict[str, LatencySummary]
+    event_counts: Dict[str, int]
+    gauges: Dict[str, float]
+    info: Dict[str, str]
+
+
+class PerfCounters:
+    """
+    Thread-safe process-wide counters:
+    - latency histograms per key (decorated function, http path, ...)
+    - event counts, gauges and info values
+    No output on the hot path, a PERF_LOG_SAMPLE_RATE fraction of timings is logged (disabled by default).
+    """
+
+    def __init__(self, log_sample_rate: float = PERF_LOG_SAMPLE_RATE):
+        self.histograms: Dict[str, LatencyHistogram] = {}
+        self.event_counts: Dict[str, int] = {}
+        self.gauges: Dict[str, float] = {}
+        self.info: Dict[str, str] = {}
+        self.log_sample_rate = log_sample_rate
+        self.lock = threading.Lock()
 
     def increment(self, key: str, elapsed: float):
-        print(f'Call {key}: {elapsed*1000:.1f}ms')
-        if key not in self.request_counts:
-            self.request_counts[key] = 0
-            self.elapsed_sum[key] = 0.
-        perf_counters.request_counts[key] += 1
-        perf_counters.elapsed_sum[key] += elapsed
-        perf_counters.avg_request_time[key] = perf_counters.elapsed_sum[key] / perf_counters.request_counts[key]
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.add(elapsed)
+
+        if self.log_sample_rate and random.random() < self.log_sample_rate:
+            logging.info("Call %s: %.1fms", key, elapsed * 1000)
+
+    def count(self, key: str, value: int = 1):
+        with self.lock:
+            self.event_counts[key] = self.event_counts.get(key, 0) + value
+
+    def set_gauge(self, key: str, value: float):
+        with self.lock:
+            self.gauges[key] = value
+
+    def set_info(self, key: str, value: str):
+        with self.lock:
+            self.info[key] = value
+
+    def report(self) -> PerfCountersReport:
+        with self.lock:
+            histograms = list(self.histograms.items())
+            return PerfCountersReport(
+                request_counts={key: _.count for key, _ in histograms},
+                elapsed_sum={key: _.sum for key, _ in histograms},
+                avg_request_time={key: _.sum / _.count for key, _ in histograms},
+                latency_ms={key: LatencySummary(p50=_.quantile(0.5) * 1000, p95=_.quantile(0.95) * 1000,
+                                                p99=_.quantile(0.99) * 1000, max=_.max * 1000)
+                            for key, _ in histograms},
+                event_counts=dict(self.event_counts),
+                gauges=dict(self.gauges),
+                info=dict(self.info),
+            )
+
+    def prometheus_text(self) -> str:
+        """
+        Counters in Prometheus text exposition format,
+        histogram buckets are reported per doubling of the latency
+        """
+        lines: List[str] = []
+        with self.lock:
+            lines.append(f"# TYPE {METRIC_PREFIX}latency_seconds histogram")
+            for key, histogram in sorted(self.histograms.items()):
+                label = f'key="{escape_label(key)}"'
+                total = 0
+                for bucket, count in enumerate(histogram.counts):
+                    total += count
+                    if (bucket + 1) % BUCKETS_PER_OCTAVE == 0 and bucket < BUCKET_COUNT - 1:
+                        lines.append(f'{METRIC_PREFIX}latency_seconds_bucket{{{label},le="{LatencyHistogram.upper_bound(bucket):.6g}"}} {total}')
+                lines.append(f'{METRIC_PREFIX}latency_seconds_bucket{{{label},le="+Inf"}} {histogram.count}')
+                lines.append(f"{METRIC_PREFIX}latency_seconds_sum{{{label}}} {histogram.sum!r}")
+                lines.append(f"{METRIC_PREFIX}latency_seconds_count{{{label}}} {histogram.count}")
+
+            lines.append(f"# TYPE {METRIC_PREFIX}events_total counter")
+            for key, value in sorted(self.event_counts.items()):
+                lines.append(f'{METRIC_PREFIX}events_total{{event="{escape_label(key)}"}} {value}')
+
+            for key, value in sorted(self.gauges.items()):
+                name = metric_name(key)
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value!r}")
+
+            if self.info:
+                labels = ",".join(f'{metric_name(key)[len(METRIC_PREFIX):]}="{escape_label(value)}"' for key, value in sorted(self.info.items()))
+                lines.append(f"# TYPE {METRIC_PREFIX}info gauge")
+                lines.append(f"{METRIC_PREFIX}info{{{labels}}} 1")
+
+        return "\n".join(lines) + "\n"
+
+
+def metric_name(key: str) -> str:
+    return METRIC_PREFIX + re.sub(r"[^a-zA-Z0-9_]", "_", key)
+
+
+def escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
 
 
-perf_counters = PerfCounters({}, {}, {})
+perf_counters = PerfCounters()
 
 
 def measure_time_elapsed(func):
@@ -0,0 +1,70 @@
+"""
+On-demand profiling of the requests served by the process
+"""
+import asyncio
+import cProfile
+import io
+import pstats
+import time
+from typing import Optional
+
+
+class ProfilingInProgressError(RuntimeError):
+    pass
+
+
+class RequestProfiler:
+    """
+    Runs cProfile on the event loop thread until the next N requests have finished or T seconds have passed,
+    i.e. it covers the request handlers and everything else running on the loop meanwhile.
+    Only one capture runs at a time; in the pre-fork server it profiles the worker serving the capture request.
+    """
+
+    def __init__(self):
+        self.profile: Optional[cProfile.Profile] = None
+        self.remaining_requests = 0
+        self.profiled_requests = 0
+        self.done: Optional[asyncio.Event] = None
+
+    async def capture(self, requests: int, seconds: float, sort: str = "cumulative", limit: int = 50) -> str:
+        """
+        Profile until the number of requests have finished or the time has passed,
+        returns aggregated stats of the top functions as text
+
+        :raises ValueError: if the sort key is unknown
+        :raises ProfilingInProgressError: if another capture is running
+        """
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise ValueError(f"Unknown sort key {sort}")
+        if self.profile is not None:
+            raise ProfilingInProgressError("Profiling is already running")
+
+        self.profile = cProfile.Profile()
+        self.remaining_requests = requests
+        self.profiled_requests = 0
+        self.done = asyncio.Event()
+        start_time = time.perf_counter()
+        self.profile.enable()
+        try:
+            await asyncio.wait_for(self.done.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.profile.disable()
+            profile, self.profile = self.profile, None
+
+        stream = io.StringIO()
+        stream.write(f"Profiled {self.profiled_requests} requests in {time.perf_counter() - start_time:.3f}s\n")
+        pstats.Stats(profile, stream=stream).sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    def request_finished(self):
+        if self.profile is None:
+            return
+        self.profiled_requests += 1
+        self.remaining_requests -= 1
+        if self.remaining_requests <= 0:
+            self.done.set()
+
+
+request_profiler = RequestProfiler()